@@ -37,12 +37,10 @@ wire   [7:0] rx_data;
 wire         rx_avail;
 reg          rx_ack;
 
-uart #(
-	.freq_hz(  clk_freq       ),
-	.baud(     uart_baud_rate )
-) tb_uart (
+uart tb_uart (
 	.reset(    reset     ),
 	.clk(      clk       ),
+	.divisor(  clk_freq/uart_baud_rate/16 ),
 	//
 	.uart_txd( uart_rxd  ),
 	.uart_rxd( uart_txd  ),
@@ -19,7 +19,113 @@ uint32_t read_uint32()
     return val;
 }
 
-#define     TEST_PATTERN        0x41424142
+void write_uint32(uint32_t val)
+{
+	uart_putchar((val >> 24) & 0xff);
+	uart_putchar((val >> 16) & 0xff);
+	uart_putchar((val >>  8) & 0xff);
+	uart_putchar((val >>  0) & 0xff);
+}
+
+/* CRC32 (IEEE 802.3, reflected), same result as zlib.crc32 on the host */
+uint32_t crc32_update(uint32_t crc, uint8_t c)
+{
+	int j;
+
+	crc ^= c;
+	for (j = 0; j < 8; j++)
+		crc = (crc >> 1) ^ (0xedb88320 & -(crc & 1));
+	return crc;
+}
+
+uint32_t crc32(uint8_t *p, uint32_t size)
+{
+	uint32_t crc = 0xffffffff;
+
+	while (size--)
+		crc = crc32_update(crc, *p++);
+	return ~crc;
+}
+
+/*
+ * LZSS decoder for the format of boot0-sd/compressor-pc.c (N=4096, F=18,
+ * THRESHOLD=2). Ring buffer positions are mapped back onto the output
+ * itself, so the data is decompressed straight into RAM as it arrives.
+ * size is the number of compressed bytes to read from the UART.
+ */
+#define     LZ_N                4096
+#define     LZ_F                18
+#define     LZ_THRESHOLD        2
+
+void unpack(uint8_t *dst, uint32_t size)
+{
+	uint8_t *out = dst;
+	uint32_t flags = 0, pos, len, dist;
+
+	while (size) {
+		if (((flags >>= 1) & 256) == 0) {
+			flags = (uint8_t)uart_getchar() | 0xff00;
+			if (--size == 0)
+				break;
+		}
+		if (flags & 1) {
+			*out++ = uart_getchar();
+			size--;
+		} else {
+			if (size < 2)
+				break;
+			pos  = (uint8_t)uart_getchar();
+			len  = (uint8_t)uart_getchar();
+			size -= 2;
+			pos |= (len & 0xf0) << 4;
+			len  = (len & 0x0f) + LZ_THRESHOLD + 1;
+			dist = (LZ_N - LZ_F + (out - dst) - pos) & (LZ_N - 1);
+			if (dist == 0)
+				dist = LZ_N;
+			while (len--) {
+				/* positions before the stream start hold the initial spaces */
+				*out = (out - dst < dist) ? ' ' : *(out - dist);
+				out++;
+			}
+		}
+	}
+}
+
+/*
+ * Baud rate switch. The request is acknowledged at the old rate, then the
+ * host sends a BAUD_PROBE_LEN byte probe at the new rate which is echoed
+ * back, followed by a 'K' once the host received the echo intact. Without
+ * a clean probe and the 'K' the old divisor is restored.
+ */
+#define     BAUD_PROBE_LEN      64
+#define     BAUD_PROBE(i)       ((uint8_t)((i) * 0x1d + 0x55))
+#define     BAUD_TIMEOUT        100
+
+void set_baudrate(uint32_t baud)
+{
+	uint32_t old = uart0->div;
+	int i, c, ok = 1;
+
+	if (baud == 0)
+		return;
+	uart_putchar('b');
+	while (uart0->ucr & UART_BUSY) ;
+	uart0->div = FCPU / (16 * baud);
+
+	for (i = 0; i < BAUD_PROBE_LEN; i++) {
+		c = uart_getchar_timeout(BAUD_TIMEOUT);
+		if (c != BAUD_PROBE(i))
+			ok = 0;
+		if (c < 0)
+			break;
+		uart_putchar(c);
+	}
+	if (ok && uart_getchar_timeout(BAUD_TIMEOUT) == 'K')
+		return;
+
+	while (uart0->ucr & UART_BUSY) ;
+	uart0->div = old;
+}
 
 void display_addr(int addr){
     gpio0->out = addr;
@@ -29,6 +135,185 @@ void display_int(int val){
     gpio0->out = val;
 }
 
+/*
+ * Packet mode, the framed protocol entered with 'p'. Both directions use
+ *
+ *   0xa5 type seq addr[4] len[4] hcrc[4] [data[len] dcrc[4]]
+ *
+ * hcrc is the CRC32 over type..len, data only follows on 'u' requests and
+ * on 'a' replies. Requests are 'u' (write data to addr), 'd' (read len
+ * bytes at addr), 'c' (CRC32 of len bytes at addr) and 'q' (back to the
+ * plain protocol). Every request is answered with 'a' and the same seq,
+ * or with 'n' when its data arrived damaged; frames with a bad header
+ * are dropped and the host sends them again after a timeout.
+ *
+ * A host that lost the ACK of 'q' sends 'q' again, so after leaving the
+ * bootloader keeps answering 'q' and drops everything else until the
+ * line was quiet for PKT_LINGER ms. Only then the plain command parser
+ * takes over, no frame byte is ever run as a command.
+ *
+ * The UART holds a single byte, so the host may have PKT_WINDOW requests
+ * in flight only because everything that waits for the transmitter moves
+ * incoming bytes into the pkt_rx ring meanwhile.
+ */
+#define     PKT_SOF             0xa5
+#define     PKT_WINDOW          4
+#define     PKT_MAX             1024
+#define     PKT_TIMEOUT         20
+#define     PKT_RXBUF           64
+#define     PKT_LINGER          500
+
+uint8_t  pkt_rx[PKT_RXBUF];
+uint32_t pkt_head, pkt_tail;
+
+void pkt_poll()
+{
+	uint8_t c;
+
+	if (uart0->ucr & UART_DR) {
+		c = uart0->rxtx;
+		if (pkt_head - pkt_tail < PKT_RXBUF)
+			pkt_rx[pkt_head++ % PKT_RXBUF] = c;
+	}
+}
+
+int pkt_getchar()
+{
+	if (pkt_head == pkt_tail)
+		return uart_getchar_timeout(PKT_TIMEOUT);
+	return pkt_rx[pkt_tail++ % PKT_RXBUF];
+}
+
+void pkt_putchar(uint8_t c, uint32_t *crc)
+{
+	while (uart0->ucr & UART_BUSY)
+		pkt_poll();
+	uart0->rxtx = c;
+	if (crc)
+		*crc = crc32_update(*crc, c);
+}
+
+/* read a big endian field of n bytes, 0 on timeout */
+int pkt_read(uint32_t *val, int n, uint32_t *crc)
+{
+	int c;
+
+	*val = 0;
+	while (n--) {
+		if ((c = pkt_getchar()) < 0)
+			return 0;
+		if (crc)
+			*crc = crc32_update(*crc, c);
+		*val = (*val << 8) | c;
+	}
+	return 1;
+}
+
+/* read the header following a SOF, 0 when late or damaged */
+int pkt_header(uint32_t *type, uint32_t *seq, uint32_t *addr, uint32_t *len)
+{
+	uint32_t crc = 0xffffffff, check;
+
+	return pkt_read(type, 1, &crc) && pkt_read(seq, 1, &crc) &&
+	    pkt_read(addr, 4, &crc) && pkt_read(len, 4, &crc) &&
+	    pkt_read(&check, 4, 0) && check == ~crc;
+}
+
+void pkt_write(uint32_t val, int n, uint32_t *crc)
+{
+	while (n--)
+		pkt_putchar(val >> (8 * n), crc);
+}
+
+void pkt_reply(uint8_t type, uint8_t seq, uint32_t addr, uint32_t len, uint8_t *data)
+{
+	uint32_t crc = 0xffffffff;
+
+	pkt_putchar(PKT_SOF, 0);
+	pkt_write(type, 1, &crc);
+	pkt_write(seq, 1, &crc);
+	pkt_write(addr, 4, &crc);
+	pkt_write(len, 4, &crc);
+	pkt_write(~crc, 4, 0);
+	if (!data)
+		return;
+	crc = 0xffffffff;
+	while (len--)
+		pkt_putchar(*data++, &crc);
+	pkt_write(~crc, 4, 0);
+}
+
+/* answer repeated 'q' until the line was quiet for PKT_LINGER ms */
+void pkt_linger()
+{
+	uint32_t type, seq, addr, len;
+	int c;
+
+	for (;;) {
+		if (pkt_head != pkt_tail)
+			c = pkt_rx[pkt_tail++ % PKT_RXBUF];
+		else if ((c = uart_getchar_timeout(PKT_LINGER)) < 0)
+			return;
+		if (c == PKT_SOF && pkt_header(&type, &seq, &addr, &len) && type == 'q')
+			pkt_reply('a', seq, addr, 0, 0);
+	}
+}
+
+void packet_mode()
+{
+	uint32_t type, seq, addr, len, crc, check;
+	uint8_t *p;
+	int c;
+
+	pkt_head = pkt_tail = 0;
+	// announce the window and the largest data part
+	pkt_reply('p', 0, PKT_WINDOW, PKT_MAX, 0);
+	for (;;) {
+		while (pkt_getchar() != PKT_SOF) ;
+		if (!pkt_header(&type, &seq, &addr, &len))
+			continue;
+
+		switch (type) {
+			case 'u':
+				if (len > PKT_MAX)
+					break;
+				display_addr(addr);
+				crc = 0xffffffff;
+				for (p = (uint8_t *) addr; p < (uint8_t *) (addr+len); p++) {
+					if ((c = pkt_getchar()) < 0)
+						break;
+					*p = c;
+					crc = crc32_update(crc, c);
+				}
+				if (p < (uint8_t *) (addr+len) || !pkt_read(&check, 4, 0) || check != ~crc)
+					break;
+				pkt_reply('a', seq, addr, 0, 0);
+				continue;
+			case 'd':
+				if (len > PKT_MAX)
+					break;
+				pkt_reply('a', seq, addr, len, (uint8_t *) addr);
+				continue;
+			case 'c':
+				crc = 0xffffffff;
+				for (p = (uint8_t *) addr; p < (uint8_t *) (addr+len); p++) {
+					crc = crc32_update(crc, *p);
+					pkt_poll();
+				}
+				crc = ~crc;
+				pkt_reply('a', seq, addr, 4, (uint8_t *) &crc);
+				continue;
+			case 'q':
+				pkt_reply('a', seq, addr, 0, 0);
+				pkt_linger();
+				return;
+		}
+		pkt_reply('n', seq, addr, len, 0);
+	}
+}
+
+#define     TEST_PATTERN        0x41424142
+
 int main(int argc, char **argv)
 {
 	int8_t  *p;
@@ -59,6 +344,23 @@ int main(int argc, char **argv)
 					uart_putchar( *p );
     			}
     			break;
+			case 'z': // compressed upload
+    			start = read_uint32();
+    			size  = read_uint32();
+                display_addr(start);
+    			unpack((uint8_t *) start, size);
+    			break;
+			case 'c': // checksum
+    			start = read_uint32();
+    			size  = read_uint32();
+    			write_uint32(crc32((uint8_t *) start, size));
+    			break;
+			case 'b': // baud rate
+    			set_baudrate(read_uint32());
+    			break;
+			case 'p': // packet mode
+    			packet_mode();
+    			break;
     		case 'g': // goto
     			start = read_uint32();
     			display_int(0xdead);
@@ -52,6 +52,29 @@ char uart_getchar()
 	return uart0->rxtx;
 }
 
+/* returns -1 when nothing arrived within msec or on a framing error */
+int uart_getchar_timeout(int msec)
+{
+	uint32_t ucr;
+
+	// Use timer0.1
+	timer0->compare1 = (FCPU/1000)*msec;
+	timer0->counter1 = 0;
+	timer0->tcr1 = TIMER_EN;
+
+	do {
+		ucr = uart0->ucr;
+		if (timer0->tcr1 & TIMER_TRIG)
+			return -1;
+	} while (! (ucr & UART_DR));
+
+	if (ucr & UART_ERR) {
+		ucr = uart0->rxtx;
+		return -1;
+	}
+	return (uint8_t) uart0->rxtx;
+}
+
 void uart_putchar(char c)
 {
 	while (uart0->ucr & UART_BUSY) ;
@@ -89,10 +89,12 @@ typedef struct {
 typedef struct {
    volatile uint32_t ucr;
    volatile uint32_t rxtx;
+   volatile uint32_t div;
 } uart_t;
 
 void uart_init();
 void uart_putchar(char c);
+int  uart_getchar_timeout(int msec);
 void uart_putstr(char *str);
 void uart_putint8(unsigned char c);
 void uart_puthex8(char c);
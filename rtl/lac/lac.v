@@ -37,12 +37,10 @@ wire   [7:0] rx_data;
 wire         rx_avail;
 reg          rx_ack;
 
-uart #(
-	.freq_hz( uart_freq_hz ),
-	.baud(    uart_baud    )
-) uart0 (
+uart uart0 (
 	.reset(       reset         ),
 	.clk(         uart_clk      ),
+	.divisor(     uart_freq_hz/uart_baud/16 ),
 	// UART
 	.uart_txd(    uart_txd      ),
 	.uart_rxd(    uart_rxd      ),
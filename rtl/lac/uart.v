@@ -2,12 +2,11 @@
 // Design Name : uart 
 // File Name   : uart.v
 //-----------------------------------------------------
-module uart #(
-	parameter          freq_hz = 100000000,
-	parameter          baud    = 115200
-) (
+module uart (
 	input              reset,
 	input              clk,
+	// enable16 divisor: freq_hz/baud/16
+	input      [15:0]  divisor,
 	// UART lines
 	input              uart_rxd,
 	output reg         uart_txd,
@@ -21,8 +20,6 @@ module uart #(
 	output reg         tx_busy
 );
 
-parameter divisor = freq_hz/baud/16;
-
 //-----------------------------------------------------------------
 // enable16 generator
 //-----------------------------------------------------------------
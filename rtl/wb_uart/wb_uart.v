@@ -5,6 +5,8 @@
 //
 //    0x00 UCR      [ 0 | 0 | 0 | tx_busy | 0 | 0 | rx_error | rx_avail ]
 //    0x04 DATA
+//    0x08 DIV      enable16 divisor (clk_freq/baud/16), reset to the
+//                  synthesis time baud rate
 //
 //---------------------------------------------------------------------------
 
@@ -38,13 +40,12 @@ reg        rx_ack;
 wire [7:0] tx_data;
 reg        tx_wr;
 wire       tx_busy;
+reg [15:0] divisor;
 
-uart #(
-	.freq_hz(   clk_freq ),
-	.baud(      baud     )
-) uart0 (
+uart uart0 (
 	.clk(       clk      ),
 	.reset(     reset    ),
+	.divisor(   divisor  ),
 	//
 	.uart_rxd(  uart_rxd ),
 	.uart_txd(  uart_txd ),
@@ -79,6 +80,7 @@ begin
 		tx_wr  <= 0;
 		rx_ack <= 0;
 		ack    <= 0;
+		divisor <= clk_freq/baud/16;
 	end else begin
 		wb_dat_o[31:8] <= 24'b0;
 		tx_wr  <= 0;
@@ -96,6 +98,9 @@ begin
 				wb_dat_o[7:0] <= rx_data;
 				rx_ack        <= 1;
 			end
+			2'b10: begin
+				wb_dat_o[15:0] <= divisor;
+			end
 			default: begin
 				wb_dat_o[7:0] <= 8'b0;
 			end
@@ -106,6 +111,10 @@ begin
 			if ((wb_adr_i[3:2] == 2'b01) && ~tx_busy) begin
 				tx_wr <= 1;
 			end
+
+			if (wb_adr_i[3:2] == 2'b10) begin
+				divisor <= wb_dat_i[15:0];
+			end
 		end
 	end
 end
@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+lm32bench - throughput benchmarks for the lm32client transfer paths.
+
+Without a device the bootloader and the lac are emulated by lm32emu on
+pseudo terminals, so runs are repeatable on any host. Every test reports
+payload bytes/s, the protocol overhead (wire bytes beyond the payload) and
+the host CPU time spent.
+"""
+import sys
+import os
+import time
+import json
+import random
+import tempfile
+import subprocess
+import optparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import lm32client
+
+TESTS = ("upload", "upload_chunked", "download_chunked", "memcheck", "memcheck_stream", "lac")
+
+
+class BenchSerial(lm32client.LM32Serial):
+    """LM32Serial without progress output"""
+
+    def info(self, msg):
+        pass
+
+    def progress(self):
+        pass
+
+    def sync(self, pending):
+        """wait until the target consumed pending bytes and answers again"""
+        if self.packets:
+            # every packet is acknowledged already
+            return
+        self.wire.send('\r')
+        banner = bytearray(len(lm32client.LM32Serial.BOOT_SIG) + 5)
+        self.read_into(memoryview(banner), pending * 10.0 / self.io.baudrate)
+
+
+class BenchLac(BenchSerial, lm32client.Lm32Lac):
+    pass
+
+
+class Emulator(object):
+    """lm32emu child process serving one device on a pty"""
+
+    def __init__(self, mode, baud, depth, noise=0.0):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lm32emu.py")
+        args = [sys.executable, script, "--mode", mode, "--depth", str(depth), "--noise", str(noise)]
+        if baud:
+            args += ["--baud", str(baud)]
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self.port = self.proc.stdout.readline().strip()
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+def measure(lm32, test, block_size, payload, func):
+    sent, received = lm32.wire.sent, lm32.received
+    cpu = sum(os.times()[:2])
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    cpu = sum(os.times()[:2]) - cpu
+    wire = lm32.wire.sent - sent + lm32.received - received
+    return {
+        "test": test,
+        "block_size": block_size,
+        "bytes": payload,
+        "wire": wire,
+        "seconds": seconds,
+        "rate": payload / seconds,
+        "overhead": float(wire - payload) / payload,
+        "cpu": cpu,
+    }
+
+
+def bench_board(lm32, tests, base, size, block_sizes, seed):
+    data = bytearray(random.Random(seed).getrandbits(8) for i in xrange(size))
+    results = []
+
+    def upload():
+        lm32.upload(base, data)
+        lm32.sync(size)
+
+    if "upload" in tests:
+        results.append(measure(lm32, "upload", size, size, upload))
+
+    for block_size in block_sizes:
+
+        def upload_chunked():
+            lm32.upload_chunked(data, base, size, block_size)
+            lm32.sync(size)
+
+        def download_chunked():
+            lm32.download_chunked(base, size, block_size)
+
+        def memcheck(stream):
+            options = optparse.Values(dict(stream=stream, seed=seed, max_errors=0))
+            result = lm32client.run_memcheck(lm32, lm32client.pattern_prng, base, size, block_size, options)
+            if result.errors:
+                raise lm32client.serial.SerialException("memcheck found %i errors" % result.errors)
+
+        if "upload_chunked" in tests:
+            results.append(measure(lm32, "upload_chunked", block_size, size, upload_chunked))
+        if "download_chunked" in tests:
+            results.append(measure(lm32, "download_chunked", block_size, size, download_chunked))
+        if "memcheck" in tests:
+            results.append(measure(lm32, "memcheck", block_size, 2 * size, lambda: memcheck(False)))
+        if "memcheck_stream" in tests:
+            results.append(measure(lm32, "memcheck_stream", block_size, 2 * size, lambda: memcheck(True)))
+    return results
+
+
+def bench_lac(lac):
+    fd, filename = tempfile.mkstemp(suffix=".vcd")
+    os.close(fd)
+    vcd = lm32client.VCDWriter(filename, "1ns")
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+
+    def readout():
+        lac.arm()
+        lac.getSize()
+        lac.get(vcd)
+
+    try:
+        vcd.writeHeader()
+        vcd.writeWires()
+        lac.setup(0, 0, 0)
+        lac.disarm()
+        # the capture size is only known once it arrived
+        result = measure(lac, "lac", 1, 1, readout)
+        vcd.close()
+    finally:
+        sys.stdout = stdout
+        os.unlink(filename)
+    result["bytes"] = lac.size
+    result["rate"] = lac.size / result["seconds"]
+    result["overhead"] = float(result["wire"] - lac.size) / lac.size
+    return result
+
+
+def report(results):
+    print "%-18s %8s %10s %9s %10s %9s %8s" % ("test", "block", "bytes", "seconds", "kB/s", "overhead", "cpu")
+    for r in results:
+        print "%-18s %8i %10i %9.3f %10.1f %8.2f%% %8.3f" % (r["test"], r["block_size"], r["bytes"],
+            r["seconds"], r["rate"] / 1024, 100 * r["overhead"], r["cpu"])
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "lm32bench - Throughput benchmarks for lm32client, against lm32emu by default"
+    )
+
+    parser.add_option("-d", "--device",
+        dest = "port",
+        help = "Bootloader device, an emulator is started when not set (Default: %default)",
+        default = None
+    )
+
+    parser.add_option("", "--lac-device",
+        dest = "lac_port",
+        help = "lac device, an emulator is started when not set (Default: %default)",
+        default = None
+    )
+
+    parser.add_option("-b", "--baud",
+        dest = "baudrate",
+        action = "store",
+        type = 'int',
+        help = "set baud rate, default %default",
+        default = 115200
+    )
+
+    parser.add_option("", "--throttle",
+        dest = "throttle",
+        action = "store_true",
+        help = "Let the emulators run at the baud rate instead of full speed",
+        default = False
+    )
+
+    parser.add_option("-t", "--tests",
+        dest = "tests",
+        action = "store",
+        help = "Comma separated tests out of %s (Default: all)" % ",".join(TESTS),
+        default = ",".join(TESTS)
+    )
+
+    parser.add_option("-a", "--addr",
+        dest = "start_addr",
+        action = "store",
+        help = "Start address in hex (Default: %default)",
+        default = "0x40000000"
+    )
+
+    parser.add_option("-s", "--size",
+        dest = "size",
+        action = "store",
+        help = "Bytes per test in hex (Default: %default)",
+        default = "0x10000"
+    )
+
+    parser.add_option("", "--blocks",
+        dest = "block_sizes",
+        action = "store",
+        help = "Comma separated block sizes in hex (Default: %default)",
+        default = "0x100,0x800,0x4000"
+    )
+
+    parser.add_option("", "--packets",
+        dest = "packets",
+        action = "store_true",
+        help = "Run the bootloader tests in packet mode",
+        default = False
+    )
+
+    parser.add_option("", "--noise",
+        dest = "noise",
+        action = "store",
+        type = 'float',
+        help = "Bit error chance per byte of the emulated links (Default: %default)",
+        default = 0.0
+    )
+
+    parser.add_option("", "--depth",
+        dest = "depth",
+        action = "store",
+        type = 'int',
+        help = "Emulated lac capture depth as power of two (Default: %default)",
+        default = 11
+    )
+
+    parser.add_option("", "--seed",
+        dest = "seed",
+        action = "store",
+        type = 'int',
+        help = "Seed of the test data (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--json",
+        dest = "filename_json",
+        action = "store",
+        help = "Also write the results to this JSON file",
+        default = None
+    )
+
+    (options, args) = parser.parse_args()
+
+    tests = options.tests.split(",")
+    for test in tests:
+        if test not in TESTS:
+            lm32client.die("Unknown test %s, use some of %s" % (test, ",".join(TESTS)))
+    try:
+        base = int(options.start_addr,16)
+        size = int(options.size,16)
+        block_sizes = [int(b,16) for b in options.block_sizes.split(",")]
+    except ValueError:
+        lm32client.die("Cannot convert inpurt values to hex")
+
+    throttle = options.throttle and options.baudrate
+    emulators = []
+    results = []
+    try:
+        if [t for t in tests if t != "lac"]:
+            port = options.port
+            if port is None:
+                emulators.append(Emulator("bootloader", throttle, options.depth, options.noise))
+                port = emulators[-1].port
+            lm32 = BenchSerial(port, options.baudrate)
+            lm32.find_bootloader(packets=options.packets)
+            results += bench_board(lm32, tests, base, size, block_sizes, options.seed)
+            lm32.close()
+        if "lac" in tests:
+            port = options.lac_port
+            if port is None:
+                emulators.append(Emulator("lac", throttle, options.depth))
+                port = emulators[-1].port
+            lac = BenchLac(port, options.baudrate)
+            results.append(bench_lac(lac))
+            lac.close()
+    except lm32client.BootloaderNotFound, e:
+        lm32client.die(str(e))
+    finally:
+        for emulator in emulators:
+            emulator.close()
+
+    report(results)
+    if options.filename_json:
+        fd = open(options.filename_json, "w")
+        json.dump(results, fd, indent=2)
+        fd.close()
+
+if __name__ == '__main__':
+    main()
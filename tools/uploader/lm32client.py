@@ -2,12 +2,38 @@
 # -*- coding: utf-8 -*-
 import random
 import sys
+import bisect
+import binascii
+import struct
+import mmap
+import array
+import zlib
+import json
+import hashlib
 import serial
 import cgitb
 import os
 import time
 import threading
+import Queue
+import socket
+import optparse
+import glob
 import termios
+import contextlib
+import select
+import string
+import re
+import subprocess
+import tempfile
+import signal
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from lm32image import make_dirs, SegmentMap, load_image
 
 EXITCHARCTER = '\x1d'   # GS/CTRL+]
 MENUCHARACTER = '\x14'  # Menu: CTRL+T
@@ -45,8 +71,24 @@ console = Console()
 def cleanup_console():
     console.cleanup()
 
-console.setup()
-sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
+
+def get_help_text():
+    return """
+--- Miniterm menu, %(menu)s followed by:
+---    %(menu)s %(exit)s  send the menu or exit character itself
+---    Ctrl+U   upload a text file line by line
+---    Ctrl+Y   send files with YMODEM
+---    Ctrl+X   send a file with XMODEM-1K
+---    Ctrl+W   receive files with YMODEM, or one file with XMODEM
+---    Ctrl+R   toggle RTS          Ctrl+D  toggle DTR       Ctrl+B  toggle BREAK
+---    Ctrl+E   toggle local echo   Ctrl+I  port settings
+---    Ctrl+A   cycle escape mode   Ctrl+L  cycle linefeed mode
+---    b        change baudrate     7 8     data bits
+---    e o m s n   parity          1 2 3   stop bits
+---    x X      software flow control off/on
+---    r R      hardware flow control off/on
+--- %(exit)s exits
+""" % {'menu': key_description(MENUCHARACTER), 'exit': key_description(EXITCHARCTER)}
 
 
 CONVERT_CRLF = 2
@@ -57,8 +99,34 @@ LF_MODES = ('LF', 'CR', 'CR/LF')
 
 REPR_MODES = ('raw', 'some control', 'all control', 'hex')
 
+LOG_FLUSH_INTERVAL = 0.5    # seconds miniterm.log may lag behind the console
+
+# received data is translated chunk wise, only characters the escape modes
+# change are looked up
+CR_TO_LF = string.maketrans('\r', '\n')
+HEXDUMP = dict((chr(i), "%02x " % i) for i in range(256))
+NEEDS_ESCAPE = re.compile(r'[^\x20-\x5b\x5d-\x7e]')
+ESCAPES = dict((chr(i), repr(chr(i))[1:-1]) for i in range(256))
+ESCAPE_TABLES = {}
+
+def escape_table(repr_mode, convert):
+    """replacements for repr modes 1 (newlines pass) and 2 (all escaped)"""
+    key = (repr_mode, convert)
+    if key not in ESCAPE_TABLES:
+        table = dict(ESCAPES)
+        if repr_mode == 1:
+            if convert == CONVERT_CRLF:
+                table['\r'] = ''
+                table['\n'] = '\n'
+            elif convert == CONVERT_LF:
+                table['\n'] = '\n'
+            elif convert == CONVERT_CR:
+                table['\r'] = '\n'
+        ESCAPE_TABLES[key] = table
+    return ESCAPE_TABLES[key]
+
 class Miniterm:
-    def __init__(self, port, baudrate, parity, rtscts, xonxoff, echo=False, convert_outgoing=CONVERT_CRLF, repr_mode=0):
+    def __init__(self, port, baudrate, parity, rtscts, xonxoff, echo=False, convert_outgoing=CONVERT_CRLF, repr_mode=0, recorder=None):
         try:
             self.serial = serial.serial_for_url(port, baudrate, parity=parity, rtscts=rtscts, xonxoff=xonxoff, timeout=1)
         except AttributeError:
@@ -73,6 +141,9 @@ class Miniterm:
         self.rts_state = True
         self.break_state = False
         self.log = open("miniterm.log","w")
+        self.recorder = recorder
+        self.paused = threading.Event()
+        self.reader_idle = threading.Event()
 
     def start(self):
         self.alive = True
@@ -120,54 +191,114 @@ class Miniterm:
             # yet received. ignore this error.
             pass
 
+    def translate(self, data):
+        """escape and newline conversion of a received chunk"""
+        if self.repr_mode == 0:
+            # direct output, just have to care about newline setting
+            if self.convert_outgoing == CONVERT_CR:
+                return data.translate(CR_TO_LF)
+            return data
+        if self.repr_mode == 3:
+            # escape everything (hexdump)
+            return "".join(map(HEXDUMP.__getitem__, data))
+        table = escape_table(self.repr_mode, self.convert_outgoing)
+        return NEEDS_ESCAPE.sub(lambda match: table[match.group()], data)
+
     def reader(self):
-        """loop and copy serial->console"""
+        """loop and copy serial->console. Everything the port has buffered
+           is taken at once, miniterm.log is flushed at most every
+           LOG_FLUSH_INTERVAL seconds.
+        """
+        flushed = time.time()
         try:
             while self.alive:
-                data = self.serial.read(1)
-
-                if self.repr_mode == 0:
-                    # direct output, just have to care about newline setting
-                    if data == '\r' and self.convert_outgoing == CONVERT_CR:
-                        sys.stdout.write('\n')
-                        self.log.write('\n')
-                    else:
-                        sys.stdout.write(data)
-                        self.log.write(data)
-                elif self.repr_mode == 1:
-                    # escape non-printable, let pass newlines
-                    if self.convert_outgoing == CONVERT_CRLF and data in '\r\n':
-                        if data == '\n':
-                            sys.stdout.write('\n')
-                            self.log.write('\n')
-                        elif data == '\r':
-                            pass
-                    elif data == '\n' and self.convert_outgoing == CONVERT_LF:
-                        sys.stdout.write('\n')
-                        self.log.write('\n')
-                    elif data == '\r' and self.convert_outgoing == CONVERT_CR:
-                        sys.stdout.write('\n')
-                        self.log.write('\n')
-                    else:
-                        sys.stdout.write(repr(data)[1:-1])
-                        self.log.write(repr(data)[1:-1])
-                elif self.repr_mode == 2:
-                    # escape all non-printable, including newline
-                    sys.stdout.write(repr(data)[1:-1])
-                    self.log.write(repr(data)[1:-1])
-                elif self.repr_mode == 3:
-                    # escape everything (hexdump)
-                    for character in data:
-                        sys.stdout.write("%s " % character.encode('hex'))
-                        self.log.write("%s " % character.encode('hex'))
-                sys.stdout.flush()
-                self.log.flush()
+                if self.paused.isSet():
+                    # a file transfer owns the port
+                    self.reader_idle.set()
+                    time.sleep(0.05)
+                    continue
+                self.reader_idle.clear()
+                data = self.serial.read(self.serial.inWaiting() or 1)
+                if data:
+                    if self.recorder is not None:
+                        self.recorder.write(data)
+                    text = self.translate(data)
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                    self.log.write(text)
+                if time.time() - flushed > LOG_FLUSH_INTERVAL:
+                    self.log.flush()
+                    if self.recorder is not None:
+                        self.recorder.flush()
+                    flushed = time.time()
         except serial.SerialException, e:
             self.alive = False
             # would be nice if the console reader could be interruptted at this
             # point...
             raise
+        finally:
+            self.log.flush()
+            if self.recorder is not None:
+                self.recorder.flush()
+
 
+    def transfer(self, receive=False, ymodem=True):
+        """XMODEM-1K/YMODEM from the menu, the reader stays out meanwhile.
+           File names are asked one per line, YMODEM sends until an empty
+           one.
+        """
+        console.cleanup()
+        names = []
+        if receive:
+            sys.stderr.write('\n--- File name for XMODEM, empty for YMODEM: ')
+        else:
+            sys.stderr.write('\n--- File to send: ')
+        while True:
+            sys.stderr.flush()
+            name = sys.stdin.readline().strip()
+            if not name:
+                break
+            names.append(name)
+            if receive or not ymodem:
+                break
+            sys.stderr.write('--- Next file, empty to start: ')
+        console.setup()
+        if not receive and not names:
+            return
+        self.paused.set()
+        self.reader_idle.wait(2 * self.serial.timeout + 1)
+        # the console has ISIG off, Ctrl+C arrives as a key
+        cancelled = threading.Event()
+        done = threading.Event()
+
+        def watch():
+            while not done.isSet():
+                if select.select([console.fd], [], [], 0.1)[0] and console.getkey() == '\x03':
+                    cancelled.set()
+
+        watcher = threading.Thread(target=watch)
+        watcher.setDaemon(1)
+        watcher.start()
+        modem = Modem(self.serial, lambda msg: sys.stderr.write('\r--- %s ' % msg), cancelled)
+        try:
+            if receive:
+                sys.stderr.write('--- Waiting for the sender, %s cancels ---\n' % key_description('\x03'))
+                start = time.time()
+                received = modem.receive(".", names and names[0] or None)
+                sys.stderr.write('\n--- Received %s in %.1f s ---\n' % (", ".join(received), time.time() - start))
+            else:
+                sys.stderr.write('--- Waiting for the receiver, %s cancels ---\n' % key_description('\x03'))
+                size, seconds = modem.send(names, ymodem)
+                sys.stderr.write('\n--- Sent %i bytes in %.1f s, %.1f kB/s, %i retransmits ---\n' % (
+                    size, seconds, seconds and size / seconds / 1024, modem.retransmits))
+        except ModemCancelled:
+            sys.stderr.write('\n--- Transfer cancelled ---\n')
+        except (ModemError, IOError), e:
+            sys.stderr.write('\n--- Transfer failed: %s ---\n' % e)
+        finally:
+            done.set()
+            watcher.join()
+        self.paused.clear()
 
     def writer(self):
         """loop and copy console->serial until EXITCHARCTER character is
@@ -208,6 +339,12 @@ class Miniterm:
                             except IOError, e:
                                 sys.stderr.write('--- ERROR opening file %s: %s ---\n' % (filename, e))
                         console.setup()
+                    elif c == '\x19':                       # CTRL+Y -> YMODEM send
+                        self.transfer()
+                    elif c == '\x18':                       # CTRL+X -> XMODEM-1K send
+                        self.transfer(ymodem=False)
+                    elif c == '\x17':                       # CTRL+W -> XMODEM/YMODEM receive
+                        self.transfer(receive=True)
                     elif c in '\x08hH?':                    # CTRL+H, h, H, ? -> Show help
                         sys.stderr.write(get_help_text())
                     elif c == '\x12':                       # CTRL+R -> Toggle RTS
@@ -314,6 +451,505 @@ class Miniterm:
             self.alive = False
             raise
 
+class MultiConsole:
+    """single threaded console for several ports. Received lines are
+       prefixed with their port and the time their first byte arrived,
+       the keyboard goes to the port in focus, MENUCHARACTER followed by
+       the port number or n switches it.
+    """
+
+    COLORS = ('\x1b[32m', '\x1b[33m', '\x1b[34m', '\x1b[35m', '\x1b[36m', '\x1b[31m')
+    RESET = '\x1b[0m'
+    PARTIAL_LINE_TIMEOUT = 0.2  # seconds until a line without newline is shown
+
+    def __init__(self, ports, baudrate, convert_outgoing=CONVERT_CRLF, recorders=None):
+        self.serials = []
+        for port in ports:
+            try:
+                self.serials.append(serial.serial_for_url(port, baudrate, timeout=0))
+            except AttributeError:
+                self.serials.append(serial.Serial(port, baudrate, timeout=0))
+        self.names = [port.replace("/dev/", "", 1) for port in ports]
+        self.width = max(len(name) for name in self.names) + 2
+        self.pending = [""] * len(ports)
+        self.stamps = [None] * len(ports)
+        self.received = [0.0] * len(ports)
+        self.newline = NEWLINE_CONVERISON_MAP[convert_outgoing]
+        self.color = sys.stdout.isatty()
+        self.focus = 0
+        self.menu_active = False
+        self.log = open("miniterm.log","w")
+        self.recorders = recorders
+
+    def emit(self, i, line, stamp):
+        prefix = "%s.%06i %-*s " % (time.strftime("%H:%M:%S", time.localtime(stamp)),
+            int(stamp % 1 * 1000000), self.width, "[%s]" % self.names[i])
+        self.log.write("%s%s\n" % (prefix, line))
+        if self.color:
+            prefix = MultiConsole.COLORS[i % len(MultiConsole.COLORS)] + prefix + MultiConsole.RESET
+        sys.stdout.write("%s%s\n" % (prefix, line))
+
+    def receive(self, i, data, now):
+        lines = (self.pending[i] + data).split('\n')
+        self.pending[i] = lines.pop()
+        stamp = self.stamps[i] or now
+        for line in lines:
+            self.emit(i, line.rstrip('\r'), stamp)
+            stamp = now
+        self.stamps[i] = self.pending[i] and stamp or None
+        self.received[i] = now
+
+    def flush_partial(self, now):
+        for i, pending in enumerate(self.pending):
+            if pending and now - self.received[i] > MultiConsole.PARTIAL_LINE_TIMEOUT:
+                self.emit(i, pending.rstrip('\r'), self.stamps[i])
+                self.pending[i] = ""
+                self.stamps[i] = None
+
+    def show_focus(self):
+        sys.stderr.write("--- keyboard on %i:%s ---\n" % (self.focus + 1, self.names[self.focus]))
+
+    def key(self, c):
+        """handle one key, False once the console should quit"""
+        port = self.serials[self.focus]
+        if self.menu_active:
+            self.menu_active = False
+            if c.isdigit() and 0 < int(c) <= len(self.serials):
+                self.focus = int(c) - 1
+                self.show_focus()
+            elif c in 'nN\t':
+                self.focus = (self.focus + 1) % len(self.serials)
+                self.show_focus()
+            elif c == MENUCHARACTER or c == EXITCHARCTER:
+                port.write(c)
+            else:
+                sys.stderr.write('--- unknown menu character %s --\n' % key_description(c))
+        elif c == MENUCHARACTER:
+            self.menu_active = True
+        elif c == EXITCHARCTER:
+            return False
+        elif c == '\n':
+            port.write(self.newline)
+        else:
+            port.write(c)
+        return True
+
+    def run(self):
+        ports = dict((s.fileno(), i) for i, s in enumerate(self.serials))
+        self.show_focus()
+        flushed = time.time()
+        while True:
+            timeout = LOG_FLUSH_INTERVAL
+            if [p for p in self.pending if p]:
+                timeout = MultiConsole.PARTIAL_LINE_TIMEOUT
+            ready = select.select([console.fd] + ports.keys(), [], [], timeout)[0]
+            now = time.time()
+            for fd in ready:
+                if fd == console.fd:
+                    if not self.key(os.read(fd, 1)):
+                        self.log.close()
+                        for recorder in self.recorders or ():
+                            recorder.close()
+                        return
+                    continue
+                i = ports[fd]
+                try:
+                    data = self.serials[i].read(self.serials[i].inWaiting() or 1)
+                except serial.SerialException, e:
+                    data = None
+                if not data:
+                    sys.stderr.write("--- %s lost ---\n" % self.names[i])
+                    del ports[fd]
+                    continue
+                if self.recorders:
+                    self.recorders[i].write(data, now)
+                self.receive(i, data, now)
+            self.flush_partial(now)
+            sys.stdout.flush()
+            if now - flushed > LOG_FLUSH_INTERVAL:
+                self.log.flush()
+                for recorder in self.recorders or ():
+                    recorder.flush()
+                flushed = now
+
+class LogRecorder(object):
+    """Records raw serial data into numbered segment files. Next to each
+       segment NNNNNNNN.log a sparse index NNNNNNNN.idx holds a (time,
+       offset) entry per received chunk, at most one every INDEX_INTERVAL
+       seconds. Segments rotate at segment_size bytes, a new recorder
+       continues after the existing segments instead of overwriting them.
+    """
+
+    ENTRY = struct.Struct(">dQ")
+    INDEX_INTERVAL = 0.05
+
+    def __init__(self, path, segment_size=0x4000000):
+        make_dirs(path)
+        self.path = path
+        self.segment_size = segment_size
+        segments = log_segments(path)
+        self.segment = segments and segments[-1] + 1 or 0
+        self.open()
+
+    def open(self):
+        name = os.path.join(self.path, "%08i" % self.segment)
+        self.data = open(name + ".log", "wb")
+        self.index = open(name + ".idx", "wb")
+        self.offset = 0
+        self.indexed = None
+
+    def write(self, data, stamp=None):
+        if stamp is None:
+            stamp = time.time()
+        if self.offset and self.offset + len(data) > self.segment_size:
+            self.close()
+            self.segment += 1
+            self.open()
+        if self.indexed is None or stamp - self.indexed >= LogRecorder.INDEX_INTERVAL:
+            self.index.write(LogRecorder.ENTRY.pack(stamp, self.offset))
+            self.indexed = stamp
+        self.data.write(data)
+        self.offset += len(data)
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+def log_segments(path):
+    """numbers of the recorded segments in path, oldest first"""
+    segments = []
+    for name in glob.glob(os.path.join(path, "*.idx")):
+        try:
+            segments.append(int(os.path.basename(name)[:-4]))
+        except ValueError:
+            pass
+    return sorted(segments)
+
+
+class LogSegment(object):
+    """read side of a recorded segment, data and index are memory-mapped"""
+
+    def __init__(self, path, number):
+        name = os.path.join(path, "%08i" % number)
+        self.data = self.map(name + ".log")
+        index = self.map(name + ".idx")
+        size = LogRecorder.ENTRY.size
+        entries = [LogRecorder.ENTRY.unpack_from(index, i) for i in xrange(0, len(index) - size + 1, size)]
+        self.times = [entry[0] for entry in entries]
+        self.offsets = [entry[1] for entry in entries]
+
+    def map(self, filename):
+        fd = open(filename, "rb")
+        try:
+            if not os.fstat(fd.fileno()).st_size:
+                return ""
+            return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+    def offset_at(self, stamp):
+        """offset of the chunk that was received at stamp"""
+        return self.offsets[max(0, bisect.bisect_right(self.times, stamp) - 1)]
+
+    def stamp_at(self, offset):
+        """receive time of the chunk holding offset"""
+        return self.times[max(0, bisect.bisect_right(self.offsets, offset) - 1)]
+
+    def lines(self, start, end, pattern=None):
+        """yield (time, line) for the lines touching [start, end) bytes,
+           only those that match pattern when given
+        """
+        data = self.data
+        pos = data.rfind("\n", 0, start) + 1
+        while pos < end:
+            if pattern is not None:
+                match = pattern.search(data, pos, end)
+                if match is None:
+                    return
+                pos = max(pos, data.rfind("\n", pos, match.start()) + 1)
+            stop = data.find("\n", pos, len(data))
+            if stop < 0:
+                stop = len(data)
+            yield self.stamp_at(pos), data[pos:stop].rstrip("\r")
+            pos = stop + 1
+
+
+def query_log(path, start=None, end=None, pattern=None):
+    """yield (time, line) of all recorded lines in path received between
+       start and end that match pattern. Only the segments and byte ranges
+       the index puts into the time range are looked at.
+    """
+    segments = log_segments(path)
+    for n, number in enumerate(segments):
+        segment = LogSegment(path, number)
+        if not segment.times:
+            continue
+        if end is not None and segment.times[0] > end:
+            break
+        if start is not None and n + 1 < len(segments):
+            following = LogSegment(path, segments[n + 1]).times
+            if following and following[0] < start:
+                continue
+        lo, hi = 0, len(segment.data)
+        if start is not None:
+            lo = segment.offset_at(start)
+        if end is not None:
+            i = bisect.bisect_right(segment.times, end)
+            if i < len(segment.offsets):
+                hi = segment.offsets[i]
+        for stamp, line in segment.lines(lo, hi, pattern):
+            if (start is None or stamp >= start) and (end is None or stamp <= end):
+                yield stamp, line
+            elif end is not None and stamp > end:
+                break
+
+
+def parse_time(text):
+    """epoch seconds, 'YYYY-mm-dd HH:MM:SS[.ffffff]' or 'HH:MM:SS' of today"""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    text, _, fraction = text.partition(".")
+    fraction = fraction and float("." + fraction) or 0.0
+    if len(text) <= 8:
+        text = time.strftime("%Y-%m-%d ") + text
+    return time.mktime(time.strptime(text, "%Y-%m-%d %H:%M:%S")) + fraction
+
+def format_time(stamp):
+    return "%s.%06i" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp)), int(stamp % 1 * 1000000))
+
+class ModemError(Exception):
+    pass
+
+class ModemCancelled(ModemError):
+    pass
+
+
+class Modem(object):
+    """XMODEM-1K and YMODEM file transfer with CRC-16 over a serial port.
+       A receiver that asks with 'G' gets YMODEM-g, the blocks are then
+       streamed without waiting for every ACK. Receivers that only send
+       NAK get the classic 8 bit checksum. Setting the cancelled event
+       sends CAN CAN to the other side and ends the transfer with
+       ModemCancelled.
+    """
+
+    SOH = '\x01'
+    STX = '\x02'
+    EOT = '\x04'
+    ACK = '\x06'
+    NAK = '\x15'
+    CAN = '\x18'
+    SUB = '\x1a'
+    RETRIES = 10
+    TIMEOUT = 10.0
+    START_TIMEOUT = 60.0
+
+    def __init__(self, port, report=None, cancelled=None):
+        self.port = port
+        self.report = report or (lambda msg: None)
+        self.cancelled = cancelled or threading.Event()
+        self.retransmits = 0
+
+    def check(self):
+        if self.cancelled.isSet():
+            self.cancel()
+            raise ModemCancelled("cancelled")
+
+    def getc(self, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.check()
+            c = self.port.read(1)
+            if c:
+                return c
+        return None
+
+    def read(self, size, timeout):
+        data = ""
+        deadline = time.time() + timeout
+        while len(data) < size and time.time() < deadline:
+            self.check()
+            data += self.port.read(size - len(data))
+        return data
+
+    def cancel(self):
+        self.port.write(Modem.CAN * 8)
+
+    def checksum(self, data):
+        if self.crc:
+            return struct.pack(">H", binascii.crc_hqx(data, 0))
+        return chr(sum(bytearray(data)) & 0xff)
+
+    def wait_start(self):
+        """wait for the receiver to ask for CRC, streaming or checksum mode"""
+        while True:
+            c = self.getc(Modem.START_TIMEOUT)
+            if c is None:
+                raise ModemError("receiver did not start")
+            if c in 'CG' + Modem.NAK:
+                self.crc = c != Modem.NAK
+                self.streaming = c == 'G'
+                return
+            if c == Modem.CAN:
+                raise ModemError("cancelled by receiver")
+
+    def send_block(self, seq, data, size, pad=SUB):
+        data = data.ljust(size, pad)
+        block = "%s%c%c%s%s" % (size == 1024 and Modem.STX or Modem.SOH,
+            seq & 0xff, 0xff - (seq & 0xff), data, self.checksum(data))
+        for retry in range(Modem.RETRIES):
+            self.check()
+            self.port.write(block)
+            if self.streaming and seq:
+                return
+            c = self.getc(Modem.TIMEOUT)
+            if c == Modem.ACK:
+                return
+            if c == Modem.CAN and self.getc(1.0) == Modem.CAN:
+                raise ModemError("cancelled by receiver")
+            self.retransmits += 1
+        self.cancel()
+        raise ModemError("block %i not acknowledged" % seq)
+
+    def send_eot(self):
+        for retry in range(Modem.RETRIES):
+            self.port.write(Modem.EOT)
+            if self.getc(Modem.TIMEOUT) == Modem.ACK:
+                return
+        raise ModemError("end of file not acknowledged")
+
+    def send_data(self, data, name):
+        start = time.time()
+        sent = 0
+        seq = 1
+        while sent < len(data):
+            size = len(data) - sent > 128 and 1024 or 128
+            self.send_block(seq, data[sent:sent + size], size)
+            sent += size
+            seq += 1
+            elapsed = time.time() - start
+            self.report("%s %3i%% %7.1f kB/s" % (name, 100 * min(sent, len(data)) / len(data),
+                elapsed and sent / elapsed / 1024))
+        self.send_eot()
+        return time.time() - start
+
+    def send(self, filenames, ymodem=True):
+        """send files, more than one needs YMODEM. Returns (bytes, seconds)"""
+        total, seconds = 0, 0.0
+        for filename in filenames:
+            data = open(filename, "rb").read()
+            self.wait_start()
+            name = os.path.basename(filename)
+            if ymodem:
+                header = "%s\0%i %o" % (name, len(data), int(os.path.getmtime(filename)))
+                self.send_block(0, header, len(header) >= 128 and 1024 or 128, "\0")
+                self.wait_start()
+            seconds += self.send_data(data, name)
+            total += len(data)
+        if ymodem:
+            # an empty header ends the batch
+            self.wait_start()
+            self.send_block(0, "", 128, "\0")
+        return total, seconds
+
+    def receive_block(self, timeout=TIMEOUT):
+        """(seq, data) of the next block, None at EOT"""
+        while True:
+            c = self.getc(timeout)
+            if c is None:
+                raise ModemError("sender timed out")
+            if c == Modem.EOT:
+                return None
+            if c == Modem.CAN and self.getc(1.0) == Modem.CAN:
+                raise ModemError("cancelled by sender")
+            if c not in Modem.SOH + Modem.STX:
+                continue
+            size = c == Modem.STX and 1024 or 128
+            block = self.read(size + 4, Modem.TIMEOUT)
+            if len(block) == size + 4:
+                seq, inverse = ord(block[0]), ord(block[1])
+                data, check = block[2:size + 2], block[size + 2:]
+                if seq == 0xff - inverse and check == self.checksum(data):
+                    return seq, data
+            self.retransmits += 1
+            self.port.write(Modem.NAK)
+
+    def receive_start(self):
+        """ask for CRC mode until the sender starts"""
+        deadline = time.time() + Modem.START_TIMEOUT
+        while time.time() < deadline:
+            self.port.write('C')
+            try:
+                return self.receive_block(3.0)
+            except ModemCancelled:
+                raise
+            except ModemError:
+                pass
+        raise ModemError("sender did not start")
+
+    def receive_file(self, name, block, size):
+        out = open(name, "wb")
+        expect = 1
+        written = 0
+        start = time.time()
+        while block is not None:
+            seq, data = block
+            if seq == expect & 0xff:
+                out.write(data)
+                written += len(data)
+                expect += 1
+            elif seq != (expect - 1) & 0xff:
+                self.cancel()
+                raise ModemError("block %i out of sequence" % seq)
+            self.port.write(Modem.ACK)
+            elapsed = time.time() - start
+            self.report("%s %7i bytes %7.1f kB/s" % (os.path.basename(name), written,
+                elapsed and written / elapsed / 1024))
+            block = self.receive_block()
+        self.port.write(Modem.ACK)
+        if size is None:
+            # XMODEM pads the last block and has no length to cut it to
+            out.close()
+            data = open(name, "rb").read().rstrip(Modem.SUB)
+            out = open(name, "wb")
+            out.write(data)
+        else:
+            out.truncate(size)
+        out.close()
+
+    def receive(self, directory=".", filename=None):
+        """receive a YMODEM batch into directory, or one XMODEM file into
+           filename when the sender starts without a header block.
+           Returns the received file names.
+        """
+        self.crc = True
+        self.streaming = False
+        received = []
+        while True:
+            seq, data = self.receive_start()
+            if seq != 0:
+                if not filename:
+                    self.cancel()
+                    raise ModemError("sender uses XMODEM, need a file name")
+                self.receive_file(filename, (seq, data), None)
+                return [filename]
+            self.port.write(Modem.ACK)
+            name, _, info = data.partition("\0")
+            if not name:
+                return received
+            name = os.path.join(directory, os.path.basename(name))
+            fields = info.split("\0")[0].split()
+            size = fields and int(fields[0]) or None
+            self.receive_file(name, self.receive_start(), size)
+            received.append(name)
+
 def die(msg):
     print msg
     sys.exit(-1)
@@ -328,15 +964,503 @@ def binary(v,bits=8):
             r +="0"
     return r
 
+LZ_N = 4096                     # LZSS parameters of boot0-sd/compressor-pc.c
+LZ_F = 18
+LZ_THRESHOLD = 2
+LZ_CHAIN = 16                   # candidates tried per position
+
+def lzss_compress(data):
+    """LZSS in the format of boot0-sd/compressor-pc.c and zloader.c.
+       Matches are looked up through a hash chain on 3-byte prefixes
+       instead of Okumura's binary trees, the output decodes the same.
+    """
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    else:
+        data = bytes(data)
+    size = len(data)
+    out = bytearray()
+    chains = {}
+    pos = 0
+    while pos < size:
+        flags = len(out)
+        out.append(0)
+        for bit in range(8):
+            if pos >= size:
+                break
+            best_len = 0
+            best_pos = 0
+            limit = min(LZ_F, size - pos)
+            for cand in reversed(chains.get(data[pos:pos + 3], ())[-LZ_CHAIN:]):
+                if pos - cand > LZ_N - LZ_F:
+                    break
+                length = 3
+                while length < limit and data[cand + length] == data[pos + length]:
+                    length += 1
+                if length > best_len:
+                    best_len = length
+                    best_pos = cand
+                    if length == limit:
+                        break
+            if best_len > LZ_THRESHOLD:
+                ring = (LZ_N - LZ_F + best_pos) & (LZ_N - 1)
+                out.append(ring & 0xff)
+                out.append(((ring >> 4) & 0xf0) | (best_len - (LZ_THRESHOLD + 1)))
+                step = best_len
+            else:
+                out[flags] |= 1 << bit
+                out.append(data[pos])
+                step = 1
+            for p in range(pos, pos + step):
+                chain = chains.setdefault(data[p:p + 3], [])
+                chain.append(p)
+                # only the newest LZ_CHAIN are tried, trim in batches
+                if len(chain) >= 2 * LZ_CHAIN:
+                    del chain[:-LZ_CHAIN]
+            pos += step
+    return out
+
+def lzss_zeros(size):
+    """what lzss_compress() makes of size zero bytes, built directly: one
+       literal zero, then full length matches of the byte before
+    """
+    out = bytearray()
+    pos = 0
+    while pos < size:
+        flags = len(out)
+        out.append(0)
+        for bit in range(8):
+            if pos >= size:
+                break
+            step = min(LZ_F, size - pos)
+            if pos and step > LZ_THRESHOLD:
+                ring = (LZ_N - LZ_F + pos - 1) & (LZ_N - 1)
+                out.append(ring & 0xff)
+                out.append(((ring >> 4) & 0xf0) | (step - (LZ_THRESHOLD + 1)))
+            else:
+                out[flags] |= 1 << bit
+                out.append(0)
+                step = 1
+            pos += step
+    return out
+
+
+class SerialTransport(object):
+    """Wire layer below LM32Serial. Small commands are staged as packed
+       header plus payload in one bounded scratch buffer and leave the
+       host with a single write; larger payloads are written as they are,
+       right after their header, without a copy of our own.
+    """
+
+    SCRATCH = 0x100
+
+    def __init__(self, io):
+        self.io = io
+        self.buf = bytearray(SerialTransport.SCRATCH)
+        self.sent = 0
+
+    def send(self, header, payload=None):
+        size = len(header)
+        if payload is None:
+            self.sent += size
+            self.io.write(header)
+            return
+        total = size + len(payload)
+        self.sent += total
+        if total > len(self.buf):
+            self.io.write(header)
+            self.io.write(payload)
+            return
+        self.buf[:size] = header
+        self.buf[size:total] = payload
+        self.io.write(memoryview(self.buf)[:total])
+
+
+class PacketLink(object):
+    """Packet mode of the bootloader: every request and reply is a frame
+
+         0xa5 type seq addr[4] len[4] hcrc[4] [data[len] dcrc[4]]
+
+       with CRC32s over the header and the data. Up to window requests are
+       in flight; the bootloader answers each with 'a' or, for damaged
+       data, 'n'. Only NAKed requests and those without an answer in time
+       are sent again. Uploads and downloads that fail repeatedly are
+       split and later ones use the smaller size, so a noisy line still
+       makes progress; max_size grows back after GROW clean replies.
+    """
+
+    SOF = '\xa5'
+    HEADER = struct.Struct(">cBII")
+    FRAME = 1 + HEADER.size + 4
+    HELLO_TIMEOUT = 0.5
+    TIMEOUT = 0.3
+    RETRIES = 8
+    SPLIT = 2
+    MIN_SIZE = 64
+    GROW = 16
+    # the bootloader answers repeated 'q' that long before it parses commands
+    LINGER = 0.5
+
+    def __init__(self, lm32, window, max_size):
+        self.lm32 = lm32
+        self.window = window
+        self.max_size = max_size
+        self.limit = max_size
+        self.clean = 0
+        self.rx = bytearray()
+        self.seq = 0
+        self.retransmits = 0
+        self.splits = 0
+
+    def frame(self, kind, seq, addr, size, data=None):
+        header = PacketLink.HEADER.pack(kind, seq, addr, size)
+        frame = bytearray(PacketLink.SOF + header + LM32Serial.UINT32.pack(crc32(header)))
+        if data is not None:
+            frame += data
+            frame += LM32Serial.UINT32.pack(crc32(data))
+        return frame
+
+    def parse(self):
+        """next frame in rx as (type, seq, addr, len, data), None if incomplete.
+           Damaged data turns the frame into a NAK of its seq.
+        """
+        rx = self.rx
+        while True:
+            start = rx.find(PacketLink.SOF)
+            if start < 0:
+                del rx[:]
+                return None
+            del rx[:start]
+            if len(rx) < PacketLink.FRAME:
+                return None
+            header = str(rx[1:PacketLink.FRAME - 4])
+            if crc32(header) != LM32Serial.UINT32.unpack(str(rx[PacketLink.FRAME - 4:PacketLink.FRAME]))[0]:
+                del rx[:1]
+                continue
+            kind, seq, addr, size = PacketLink.HEADER.unpack(header)
+            if kind != 'a' or not size:
+                del rx[:PacketLink.FRAME]
+                return kind, seq, addr, size, None
+            end = PacketLink.FRAME + size + 4
+            if len(rx) < end:
+                return None
+            data = rx[PacketLink.FRAME:end - 4]
+            crc = LM32Serial.UINT32.unpack(str(rx[end - 4:end]))[0]
+            del rx[:end]
+            if crc32(buffer(data)) != crc:
+                return 'n', seq, addr, size, None
+            return kind, seq, addr, size, data
+
+    def receive(self):
+        """next frame from the port, None when nothing arrived for a while"""
+        io = self.lm32.io
+        while True:
+            frame = self.parse()
+            if frame is not None:
+                return frame
+            data = io.read(io.inWaiting() or 1)
+            if not data:
+                return None
+            self.lm32.received += len(data)
+            self.rx += data
+
+    def hello(self):
+        """window and data size the bootloader announces on 'p'"""
+        deadline = time.time() + PacketLink.HELLO_TIMEOUT
+        while time.time() < deadline:
+            frame = self.receive()
+            if frame is not None and frame[0] == 'p':
+                return frame[2], frame[3]
+        return None
+
+    def transfer(self, requests):
+        """run [(type, addr, len, data)] and return the data of the replies"""
+        count = len(requests)
+        requests = list(requests)
+        results = [None] * count
+        # request -> the two halves it was split into
+        halves = {}
+        queue = range(count)
+        # seq -> [request, frame, reply size, wire time, tries, deadline]
+        pending = {}
+        line = 10.0 / self.lm32.io.baudrate
+
+        def retry(seq):
+            i = pending[seq][0]
+            kind, addr, size, data = requests[i]
+            if pending[seq][4] < PacketLink.SPLIT or kind not in "ud" or size < 2 * PacketLink.MIN_SIZE:
+                self.send(pending, seq)
+                return
+            del pending[seq]
+            half = size / 2
+            halves[i] = (len(requests), len(requests) + 1)
+            requests.append((kind, addr, half, data and data[:half]))
+            requests.append((kind, addr + half, size - half, data and data[half:]))
+            results.extend((None, None))
+            queue[:0] = halves[i]
+            self.max_size = max(PacketLink.MIN_SIZE, min(self.max_size, half))
+            self.clean = 0
+            self.splits += 1
+
+        while queue or pending:
+            while queue and len(pending) < self.window:
+                i = queue.pop(0)
+                kind, addr, size, data = requests[i]
+                answer = {'d': size, 'c': 4}.get(kind, 0)
+                frame = self.frame(kind, self.seq, addr, size, data)
+                # wire time of request and reply, plus the on-target checksum
+                cost = (len(frame) + PacketLink.FRAME + answer + 4) * line
+                if kind == 'c':
+                    cost += size / LM32Serial.CRC_RATE
+                pending[self.seq] = [i, frame, answer, cost, 0, 0]
+                self.send(pending, self.seq)
+                self.seq = (self.seq + 1) & 0xff
+
+            frame = self.receive()
+            if frame is not None:
+                kind, seq, addr, size, data = frame
+                entry = pending.get(seq)
+                if entry is not None and requests[entry[0]][1] == addr:
+                    if kind == 'a' and len(data or "") == entry[2]:
+                        results[entry[0]] = data
+                        del pending[seq]
+                        self.grow(entry[4])
+                    else:
+                        retry(seq)
+
+            now = time.time()
+            for seq, entry in pending.items():
+                if entry[5] < now:
+                    retry(seq)
+
+        def result(i):
+            if i not in halves:
+                return results[i]
+            first, second = [result(j) for j in halves[i]]
+            return first is not None and first + second or None
+        return [result(i) for i in range(count)]
+
+    def grow(self, tries):
+        if tries > 1:
+            self.clean = 0
+            return
+        self.clean += 1
+        if self.clean >= PacketLink.GROW and self.max_size < self.limit:
+            self.max_size = min(self.limit, 2 * self.max_size)
+            self.clean = 0
+
+    def send(self, pending, seq):
+        """(re)send a pending request, it queues up behind all in flight"""
+        entry = pending[seq]
+        if entry[4] == PacketLink.RETRIES:
+            raise serial.SerialTimeoutException("Packet %i failed after %i tries" % (seq, entry[4]))
+        if entry[4]:
+            self.retransmits += 1
+        entry[4] += 1
+        entry[5] = time.time() + PacketLink.TIMEOUT + sum(e[3] for e in pending.values())
+        self.lm32.wire.send(entry[1])
+
+    def upload(self, addr, data):
+        view = memoryview(data)
+        requests = []
+        for offset in range(0, len(view), self.max_size):
+            block = view[offset:offset + self.max_size]
+            requests.append(('u', addr + offset, len(block), block))
+        self.transfer(requests)
+
+    def download(self, addr, size, out):
+        requests = [('d', addr + offset, min(self.max_size, size - offset), None)
+            for offset in range(0, size, self.max_size)]
+        offset = 0
+        for data in self.transfer(requests):
+            out[offset:offset + len(data)] = data
+            offset += len(data)
+
+    def checksum(self, addr, size):
+        return LM32Serial.UINT32.unpack(str(self.transfer([('c', addr, size, None)])[0]))[0]
+
+    def leave(self):
+        self.transfer([('q', 0, 0, None)])
+        time.sleep(PacketLink.LINGER)
+        self.lm32.io.flushInput()
+
+
+class ProtocolProfile(object):
+    """Timeline of LM32Serial commands with their latency, wire bytes and
+       outcome. Boards are instrumented by wrapping the methods of each
+       instance, so nothing is paid for when profiling is off.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.ports = {}
+
+    def add(self, name, port, start, end, sent=0, received=0, ok=True):
+        self.events.append({
+            "name": name,
+            "port": port,
+            "start": start - self.start,
+            "duration": end - start,
+            "sent": sent,
+            "received": received,
+            "ok": ok,
+        })
+
+    def attach(self, lm32, opened):
+        """record the port open that began at opened and wrap lm32"""
+        port = lm32.io.portstr
+        self.add("open", port, opened, time.time())
+        for name in lm32.PROFILED:
+            setattr(lm32, name, self.wrap(lm32, port, name, getattr(lm32, name)))
+
+    def wrap(self, lm32, port, name, method):
+        def call(*args, **kw):
+            sent, received = lm32.wire.sent, lm32.received
+            start = time.time()
+            ok = False
+            try:
+                result = method(*args, **kw)
+                ok = result is not False
+                return result
+            finally:
+                self.add(name, port, start, time.time(),
+                    lm32.wire.sent - sent, lm32.received - received, ok)
+        return call
+
+    @contextlib.contextmanager
+    def phase(self, name, port=""):
+        """time host side work like parsing in the same timeline"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, port, start, time.time())
+
+    def summary(self):
+        """per command totals; failed calls are the retries of pings and
+           baud rate switches
+        """
+        summary = {}
+        for event in self.events:
+            s = summary.setdefault(event["name"], {"calls": 0, "failed": 0,
+                "seconds": 0.0, "max": 0.0, "sent": 0, "received": 0})
+            s["calls"] += 1
+            s["failed"] += not event["ok"]
+            s["seconds"] += event["duration"]
+            s["max"] = max(s["max"], event["duration"])
+            s["sent"] += event["sent"]
+            s["received"] += event["received"]
+        for s in summary.values():
+            s["rate"] = s["seconds"] and (s["sent"] + s["received"]) / s["seconds"]
+        return summary
+
+    def report(self):
+        print "%-18s %6s %6s %9s %9s %9s %10s %10s %10s" % ("command", "calls", "failed",
+            "total s", "mean ms", "max ms", "sent", "received", "kB/s")
+        summary = self.summary()
+        for name in sorted(summary, key=lambda n: -summary[n]["seconds"]):
+            s = summary[name]
+            print "%-18s %6i %6i %9.3f %9.3f %9.3f %10i %10i %10.1f" % (name, s["calls"], s["failed"],
+                s["seconds"], 1000 * s["seconds"] / s["calls"], 1000 * s["max"],
+                s["sent"], s["received"], s["rate"] / 1024)
+
+    def save_json(self, filename):
+        fd = open(filename, "w")
+        json.dump({"summary": self.summary(), "events": self.events}, fd, indent=1)
+        fd.close()
+
+    def save_trace(self, filename):
+        """Chrome trace event format, loads in chrome://tracing and Perfetto"""
+        pid = os.getpid()
+        tids = {}
+        trace = []
+        for event in self.events:
+            if event["port"] not in tids:
+                tids[event["port"]] = len(tids)
+                trace.append({"name": "thread_name", "ph": "M", "pid": pid,
+                    "tid": tids[event["port"]], "args": {"name": event["port"] or "host"}})
+            trace.append({
+                "name": event["name"],
+                "cat": "lm32",
+                "ph": "X",
+                "pid": pid,
+                "tid": tids[event["port"]],
+                "ts": int(event["start"] * 1e6),
+                "dur": int(event["duration"] * 1e6),
+                "args": {"sent": event["sent"], "received": event["received"], "ok": event["ok"]},
+            })
+        fd = open(filename, "w")
+        json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, fd)
+        fd.close()
+
+profile = None                  # ProtocolProfile while --profile is active
+
+@contextlib.contextmanager
+def profiled(name, port=""):
+    if profile is None:
+        yield
+    else:
+        with profile.phase(name, port):
+            yield
+
+
+class BootloaderNotFound(Exception):
+    pass
+
+
+FCPU = 50000000                 # system clock of the boards, see soc-hw.h
+BAUD_TOLERANCE = 0.02
+
+def baud_error(baud, fcpu=FCPU):
+    """relative error of baud on the bootloader UART, whose divisor is
+       fcpu/baud/16 truncated like in set_baudrate() of boot0-serial
+    """
+    div = fcpu // (16 * baud)
+    if not div:
+        return 1.0
+    return abs(fcpu / (16.0 * div) - baud) / baud
+
+
 class LM32Serial(object):
 
     BOOT_SIG = "**soc-lm32/bootloader**"
+    CMD_ADDR = struct.Struct(">cI")
+    CMD_BLOCK = struct.Struct(">cII")
+    UINT32 = struct.Struct(">I")
+    READ_TIMEOUT = 0.1
+    READ_SLACK = 1.0
+    CRC_RATE = 500000.0         # bytes/s the bootloader checksums at
+    # common rates and the ones FCPU divides exactly, the UART is too far
+    # off for most common rates
+    BAUD_RATES = tuple(baud for baud in (3125000, 3000000, 2000000, 1562500, 1500000, 1000000,
+        921600, 781250, 500000, 460800, 390625, 230400) if baud_error(baud) < BAUD_TOLERANCE)
+    BAUD_PROBE = bytearray((i * 0x1d + 0x55) & 0xff for i in range(64))
+    BAUD_SETTLE = 0.3           # bootloader gives up on a failed switch by then
+    DRAIN_CHARS = 16            # character times of silence that end a drain
+    DRAIN_MIN = 0.05            # USB adapters deliver in bursts of a few ms
+    PROFILED = ("find_bootloader", "ping", "set_baudrate", "upload", "upload_compressed",
+        "upload_chunked", "zero_fill", "download", "download_chunked", "checksum", "jump", "packet_mode")
 
     def __init__(self, dev, speed):
-        self.io = serial.Serial(dev, speed)
+        opened = time.time()
+        try:
+            self.io = serial.serial_for_url(dev, speed, timeout=LM32Serial.READ_TIMEOUT)
+        except AttributeError:
+            # pyserial older than 2.5 only knows device names
+            self.io = serial.Serial(dev, speed, timeout=LM32Serial.READ_TIMEOUT)
+        self.wire = SerialTransport(self.io)
+        self.base_baud = speed
+        self.received = 0
         self.debug = False
+        self.packets = None
+        if profile is not None:
+            profile.attach(self, opened)
 
     def close(self):
+        self.leave_packet_mode()
+        if self.io.baudrate != self.base_baud:
+            self.set_baudrate(self.base_baud)
         self.io.close()
 
     def progress(self):
@@ -348,139 +1472,658 @@ class LM32Serial(object):
         sys.stdout.flush()
     
     def put_uint32(self,i):
-        self.io.write( chr((i >> 24) & 0xff ))
-        self.io.write( chr((i >> 16) & 0xff ))
-        self.io.write( chr((i >>  8) & 0xff ))
-        self.io.write( chr((i >>  0) & 0xff ))
+        self.wire.send(LM32Serial.UINT32.pack(i & 0xffffffff))
 
     def put_uint8(self,i):
-        self.io.write( chr((i) & 0xff ))
+        self.wire.send(chr(i & 0xff))
    
     def get_uint8(self):
-        return ord(self.io.read(1))
+        byte = bytearray(1)
+        self.read_into(memoryview(byte))
+        return byte[0]
 
 
     def upload(self, addr, data):
         if self.debug:
             self.info("upload 0x%08x (%i)\n" % (addr,len(data)))
-        self.io.write('u')
-        self.put_uint32(addr)
-        self.put_uint32(len(data))
-        for v in data:
-            self.io.write(v)
+        if self.packets:
+            self.packets.upload(addr, data)
+            return
+        self.wire.send(LM32Serial.CMD_BLOCK.pack('u', addr, len(data)), data)
+
+    def upload_compressed(self, addr, data):
+        """LZSS compressed upload, the bootloader unpacks while receiving.
+           Falls back to a plain upload when compression does not pay off
+           and in packet mode.
+        """
+        packed = not self.packets and lzss_compress(data)
+        if not packed or len(packed) >= len(data):
+            self.upload(addr, data)
+            return len(data)
+        if self.debug:
+            self.info("upload_compressed 0x%08x (%i -> %i)\n" % (addr,len(data),len(packed)))
+        self.wire.send(LM32Serial.CMD_BLOCK.pack('z', addr, len(packed)), packed)
+        return len(packed)
+
+    def zero_fill(self, addr, size):
+        """clear [addr, addr+size) on the target, as an LZSS stream of
+           zeros where that is shorter. Returns the bytes sent.
+        """
+        packed = not self.packets and lzss_zeros(size)
+        if not packed or len(packed) >= size:
+            self.upload(addr, bytearray(size))
+            return size
+        if self.debug:
+            self.info("zero_fill 0x%08x (%i -> %i)\n" % (addr,size,len(packed)))
+        self.wire.send(LM32Serial.CMD_BLOCK.pack('z', addr, len(packed)), packed)
+        return len(packed)
 
     def upload_chunked(self, data, addr, size, block_size):
         self.info("Uploading 0x%X (%i kb) to 0x%X..." % (size, size/1024, addr))
-        for i in range((size / block_size)):
+        view = memoryview(data)
+        for offset in range(0, size, block_size):
             self.progress()
-            offset = i * block_size
-            block = data[ offset : (offset + block_size) ]
-            self.upload( addr + i * block_size, block )
+            self.upload( addr + offset, view[ offset : (offset + block_size) ] )
         self.info("Done.\n")
 
-    def download(self, addr, size):
+    def read_into(self, view, wait=0.0):
+        """fill view from the port; the deadline scales with the line rate,
+           wait adds the time the target needs before it starts to answer
+        """
+        size = len(view)
+        deadline = time.time() + wait + LM32Serial.READ_SLACK + size * 10.0 / self.io.baudrate
+        pos = 0
+        while pos < size:
+            n = self.io.readinto(view[pos:])
+            pos += n
+            if not n and time.time() > deadline:
+                raise serial.SerialTimeoutException("Short read: %i of %i bytes" % (pos, size))
+        self.received += size
+        return size
+
+    def download(self, addr, size, out=None):
         if self.debug:
             self.info("download 0x%08x (%i)\n" % (addr,size))
-        r = []
-        self.io.write('d')
-        self.put_uint32(addr)
-        self.put_uint32(size)
-        for i in range(size):
-            r.append(self.io.read(1))
-        return r
+        if out is None:
+            out = bytearray(size)
+        if self.packets:
+            self.packets.download(addr, size, out)
+            return out
+        self.wire.send(LM32Serial.CMD_BLOCK.pack('d', addr, size))
+        try:
+            self.read_into(memoryview(out)[:size])
+        except serial.SerialTimeoutException:
+            if not self.fall_back():
+                raise
+            return self.download(addr, size, out)
+        return out
     
-    def download_chunked(self, addr, size, block_size):
+    def download_chunked(self, addr, size, block_size, out=None):
+        """read [addr, addr+size) block by block. Without out the data is
+           returned in one preallocated bytearray, otherwise every block is
+           written to out (a file or an mmap) as soon as it arrived.
+        """
         self.info("Download 0x%X (%i kb) from 0x%X..." % (size, size/1024, addr))
-        data = []
-        for i in range((size / block_size)):
-            self.progress()
-            data += self.download( addr + i*block_size, block_size )
+        if out is None:
+            data = bytearray(size)
+            view = memoryview(data)
+            for offset in range(0, size, block_size):
+                self.progress()
+                n = min(block_size, size - offset)
+                self.download( addr + offset, n, view[offset:offset + n] )
+        else:
+            data = out
+            block = bytearray(block_size)
+            for offset in range(0, size, block_size):
+                self.progress()
+                n = min(block_size, size - offset)
+                if n < block_size:
+                    block = bytearray(n)
+                self.download( addr + offset, n, block )
+                out.write(buffer(block))
         self.info("Done.\n")
         return data
 
+    def checksum(self, addr, size):
+        """CRC32 of [addr, addr+size) computed by the bootloader"""
+        if self.debug:
+            self.info("checksum 0x%08x (%i)\n" % (addr,size))
+        if self.packets:
+            return self.packets.checksum(addr, size)
+        self.wire.send(LM32Serial.CMD_BLOCK.pack('c', addr, size))
+        crc = bytearray(4)
+        try:
+            self.read_into(memoryview(crc), size / LM32Serial.CRC_RATE)
+        except serial.SerialTimeoutException:
+            if not self.fall_back():
+                raise
+            return self.checksum(addr, size)
+        return LM32Serial.UINT32.unpack(str(crc))[0]
+
     def jump(self,addr):
+        self.leave_packet_mode()
+        if self.io.baudrate != self.base_baud:
+            self.set_baudrate(self.base_baud)
         self.info("Jump to 0x%X...\n" % (addr))
-        self.io.write('g')
-        self.put_uint32(addr)
+        self.wire.send(LM32Serial.CMD_ADDR.pack('g', addr))
+
+    def ping(self):
+        self.wire.send('\r')
+        line = self.io.readline()
+        self.received += len(line)
+        return bool(line) and LM32Serial.BOOT_SIG in line
+
+    def resync(self, baud):
+        """fall back to baud after a failed switch and wait for the bootloader"""
+        self.io.baudrate = baud
+        time.sleep(LM32Serial.BAUD_SETTLE)
+        self.io.flushInput()
+        return self.ping()
+
+    def drain(self):
+        """drop input until the line has been quiet for DRAIN_CHARS
+           character times, the bootloader may still be sending
+        """
+        quiet = max(LM32Serial.DRAIN_CHARS * 10.0 / self.io.baudrate, LM32Serial.DRAIN_MIN)
+        last = time.time()
+        while time.time() - last < quiet:
+            waiting = self.io.inWaiting()
+            if waiting:
+                self.io.read(waiting)
+                last = time.time()
+            else:
+                time.sleep(quiet / 4)
+
+    def set_baudrate(self, baud):
+        """switch bootloader and host to baud. The bootloader echoes a probe
+           at the new rate and keeps it only when the host confirms the
+           echo, otherwise both sides stay at the old rate.
+        """
+        old = self.io.baudrate
+        if self.debug:
+            self.info("baudrate %i -> %i\n" % (old, baud))
+        self.wire.send(LM32Serial.CMD_ADDR.pack('b', baud))
+        ack = bytearray(1)
+        echo = bytearray(len(LM32Serial.BAUD_PROBE))
+        try:
+            self.read_into(memoryview(ack))
+            if ack != 'b':
+                self.resync(old)
+                return False
+            try:
+                self.io.baudrate = baud
+            except (ValueError, serial.SerialException):
+                # the host UART can't do it, the bootloader times out
+                self.resync(old)
+                return False
+            self.wire.send(LM32Serial.BAUD_PROBE)
+            self.read_into(memoryview(echo))
+        except serial.SerialTimeoutException:
+            pass
+        if echo != LM32Serial.BAUD_PROBE:
+            self.resync(old)
+            return False
+        self.wire.send('K')
+        if self.ping():
+            return True
+        self.resync(old)
+        return False
+
+    def negotiate_baudrate(self, max_baud):
+        """step up to the fastest rate up to max_baud that passes the probe"""
+        self.info("Negotiating baudrate...")
+        for baud in LM32Serial.BAUD_RATES:
+            if baud > max_baud or baud <= self.io.baudrate:
+                continue
+            self.info(" %i" % baud)
+            if self.set_baudrate(baud):
+                break
+        self.info(" using %i baud.\n" % self.io.baudrate)
+        return self.io.baudrate
+
+    def fall_back(self):
+        """after a transfer failed at a negotiated rate, switch to the next
+           lower rate that passes the probe. False at the base rate.
+        """
+        failed = self.io.baudrate
+        if failed <= self.base_baud or self.packets:
+            return False
+        self.info("\nTransfer failed at %i baud, falling back..." % failed)
+        # the bootloader may still be answering the failed command
+        self.drain()
+        self.ping()
+        for baud in LM32Serial.BAUD_RATES + (self.base_baud,):
+            if self.base_baud <= baud < failed and self.set_baudrate(baud):
+                self.info(" using %i baud.\n" % baud)
+                return True
+        self.info(" failed.\n")
+        return False
         
-    def find_bootloader(self, max_tries = 32):
+    def packet_mode(self):
+        """switch to the framed protocol, False for bootloaders without it"""
+        self.wire.send('p')
+        link = PacketLink(self, 0, 0)
+        hello = link.hello()
+        if hello is None:
+            self.io.flushInput()
+            return False
+        link.window, link.max_size = hello
+        link.limit = link.max_size
+        self.packets = link
+        return True
+
+    def leave_packet_mode(self):
+        if not self.packets:
+            return
+        link, self.packets = self.packets, None
+        link.leave()
+        if link.retransmits:
+            self.info("%i packets sent again.\n" % link.retransmits)
+        if link.splits:
+            self.info("%i packets split on a noisy line.\n" % link.splits)
+
+    def find_bootloader(self, max_tries = 32, max_baud = 0, packets = False):
         self.info("Looking for soc-lm32 bootloader")
         count = 0
         while True:
             self.progress()
             count = count + 1
             if count == max_tries:
-                die("Bootloader %s not not found" % LM32Serial.BOOT_SIG)
-            self.io.write('\r')
-            line = self.io.readline()
-            if line and LM32Serial.BOOT_SIG in line:
+                raise BootloaderNotFound("Bootloader %s not found" % LM32Serial.BOOT_SIG)
+            if self.ping():
                 self.info("found.\n")
                 break
+        if max_baud > self.io.baudrate:
+            self.negotiate_baudrate(max_baud)
+        if packets and not self.packet_mode():
+            self.info("No packet mode, using the plain protocol.\n")
+
 
 import hashlib
 import random 
 import os
 
+@contextlib.contextmanager
+def batch_file(suffix, lines):
+    """temporary file holding lines, removed again afterwards"""
+    fd, filename = tempfile.mkstemp(prefix="lm32_", suffix=suffix)
+    try:
+        os.write(fd, "".join(line + "\n" for line in lines))
+        os.close(fd)
+        yield filename
+    finally:
+        os.unlink(filename)
+
+class ToolError(Exception):
+    """an external tool failed, output holds what it printed"""
+
+    def __init__(self, msg, output=""):
+        Exception.__init__(self, msg)
+        self.output = output
+
+
+def run_tool(name, args, timeout):
+    """run an external tool and return its output, stdout and stderr
+       combined. The tool and its children are killed after timeout
+       seconds. Raises ToolError when it can't run, fails or times out.
+    """
+    with open(os.devnull) as null:
+        try:
+            proc = subprocess.Popen(args, stdin=null, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, close_fds=True, preexec_fn=os.setsid)
+        except OSError, e:
+            raise ToolError("Can't run %s: %s" % (args[0], e))
+    expired = []
+
+    def kill():
+        expired.append(True)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output = proc.communicate()[0]
+    finally:
+        timer.cancel()
+    if expired:
+        raise ToolError("%s did not finish within %is" % (name, timeout), output)
+    if proc.returncode:
+        raise ToolError("%s failed with exit code %i" % (name, proc.returncode), output)
+    return output
+
+
 class UrjtagUploader(object):
+    """Program a bitstream through urjtag. impact turns the bitstream into
+       an SVF for the chain, the SVFs are kept under ~/.lm32client/svf by
+       a hash of chain and bitstream, so impact only runs for new ones.
+    """
     
     PATH_ISE = "/opt/Xilinx/11.1/ISE" 
     PATH_JTAG = "/usr/local/bin"
-
-    def __init__(self,bitstream):
-        s = hashlib.md5(str(random.randint(0,10000000))).hexdigest()
-        self.file_jtag = os.path.join("/tmp","lm32_%s.jtag" % s)
-        self.file_impact = os.path.join("/tmp","lm32_%s.impact" % s)
-        self.bin_impact = os.path.join(UrjtagUploader.PATH_ISE,"bin","lin","impact")
-        self.bin_jtag = os.path.join(UrjtagUploader.PATH_JTAG,"jtag")
-        self.file_bitstream = bitstream
-        self.file_svf = bitstream.split(".")[0] + ".svf"
+    PATH_SVF = os.path.expanduser("~/.lm32client/svf")
+    TIMEOUT = 300
+
+    def __init__(self, bitstream, bin_impact="impact", bin_jtag="jtag", timeout=TIMEOUT):
+        self.bin_impact = bin_impact
+        self.bin_jtag = bin_jtag
+        self.timeout = timeout
+        self.file_bitstream = os.path.abspath(bitstream)
+        # devices in front of the FPGA, which comes last
+        self.chain = ["addDevice -p 1 -file %s/xcf/data/xcf04s.bsd" % UrjtagUploader.PATH_ISE]
+        key = hashlib.sha1("\n".join(self.chain))
+        fd = open(bitstream, "rb")
+        for chunk in iter(lambda: fd.read(0x10000), ""):
+            key.update(chunk)
+        fd.close()
+        self.file_svf = os.path.join(UrjtagUploader.PATH_SVF, key.hexdigest() + ".svf")
     
     def makeSVF(self):
-    	print "Generating SVF file..."
-        fd = open(self.file_impact,"w")
-        fd.write("setmode -bs\n")
-        fd.write("setCable -port svf -file %s\n" % self.file_svf)
-        fd.write("addDevice -p 1 -file %s/xcf/data/xcf04s.bsd\n" % UrjtagUploader.PATH_ISE)
-        fd.write("addDevice -p 2 -file %s\n" % self.file_bitstream)
-        fd.write("program -p 2\n")
-        fd.write("closeCable\n")
-        fd.write("quit\n")
-        fd.close()
-        if not os.path.isfile(self.file_impact):
-            die("Failed to create impact batch file")
-        os.system("impact -batch %s 2>/dev/null >/dev/null" % self.file_impact)
-        os.unlink(self.file_impact)
-        if not os.path.isfile(self.file_svf):
-            die("Failed to create svf file")
+        if os.path.isfile(self.file_svf):
+            print "Using cached SVF file %s" % self.file_svf
+            return
+        print "Generating SVF file..."
+        make_dirs(UrjtagUploader.PATH_SVF)
+        file_tmp = self.file_svf + ".tmp"
+        lines = ["setmode -bs", "setCable -port svf -file %s" % file_tmp]
+        lines += self.chain
+        fpga = len(self.chain) + 1
+        lines += ["addDevice -p %i -file %s" % (fpga, self.file_bitstream), "program -p %i" % fpga]
+        lines += ["closeCable", "quit"]
+        with batch_file(".impact", lines) as file_impact:
+            output = run_tool("impact", [self.bin_impact, "-batch", file_impact], self.timeout)
+        if not os.path.isfile(file_tmp):
+            raise ToolError("Failed to create svf file", output)
+        os.rename(file_tmp, self.file_svf)
 
     def uploadSVF(self):
-    	print "Upload SVF file..."
-        fd = open(self.file_jtag,"w")
-        fd.write("bsdl path %s/spartan3e/data;%s/xcf/data\n" % (UrjtagUploader.PATH_ISE, UrjtagUploader.PATH_ISE))
-        fd.write("cable USB-TO-JTAG-IF\n")
-        fd.write("frequency 1000000\n")
-        fd.write("detect\n")
-        fd.write("part 1\n")
-        fd.write("print chain\n")
-        fd.write("svf %s\n" % self.file_svf)
-        fd.write("quit\n")
-        fd.close()
-        if not os.path.isfile(self.file_jtag):
-            die("Failed to create jtag batch file")
-        os.system("jtag %s" % self.file_jtag)
-        os.unlink(self.file_jtag)
+        print "Upload SVF file..."
+        lines = [
+            "bsdl path %s/spartan3e/data;%s/xcf/data" % (UrjtagUploader.PATH_ISE, UrjtagUploader.PATH_ISE),
+            "cable USB-TO-JTAG-IF",
+            "frequency 1000000",
+            "detect",
+            "part 1",
+            "print chain",
+            "svf %s" % self.file_svf,
+            "quit",
+        ]
+        with batch_file(".jtag", lines) as file_jtag:
+            sys.stdout.write(run_tool("jtag", [self.bin_jtag, file_jtag], self.timeout))
 
 
 def bitstream(options):
-    if not os.path.file(options.filename_bitstream):
+    if not os.path.isfile(options.filename_bitstream):
         die("Can't find file %s" % options.filename_bitstream)
     
-    urjtag = UrjtagUploader(options.filename_bitstream)
-    urjtag.makeSVF()
-    urjtag.uploadSVF()
+    urjtag = UrjtagUploader(options.filename_bitstream, options.bin_impact,
+        options.bin_jtag, options.tool_timeout)
+    try:
+        urjtag.makeSVF()
+        urjtag.uploadSVF()
+    except ToolError, e:
+        sys.stdout.write(e.output)
+        die(str(e))
+
+def _repeat(period, base, size):
+    """tile period over [base, base+size), aligned to absolute addresses"""
+    offset = base % len(period)
+    count = (offset + size) / len(period) + 1
+    return bytearray(period * count)[offset:offset + size]
+
+def _words(values):
+    """pack 32-bit words big-endian, like the LM32 sees them"""
+    words = array.array('I', values)
+    if sys.byteorder == 'little':
+        words.byteswap()
+    return words.tostring()
+
+def pattern_random(base, size, seed=None):
+    return bytearray(os.urandom(size))
+
+def pattern_prng(base, size, seed=None):
+    # the chunk address is part of the seed, so every block is reproducible
+    if not size:
+        return bytearray()
+    rng = random.Random(((seed or 0) << 32) | base)
+    return bytearray(binascii.unhexlify("%0*x" % (size * 2, rng.getrandbits(size * 8))))
+
+def pattern_walking_ones(base, size, seed=None):
+    return _repeat(_words([1 << i for i in range(32)]), base, size)
+
+def pattern_walking_zeros(base, size, seed=None):
+    return _repeat(_words([~(1 << i) & 0xffffffff for i in range(32)]), base, size)
+
+def pattern_checkerboard(base, size, seed=None):
+    return _repeat(_words([0xaaaaaaaa, 0x55555555]), base, size)
+
+def pattern_address(base, size, seed=None):
+    # every word holds its own address, see TEST_PATTERN in boot0-serial
+    start = base & ~3
+    end = (base + size + 3) & ~3
+    words = _words(xrange(start, end, 4))
+    return bytearray(words)[base - start:base - start + size]
+
+PATTERNS = {
+    'random':       pattern_random,
+    'prng':         pattern_prng,
+    'walking1':     pattern_walking_ones,
+    'walking0':     pattern_walking_zeros,
+    'checkerboard': pattern_checkerboard,
+    'address':      pattern_address,
+}
+
+
+class MemcheckResult(object):
+    """Compact memcheck outcome: error count, per-bit stuck-at masks of the
+       32-bit data bus and the failing address ranges.
+    """
+
+    MAX_RANGES = 32
 
-def memcheck(options):
-   
+    def __init__(self):
+        self.checked = 0
+        self.errors = 0
+        self.stuck0 = 0             # bits written as 1, read back as 0
+        self.stuck1 = 0             # bits written as 0, read back as 1
+        self.ranges = []
+        self.dropped = 0
+
+    def add_range(self, start, end):
+        if self.ranges and self.ranges[-1][1] == start:
+            self.ranges[-1][1] = end
+        elif len(self.ranges) < MemcheckResult.MAX_RANGES:
+            self.ranges.append([start, end])
+        else:
+            self.dropped += 1
+
+    def merge(self, other):
+        self.checked += other.checked
+        self.errors += other.errors
+        self.stuck0 |= other.stuck0
+        self.stuck1 |= other.stuck1
+        self.dropped += other.dropped
+        for start, end in other.ranges:
+            self.add_range(start, end)
+
+    def add_masks(self, lane, stuck0, stuck1):
+        shift = (3 - lane) * 8
+        self.stuck0 |= stuck0 << shift
+        self.stuck1 |= stuck1 << shift
+
+    def report(self):
+        print "Checked 0x%X bytes, %i errors" % (self.checked, self.errors)
+        if not self.errors:
+            return
+        print "Stuck at 0: 0x%08X  Stuck at 1: 0x%08X" % (self.stuck0, self.stuck1)
+        for start, end in self.ranges:
+            print "  [0x%08X,0x%08X) %i bytes" % (start, end, end - start)
+        if self.dropped:
+            print "  ... %i more ranges" % self.dropped
+
+
+def _memcompare_numpy(base, expected, got, result):
+    exp = numpy.frombuffer(expected, numpy.uint8)
+    act = numpy.frombuffer(got, numpy.uint8)
+    bad = numpy.flatnonzero(exp != act)
+    if not len(bad):
+        return
+    result.errors += len(bad)
+    for lane in range(4):
+        idx = bad[(bad + base) % 4 == lane]
+        if len(idx):
+            result.add_masks(lane,
+                int(numpy.bitwise_or.reduce(exp[idx] & ~act[idx])),
+                int(numpy.bitwise_or.reduce(~exp[idx] & act[idx])))
+    breaks = numpy.flatnonzero(numpy.diff(bad) != 1)
+    starts = numpy.concatenate(([bad[0]], bad[breaks + 1]))
+    ends = numpy.concatenate((bad[breaks], [bad[-1]])) + 1
+    for start, end in zip(starts, ends):
+        result.add_range(base + int(start), base + int(end))
+
+def _memcompare_bytes(base, expected, got, result):
+    # equal chunks are skipped at memcmp speed, only dirty ones are walked
+    chunk = 256
+    exp = buffer(expected)
+    act = buffer(got)
+    stuck = [[0, 0] for lane in range(4)]
+    for offset in xrange(0, len(exp), chunk):
+        if exp[offset:offset + chunk] == act[offset:offset + chunk]:
+            continue
+        for idx in xrange(offset, min(offset + chunk, len(exp))):
+            e = expected[idx]
+            a = got[idx]
+            if e != a:
+                result.errors += 1
+                lane = stuck[(base + idx) % 4]
+                lane[0] |= e & ~a
+                lane[1] |= ~e & a & 0xff
+                result.add_range(base + idx, base + idx + 1)
+    for lane, (stuck0, stuck1) in enumerate(stuck):
+        result.add_masks(lane, stuck0, stuck1)
+
+def memcompare(base, expected, got, result=None):
+    """compare two equally sized bytearrays, accumulating into result"""
+    if result is None:
+        result = MemcheckResult()
+    result.checked += len(expected)
+    if numpy is not None:
+        _memcompare_numpy(base, expected, got, result)
+    else:
+        _memcompare_bytes(base, expected, got, result)
+    return result
+
+def memcheck_stream(lm32, generate, base, size, block_size, seed, max_errors=0):
+    """upload, read back and verify block by block. A generator thread
+       prepares the pattern of the next block while the current one is on
+       the wire, a checker thread verifies the previous block. Its reports
+       are printed by the calling thread after the next block. Stops early
+       once max_errors is reached.
+    """
+    patterns = Queue.Queue(2)
+    checks = Queue.Queue(2)
+    result = MemcheckResult()
+    abort = threading.Event()
+    # exc_info of a failed helper thread, raised again by the caller
+    failures = []
+    # checker messages, printed by the caller so they reach the output of
+    # its thread, like a session client
+    reports = Queue.Queue()
+
+    def report():
+        while True:
+            try:
+                lm32.info(reports.get_nowait())
+            except Queue.Empty:
+                return
+
+    def generator():
+        try:
+            for offset in range(0, size, block_size):
+                if abort.is_set():
+                    break
+                addr = base + offset
+                patterns.put((addr, generate(addr, min(block_size, size - offset), seed)))
+        except Exception:
+            failures.append(sys.exc_info())
+            abort.set()
+        finally:
+            patterns.put(None)
+
+    def checker():
+        while True:
+            item = checks.get()
+            if item is None:
+                break
+            if failures:
+                # keep draining, the main loop must never block on checks
+                continue
+            addr, expected, got = item
+            try:
+                block = memcompare(addr, expected, got)
+                if block.errors:
+                    reports.put("\n0x%08X: %i errors, stuck at 0: 0x%08X stuck at 1: 0x%08X\n" % (
+                        addr, block.errors, block.stuck0, block.stuck1))
+                result.merge(block)
+            except Exception:
+                failures.append(sys.exc_info())
+            finally:
+                if failures or max_errors and result.errors >= max_errors:
+                    abort.set()
+
+    threads = [threading.Thread(target=generator), threading.Thread(target=checker)]
+    for t in threads:
+        t.setDaemon(1)
+        t.start()
+
+    lm32.info("Streaming 0x%X (%i kb) to 0x%X..." % (size, size/1024, base))
+    item = ()
+    try:
+        while not abort.is_set():
+            item = patterns.get()
+            if item is None:
+                break
+            addr, data = item
+            lm32.progress()
+            lm32.upload(addr, data)
+            checks.put((addr, data, lm32.download(addr, len(data))))
+            report()
+    finally:
+        abort.set()
+        # the generator always ends with None
+        while item is not None:
+            item = patterns.get()
+        checks.put(None)
+        for t in threads:
+            t.join()
+        report()
+    if failures:
+        raise failures[0][0], failures[0][1], failures[0][2]
+    if max_errors and result.errors >= max_errors:
+        lm32.info("Aborted after %i errors.\n" % result.errors)
+    else:
+        lm32.info("Done.\n")
+    return result
+
+def run_memcheck(lm32, generate, base, size, block_size, options):
+    if options.stream:
+        return memcheck_stream(lm32, generate, base, size, block_size,
+            options.seed, options.max_errors)
+
+    data = generate(base, size, options.seed)
+    
+    lm32.upload_chunked(data, base, size, block_size)
+    read_data = lm32.download_chunked( base, size, block_size )
+    
+    lm32.info("Checking for memory errors...")
+    with profiled("memcompare"):
+        result = memcompare(base, data, read_data)
+    lm32.info("Done.\n")
+    return result
+
+def memcheck_options(options):
     try:
         block_size = int(options.block_size,16)
         test_size  = int(options.size,16)
@@ -488,63 +2131,619 @@ def memcheck(options):
     except:
         die("Cannot convert inpurt values to hex")
     
-    print "Memcheck addr=0x%X size=0x%X " % (test_base,test_size)
+    if options.pattern not in PATTERNS:
+        die("Unknown pattern %s, use one of %s" % (options.pattern, ",".join(sorted(PATTERNS))))
+    return PATTERNS[options.pattern], test_base, test_size, block_size
+
+def memcheck(options):
+   
+    generate, test_base, test_size, block_size = memcheck_options(options)
+
+    print "Memcheck addr=0x%X size=0x%X pattern=%s" % (test_base,test_size,options.pattern)
     
     try:
         lm32 = LM32Serial(options.port, options.baudrate)
     except:
         die("Can't open serial port")
 
-    lm32.find_bootloader()
-    
-    data = []
-    for x in range(test_size):
-        data.append(chr(random.randint(0,255)))
-    
-    lm32.upload_chunked(data, test_base, test_size, block_size)
-    read_data = lm32.download_chunked( test_base, test_size, block_size )
-    
-    print "Checking for memory errors...",
-    for idx,val in enumerate(data):
-        if val != read_data[idx]:
-            print "0x%X 0x%02x != 0x%02x" % (test_base + idx,ord(val),ord(read_data[idx]))
-    print "Done."
+    lm32.find_bootloader(max_baud=options.max_baud, packets=options.packets)
+    result = run_memcheck(lm32, generate, test_base, test_size, block_size, options)
+    result.report()
+    lm32.close()
+
+def dump(options):
+
+    try:
+        lm32 = LM32Serial(options.port, options.baudrate)
+    except:
+        die("Can't open serial port")
+    lm32.find_bootloader(max_baud=options.max_baud, packets=options.packets)
+    dump_board(lm32, options)
+    lm32.close()
+
+def dump_board(lm32, options):
+    try:
+        block_size = int(options.block_size,16)
+        size = int(options.size,16)
+        base = int(options.start_addr,16)
+    except:
+        die("Cannot convert inpurt values to hex")
+
+    try:
+        fd = open(options.filename_dump, "w+b")
+        fd.truncate(size)
+    except IOError, e:
+        die("Can't open output file %s: %s" % (options.filename_dump, e))
+    if not size:
+        # mmap can't map an empty file
+        fd.close()
+        return
+    image = mmap.mmap(fd.fileno(), size)
+    try:
+        lm32.download_chunked(base, size, block_size, image)
+    except serial.SerialTimeoutException, e:
+        die(str(e))
+    image.close()
+    fd.close()
+
+def crc32(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return zlib.crc32(data) & 0xffffffff
+
+ZERO_BLOCK = "\0" * 0x10000
+
+def crc32_zeros(size):
+    """crc32() of size zero bytes"""
+    crc = 0
+    for offset in range(0, size, len(ZERO_BLOCK)):
+        crc = zlib.crc32(ZERO_BLOCK[:size - offset], crc)
+    return crc & 0xffffffff
+
+
+class ImageCache(object):
+    """Block checksums of the image last uploaded through a port, used to
+       find the blocks a new image actually changes.
+    """
+
+    PATH = os.path.expanduser("~/.lm32client")
+
+    def __init__(self, port):
+        key = hashlib.sha1(os.path.realpath(port)).hexdigest()[:16]
+        self.filename = os.path.join(ImageCache.PATH, "image_%s.json" % key)
+
+    def load(self):
+        try:
+            blocks = json.load(open(self.filename))
+        except (IOError, ValueError):
+            return {}
+        return dict((int(addr, 16), crc) for addr, crc in blocks.items())
+
+    def save(self, blocks):
+        make_dirs(ImageCache.PATH)
+        fd = open(self.filename + ".tmp", "w")
+        json.dump(dict(("%08x" % addr, crc) for addr, crc in blocks.items()), fd)
+        fd.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+
+class BlockChecksums(dict):
+    """{addr: crc32} over the block_size chunks of a SegmentMap"""
+
+    def __init__(self, segments, block_size):
+        dict.__init__(self)
+        self.block_size = block_size
+        for addr, data in segments.extents(block_size):
+            self[addr] = crc32(data)
+
+
+def delta_segments(lm32, segments, blocks, known):
+    """SegmentMap of the blocks the board does not hold yet. Blocks that
+       match the cache are confirmed with an on-target checksum first.
+    """
+    changed = SegmentMap()
+    for addr, data in segments.extents(blocks.block_size):
+        crc = blocks[addr]
+        if known.get(addr) == crc:
+            lm32.progress()
+            if lm32.checksum(addr, len(data)) == crc:
+                continue
+        changed.add(addr, data)
+    return changed
+
+def verify_segments(lm32, segments, max_extent):
+    """checksum the data and the zero-filled ranges of segments"""
+    lm32.info("Verifying")
+    checks = [(addr, len(data), crc32(data)) for addr, data in segments.extents(max_extent)]
+    for addr, size in segments.zeros:
+        step = max_extent or size
+        for offset in range(0, size, step):
+            length = min(step, size - offset)
+            checks.append((addr + offset, length, crc32_zeros(length)))
+    failed = 0
+    for addr, size, crc in checks:
+        lm32.progress()
+        if lm32.checksum(addr, size) != crc:
+            lm32.info("\nChecksum mismatch in [0x%08X,0x%08X)" % (addr, addr + size))
+            failed += 1
+    lm32.info("Done.\n")
+    return failed == 0
+
+
+def upload_options(options):
+    try:
+        max_extent = int(options.max_extent,16)
+        block_size = int(options.block_size,16)
+    except:
+        die("Faulty extent or block size %s %s" % (options.max_extent, options.block_size))
+    return max_extent, block_size
+
+def flash(lm32, port, segments, addr_jump, max_extent, block_size, options):
+    """upload segments and jump to addr_jump; False if verification failed"""
+    cache = ImageCache(port)
+    blocks = BlockChecksums(segments, block_size)
+    image = segments
+    if options.delta:
+        lm32.info("Comparing with last upload")
+        image = delta_segments(lm32, segments, blocks, cache.load())
+        lm32.info(" %i of %i bytes changed.\n" % (image.size(), segments.size()))
+
+    send_image(lm32, image, segments.zeros, max_extent, options)
+    # a negotiated rate that garbles uploads shows up in the verification
+    while options.verify and not verify_segments(lm32, segments, max_extent):
+        if not lm32.fall_back():
+            cache.save({})
+            return False
+        send_image(lm32, image, segments.zeros, max_extent, options)
+    cache.save(blocks)
+    lm32.jump(addr_jump)
+    return True
+
+def send_image(lm32, image, zero_ranges, max_extent, options):
+    size = image.size()
+    sent = 0
+    lm32.info("Uploading %i bytes in %i extents" % (size, len(image)))
+    if zero_ranges:
+        lm32.info(", clearing %i bytes" % sum(zeros for addr, zeros in zero_ranges))
+    for addr, data in image.extents(max_extent):
+        lm32.progress()
+        if options.compress:
+            sent += lm32.upload_compressed(addr,data)
+        else:
+            sent += len(data)
+            lm32.upload(addr,data)
+    for addr, zeros in zero_ranges:
+        lm32.progress()
+        size += zeros
+        sent += lm32.zero_fill(addr, zeros)
+    lm32.info("Done.\n")
+    if sent != size and size:
+        lm32.info("Sent %i bytes (%.1f%%).\n" % (sent, 100.0 * sent / size))
 
 def upload(options):
     
-    block_size = 0x800
+    max_extent, block_size = upload_options(options)
     try:
         lm32 = LM32Serial(options.port, options.baudrate)
     except:
         die("Can't open serial port")
-    lm32.find_bootloader()
+    lm32.find_bootloader(max_baud=options.max_baud, packets=options.packets)
     
-    addr_jump = 0
     if not os.path.isfile(options.filename_srec):
         die("Can't find file %s" % options.filename_srec)
 
-    data = open(options.filename_srec).read().splitlines()
-    for line in data:
-        line = line.strip()
-        if line.startswith("S7"):
-            addr_jump = int(line[4:12],16)
-        if line.startswith("S3"):
-            count = int(line[2:4],16)
-            addr  = int(line[4:12],16)
-            dat   = line[12:-2]
-            cksum = int(line[-2:],16)
-            count = (count - 5) * 2
-            data = []
-            sys.stdout.write("\rUploading 0x%08x" % addr)
-            sys.stdout.flush()
-            for i in range(0,count,2):
-                data.append(chr(int(dat[i:i+2],16)))
-            lm32.upload(addr,data)    
-    sys.stdout.write("\n")
-    sys.stdout.flush()
-    lm32.jump(addr_jump)
+    with profiled("load_image"):
+        try:
+            segments, addr_jump = load_image(options.filename_srec)
+        except ValueError, e:
+            die(str(e))
+    with segments:
+        if not flash(lm32, options.port, segments, addr_jump, max_extent, block_size, options):
+            die("Upload verification failed")
     lm32.close()
 
+
+def board_brams(filename):
+    """{instance: (base, size, mem_file)} of the wb_bram instances in a
+       board's system.v. The base comes from the wb_conbus slave whose
+       address lines drive the instance, mem_file is None without one.
+    """
+    text = open(filename).read()
+    text = re.sub(r"/\*.*?\*/", "", re.sub(r"//[^\n]*", "", text), flags=re.S)
+    params = dict(re.findall(r'parameter\s+(\w+)\s*=\s*"([^"]*)"', text))
+    # wb_conbus_top defaults
+    widths = {0: 4, 1: 4}
+    widths.update((n, 8) for n in range(2, 8))
+    for slave, width in re.findall(r"\.s(\d+)_addr_w\s*\(\s*(\d+)\s*\)", text):
+        if slave == "27":
+            widths.update((n, int(width)) for n in range(2, 8))
+        else:
+            widths[int(slave)] = int(width)
+    addrs = dict((int(slave), int(value, 16)) for slave, value in
+        re.findall(r"\.s(\d)_addr\s*\(\s*\d*'h([0-9a-fA-F]+)\s*\)", text))
+    slaves = dict((wire, int(slave)) for slave, wire in
+        re.findall(r"\.s(\d)_adr_o\s*\(\s*(\w+)\s*\)", text))
+
+    brams = {}
+    for config, name, ports in re.findall(r"\bwb_bram\w*\s*#\s*\((.*?)\)\s*(\w+)\s*\((.*?)\);", text, re.S):
+        width = re.search(r"\.adr_width\s*\(\s*(\d+)\s*\)", config)
+        mem_file = re.search(r'\.mem_file_name\s*\(\s*"?(\w[^")\s]*)"?\s*\)', config)
+        wire = re.search(r"\.wb_adr_i\s*\(\s*(\w+)\s*\)", ports)
+        if not width or not wire or wire.group(1) not in slaves:
+            continue
+        slave = slaves[wire.group(1)]
+        # the bus decodes the slave address from bit 30 downwards
+        base = addrs.get(slave, 0) << (31 - widths[slave])
+        if mem_file:
+            mem_file = params.get(mem_file.group(1), mem_file.group(1))
+            mem_file = os.path.join(os.path.dirname(filename), mem_file)
+        brams[name] = (base, 1 << int(width.group(1)), mem_file)
+    return brams
+
+def write_if_changed(filename, data):
+    """write data unless filename holds it already, True when written"""
+    try:
+        if open(filename, "rb").read() == data:
+            return False
+    except IOError:
+        pass
+    fd = open(filename + ".tmp", "wb")
+    fd.write(data)
+    fd.close()
+    os.rename(filename + ".tmp", filename)
+    return True
+
+def readmemh(data, width):
+    """$readmemh text of data, width bytes per line"""
+    digits = binascii.hexlify(data)
+    step = 2 * width
+    return "".join(digits[i:i + step] + "\n" for i in range(0, len(digits), step))
+
+def bram(options):
+    """write the $readmemh files of an image for a board's boot BRAM: the
+       32 bit words wb_bram reads and one file per byte lane, lane 0 being
+       bits 7:0. Files that would not change are left alone.
+    """
+    system = options.board
+    if os.path.isdir(system):
+        system = os.path.join(system, "system.v")
+    try:
+        brams = board_brams(system)
+    except IOError, e:
+        die("Can't read board description: %s" % e)
+    if options.bram:
+        if options.bram not in brams:
+            die("No wb_bram %s in %s, found %s" % (options.bram, system, ",".join(sorted(brams)) or "none"))
+        name = options.bram
+    else:
+        named = sorted(name for name in brams if brams[name][2])
+        if not named:
+            die("No wb_bram with a mem_file_name in %s" % system)
+        name = named[0]
+    base, size, mem_file = brams[name]
+    filename = options.filename_bram or mem_file
+    if not filename:
+        die("%s has no mem_file_name, use --bram-file" % name)
+
+    try:
+        segments, addr_jump = load_image(options.filename_srec)
+    except ValueError, e:
+        die(str(e))
+    image = bytearray(size)
+    outside = 0
+    with segments:
+        for addr, data in segments.extents():
+            start = max(addr, base)
+            end = min(addr + len(data), base + size)
+            outside += len(data) - max(end - start, 0)
+            if start < end:
+                image[start - base:end - base] = data[start - addr:end - addr]
+    print "%s: [0x%08X,0x%08X) from %s" % (name, base, base + size, options.filename_srec)
+    if outside:
+        print "Warning: %i bytes of the image are outside of %s" % (outside, name)
+
+    root, ext = os.path.splitext(filename)
+    outputs = [(filename, readmemh(image, 4))]
+    # big endian: the byte at offset 0 of a word is bits 31:24
+    outputs += [("%s%i%s" % (root, lane, ext), readmemh(image[3 - lane::4], 1)) for lane in range(4)]
+    for output, text in outputs:
+        print "%s %s" % (write_if_changed(output, text) and "Wrote" or "Unchanged", output)
+
+
+class FleetJob(object):
+    """State of one board in a fleet run"""
+
+    def __init__(self, port, total):
+        self.port = port
+        self.total = total
+        self.board = None
+        self.state = "waiting"
+        self.ok = None
+        self.summary = ""
+        self.started = None
+        self.finished = None
+
+    def transferred(self):
+        if self.board is None:
+            return 0
+        return self.board.wire.sent + self.board.received
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return elapsed and self.transferred() / elapsed / 1024
+
+    def status(self):
+        name = os.path.basename(self.port)
+        if self.ok is not None:
+            return "%s %s" % (name, self.ok and "PASS" or "FAIL")
+        if self.board is None:
+            return "%s %s" % (name, self.state)
+        done = min(100, 100 * self.transferred() / max(1, self.total))
+        return "%s %3i%% %5.1fkB/s" % (name, done, self.rate())
+
+    def run(self, task, options):
+        self.started = time.time()
+        try:
+            self.board = FleetBoard(self, self.port, options.baudrate)
+            self.board.find_bootloader(max_baud=options.max_baud, packets=options.packets)
+            self.ok, self.summary = task(self.board, self.port)
+        except Exception, e:
+            self.ok, self.summary = False, str(e)
+        if self.board is not None:
+            try:
+                self.board.close()
+            except Exception:
+                pass
+        self.finished = time.time()
+
+
+class FleetBoard(LM32Serial):
+    """LM32Serial that reports into its FleetJob instead of stdout"""
+
+    def __init__(self, job, dev, speed):
+        self.job = job
+        LM32Serial.__init__(self, dev, speed)
+
+    def info(self, msg):
+        msg = msg.strip()
+        if msg:
+            self.job.state = msg
+
+    def progress(self):
+        pass
+
+
+def fleet_ports(spec):
+    """expand a comma separated list of ports and globs"""
+    ports = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        for port in (glob.has_magic(item) and sorted(glob.glob(item)) or [item]):
+            if port not in ports:
+                ports.append(port)
+    return ports
+
+PROBE_PORTS = ("/dev/ttyUSB*", "/dev/ttyACM*")
+PROBE_TIMEOUT = 0.3
+
+def usb_serials():
+    """{port: USB serial number} of the serial adapters the system knows"""
+    try:
+        from serial.tools import list_ports
+    except ImportError:
+        return {}
+    serials = {}
+    for info in list_ports.comports():
+        number = getattr(info, "serial_number", None)
+        if number is None:
+            # pyserial 2 only has the hardware id string
+            match = re.search(r"(?:SER|SNR)=(\w+)", info[2])
+            number = match and match.group(1)
+        if number:
+            serials[info[0]] = number
+    return serials
+
+
+class BoardMap(object):
+    """Ports a bootloader answered on before, keyed by the USB serial number
+       of the adapter so a board is found again when it got another port
+       name, by the port itself for adapters without a number.
+    """
+
+    PATH = os.path.join(ImageCache.PATH, "boards.json")
+
+    def __init__(self):
+        try:
+            self.boards = json.load(open(BoardMap.PATH))
+        except (IOError, ValueError):
+            self.boards = {}
+
+    def known(self, serials):
+        """ports of known boards that are present, most recently seen first"""
+        ports = dict((number, port) for port, number in serials.items())
+        known = []
+        for key, entry in sorted(self.boards.items(), key=lambda item: -item[1]["seen"]):
+            port = str(ports.get(key, entry["port"]))
+            if key in ports or port.startswith("socket://") or os.path.exists(port):
+                if port not in known:
+                    known.append(port)
+        return known
+
+    def update(self, ports, serials):
+        for port in ports:
+            self.boards[serials.get(port, port)] = {"port": port, "seen": time.time()}
+
+    def save(self):
+        make_dirs(ImageCache.PATH)
+        fd = open(BoardMap.PATH + ".tmp", "w")
+        json.dump(self.boards, fd, indent=1)
+        fd.close()
+        os.rename(BoardMap.PATH + ".tmp", BoardMap.PATH)
+
+
+def probe_port(port, baudrate, timeout=PROBE_TIMEOUT):
+    """seconds until the bootloader banner came back on port, None if it
+       did not within timeout
+    """
+    start = time.time()
+    try:
+        io = serial.serial_for_url(port, baudrate, timeout=0.01)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    try:
+        received = ""
+        resend = start + timeout / 2
+        io.write('\r')
+        while time.time() - start < timeout:
+            received += io.read(io.inWaiting() or 1)
+            if LM32Serial.BOOT_SIG in received:
+                return time.time() - start
+            if resend and time.time() > resend:
+                resend = None
+                io.write('\r')
+    except (serial.SerialException, OSError):
+        pass
+    finally:
+        io.close()
+    return None
+
+def probe_ports(ports, baudrate, timeout=PROBE_TIMEOUT):
+    """probe all ports at once, [(port, seconds)] of those that answered"""
+    answers = {}
+
+    def probe(port):
+        answers[port] = probe_port(port, baudrate, timeout)
+
+    threads = [threading.Thread(target=probe, args=(port,)) for port in ports]
+    for t in threads:
+        t.setDaemon(1)
+        t.start()
+    for t in threads:
+        t.join()
+    return [(port, answers[port]) for port in ports if answers[port] is not None]
+
+def discover(options, first=False, skip=()):
+    """[(port, seconds)] of the bootloaders on the usual serial adapters and
+       the --probe ports. Known boards are probed first; with first set the
+       search ends there when one of them answers. Ports in skip are left
+       alone.
+    """
+    serials = usb_serials()
+    boards = BoardMap()
+    ports = [port for port in boards.known(serials) if port not in skip]
+    found = []
+    if first and ports:
+        found = probe_ports(ports, options.baudrate)
+    if not found:
+        for pattern in PROBE_PORTS:
+            ports += [port for port in sorted(glob.glob(pattern)) if port not in ports]
+        if options.probe:
+            ports += [port for port in fleet_ports(options.probe) if port not in ports]
+        ports = [port for port in ports if port not in skip]
+        found = probe_ports(ports, options.baudrate)
+    boards.update([port for port, seconds in found], serials)
+    boards.save()
+    return found
+
+def discover_port(options):
+    found = discover(options, first=True)
+    if not found:
+        die("No soc-lm32 bootloader answered on any port")
+    return found[0][0]
+
+def list_boards(options):
+    serials = usb_serials()
+    found = discover(options)
+    for port, seconds in found:
+        print "%-24s %-16s %6.1f ms" % (port, serials.get(port, "-"), 1000 * seconds)
+    if not found:
+        print "No soc-lm32 bootloader found"
+
+def fleet(options):
+    """run upload or memcheck on many boards at once. The image is parsed
+       once into a frozen SegmentMap shared by all workers.
+    """
+    ports = fleet_ports(options.fleet)
+    if not ports:
+        die("No serial ports match %s" % options.fleet)
+
+    if options.action == 'upload':
+        max_extent, block_size = upload_options(options)
+        with profiled("load_image"):
+            try:
+                segments, addr_jump = load_image(options.filename_srec)
+            except ValueError, e:
+                die(str(e))
+        segments.freeze()
+        total = segments.size()
+        print "Flashing %i bytes to %i boards" % (total, len(ports))
+
+        def task(lm32, port):
+            if not flash(lm32, port, segments, addr_jump, max_extent, block_size, options):
+                return False, "verification failed"
+            return True, "%i bytes" % total
+    elif options.action == 'memcheck':
+        generate, base, size, block_size = memcheck_options(options)
+        total = 2 * size
+        print "Memcheck addr=0x%X size=0x%X pattern=%s on %i boards" % (base, size, options.pattern, len(ports))
+
+        def task(lm32, port):
+            result = run_memcheck(lm32, generate, base, size, block_size, options)
+            summary = "%i errors" % result.errors
+            if result.errors:
+                summary += ", stuck at 0: 0x%08X stuck at 1: 0x%08X" % (result.stuck0, result.stuck1)
+            return result.errors == 0, summary
+    else:
+        die("Fleet mode supports the upload and memcheck actions")
+
+    jobs = [FleetJob(port, total) for port in ports]
+    pending = Queue.Queue()
+    for job in jobs:
+        pending.put(job)
+
+    def worker():
+        while True:
+            try:
+                job = pending.get_nowait()
+            except Queue.Empty:
+                return
+            job.run(task, options)
+
+    workers = [threading.Thread(target=worker) for i in range(min(options.jobs or len(jobs), len(jobs)))]
+    started = time.time()
+    for t in workers:
+        t.setDaemon(1)
+        t.start()
+    width = 0
+    while True:
+        alive = [t for t in workers if t.isAlive()]
+        line = " | ".join(job.status() for job in jobs)
+        sys.stdout.write("\r" + line.ljust(width))
+        sys.stdout.flush()
+        width = len(line)
+        if not alive:
+            break
+        time.sleep(0.5)
+    sys.stdout.write("\n")
+    if options.action == 'upload':
+        segments.close()
+
+    print "%-24s %-6s %8s %8s  %s" % ("Port", "Result", "Time", "kB/s", "Details")
+    for job in jobs:
+        print "%-24s %-6s %7.1fs %8.1f  %s" % (job.port, job.ok and "PASS" or "FAIL",
+            job.elapsed(), job.rate(), job.summary)
+    passed = len([job for job in jobs if job.ok])
+    print "%i of %i boards passed in %.1fs" % (passed, len(jobs), time.time() - started)
+    if passed != len(jobs):
+        sys.exit(1)
+
 def jump(options):
     
     try:
@@ -561,17 +2760,229 @@ def jump(options):
     lm32.close()
 
 
+def value_changes(data):
+    """indices of the samples that differ from their predecessor, the
+       first sample always counts as a change
+    """
+    if not len(data):
+        return []
+    if numpy is not None:
+        samples = numpy.frombuffer(buffer(data), dtype=numpy.uint8)
+        changes = numpy.flatnonzero(samples[1:] != samples[:-1]) + 1
+        return [0] + changes.tolist()
+    return [0] + [i for i in xrange(1, len(data)) if data[i] != data[i - 1]]
+
+def _edges(levels, level):
+    """indices where levels switches to level"""
+    if numpy is not None:
+        a = numpy.frombuffer(buffer(levels), dtype=numpy.uint8)
+        return (numpy.flatnonzero((a[1:] != a[:-1]) & (a[1:] == level)) + 1).tolist()
+    return [i for i in xrange(1, len(levels)) if levels[i] == level and levels[i - 1] != level]
+
+def timescale_seconds(timescale):
+    """'10ns' -> 1e-08"""
+    units = {"s": 1.0, "ms": 1e-3, "us": 1e-6, "ns": 1e-9, "ps": 1e-12, "fs": 1e-15}
+    value = timescale.strip().rstrip("munpfs")
+    return float(value) * units[timescale.strip()[len(value):]]
+
+class LacSignal(object):
+    """named field of width bits starting at probe bit lsb"""
+
+    def __init__(self, name, lsb, width, code):
+        self.name = name
+        self.lsb = lsb
+        self.width = width
+        self.code = code
+        if width == 1:
+            self.formats = ["%i%s\n" % (v, code) for v in range(2)]
+        else:
+            self.formats = ["%s %s\n" % (binary(v, width), code) for v in range(1 << width)]
+
+    def declaration(self):
+        if self.width == 1:
+            return self.name
+        return "%s[%i:0]" % (self.name, self.width - 1)
+
+    def levels(self, samples):
+        """the field value of every sample as bytearray"""
+        mask = (1 << self.width) - 1
+        if numpy is not None:
+            a = numpy.frombuffer(buffer(samples), dtype=numpy.uint8)
+            return bytearray(((a >> self.lsb) & mask).tostring())
+        return bytearray((v >> self.lsb) & mask for v in samples)
+
+class UartDecoder(object):
+    """8N1 frames, idle high, LSB first"""
+
+    def __init__(self, rx, baud):
+        self.rx = rx
+        self.baud = baud
+
+    def names(self):
+        return [self.rx]
+
+    def decode(self, levels, period):
+        rx = levels[self.rx]
+        bit = 1.0 / (period * self.baud)
+        if bit < 2:
+            raise ValueError("uart %s: %i baud is too fast for the sample rate" % (self.rx, self.baud))
+        frames = []
+        end = 0
+        for start in _edges(rx, 0):
+            stop = int(start + 9.5 * bit)
+            if stop >= len(rx):
+                break
+            if start < end or rx[int(start + 0.5 * bit)]:
+                continue
+            value = 0
+            for k in range(8):
+                value |= rx[int(start + (1.5 + k) * bit)] << k
+            text = "%s 0x%02x %r" % (self.rx, value, chr(value))
+            if not rx[stop]:
+                text += " framing error"
+            frames.append((start, "uart", text))
+            end = stop
+        return frames
+
+class SpiDecoder(object):
+    """bytes MSB first, sampled on the sck edge given by the SPI mode.
+       With cs every low phase of cs starts a new byte.
+    """
+
+    def __init__(self, sck, mosi=None, miso=None, cs=None, mode=0):
+        self.sck = sck
+        self.data = [name for name in (mosi, miso) if name]
+        self.cs = cs
+        self.mode = mode
+
+    def names(self):
+        return [self.sck] + self.data + [name for name in (self.cs,) if name]
+
+    def decode(self, levels, period):
+        edges = _edges(levels[self.sck], self.mode in (0, 3) and 1 or 0)
+        if self.cs:
+            cs = levels[self.cs]
+            edges = [i for i in edges if not cs[i]]
+            starts = _edges(cs, 0)
+        else:
+            starts = []
+        words = []
+        first = 0
+        while first < len(edges):
+            # bytes never run across the start of a transfer
+            nxt = bisect.bisect_right(starts, edges[first])
+            limit = nxt < len(starts) and starts[nxt] or len(levels[self.sck])
+            last = bisect.bisect_left(edges, limit, first, min(first + 8, len(edges)))
+            count = last - first
+            text = []
+            for name in self.data:
+                line = levels[name]
+                value = 0
+                for i in edges[first:last]:
+                    value = value << 1 | line[i]
+                text.append("%s 0x%02x" % (name, value))
+            if count < 8:
+                text.append("(%i bits)" % count)
+            words.append((edges[first], "spi", " ".join(text)))
+            first = last
+        return words
+
+class WishboneDecoder(object):
+    """one cycle per rising stb, closed by the first ack"""
+
+    def __init__(self, stb, ack, we=None):
+        self.stb = stb
+        self.ack = ack
+        self.we = we
+
+    def names(self):
+        return [name for name in (self.stb, self.ack, self.we) if name]
+
+    def decode(self, levels, period):
+        stb, ack = levels[self.stb], levels[self.ack]
+        acks = _edges(ack, 1)
+        drops = _edges(stb, 0)
+        starts = _edges(stb, 1)
+        if stb[0]:
+            starts.insert(0, 0)
+        cycles = []
+        for start in starts:
+            if ack[start]:
+                done = start
+            else:
+                n = bisect.bisect_left(acks, start)
+                done = n < len(acks) and acks[n] or None
+            n = bisect.bisect_right(drops, start)
+            if done is not None and n < len(drops) and drops[n] < done:
+                done = None
+            kind = "cycle"
+            if self.we:
+                kind = levels[self.we][start] and "write" or "read"
+            if done is None:
+                cycles.append((start, "wishbone", "%s without ack" % kind))
+            else:
+                cycles.append((start, "wishbone", "%s ack after %i" % (kind, done - start)))
+        return cycles
+
+LAC_DECODERS = {
+    "uart": UartDecoder,
+    "spi": SpiDecoder,
+    "wishbone": WishboneDecoder,
+}
+
+def load_lac_config(filename):
+    """read named probe bits and decoders from a JSON file like
+         {"signals": {"tx": 0, "sck": 1, "mosi": 2, "miso": 3, "addr": [4, 7]},
+          "decoders": [{"type": "uart", "rx": "tx", "baud": 115200},
+                       {"type": "spi", "sck": "sck", "mosi": "mosi", "miso": "miso"}]}
+       a signal is a single bit or an inclusive [lsb, msb] range
+    """
+    config = json.load(open(filename))
+    fields = []
+    for name, bits in config.get("signals", {}).items():
+        if isinstance(bits, int):
+            bits = [bits, bits]
+        fields.append((bits[0], bits[1] - bits[0] + 1, str(name)))
+    signals = []
+    for lsb, width, name in sorted(fields):
+        signals.append(LacSignal(name, lsb, width, chr(ord("a") + len(signals))))
+    decoders = []
+    for args in config.get("decoders", []):
+        args = dict((str(k), isinstance(v, basestring) and str(v) or v) for k, v in args.items())
+        kind = args.pop("type", None)
+        if kind not in LAC_DECODERS:
+            raise ValueError("unknown decoder type %r" % kind)
+        decoder = LAC_DECODERS[kind](**args)
+        for name in decoder.names():
+            if name not in [signal.name for signal in signals]:
+                raise ValueError("%s decoder uses undefined signal %r" % (kind, name))
+        decoders.append(decoder)
+    return signals, decoders
+
+def decode_capture(samples, signals, decoders, period):
+    """run all decoders over a capture, transactions sorted by sample"""
+    levels = dict((signal.name, signal.levels(samples)) for signal in signals)
+    transactions = []
+    for decoder in decoders:
+        transactions += decoder.decode(levels, period)
+    transactions.sort(key=lambda t: t[0])
+    return transactions
+
 class VCDWriter(object):
 
-    def __init__(self, filename, timescale):
-        self.fd = open(filename,"w")
+    BINARY = ["%s P\n" % binary(v) for v in range(256)]
+    BUFFER_SIZE = 0x10000
+
+    def __init__(self, filename, timescale, signals=()):
+        self.fd = open(filename,"w",VCDWriter.BUFFER_SIZE)
         self.filename = filename 
         self.timescale = timescale
+        self.signals = signals
 
-    def writeHeader(self):
+    def writeHeader(self, stamp=None):
         # Write VCD header
         self.fd.write("$date\n") 
-        self.fd.write("\t%s" % time.strftime("%Y-%m-%d %H:%M:%S",time.localtime()))
+        self.fd.write("\t%s" % time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(stamp)))
         self.fd.write("$end\n")
         self.fd.write("$version\n") 
         self.fd.write("\tLogicAnalyzerComponent soc-lm32\n")
@@ -580,10 +2991,15 @@ class VCDWriter(object):
         self.fd.write("\t%s\n" % self.timescale)
         self.fd.write("$end\n")
 
+    def writeComment(self, text):
+        self.fd.write("$comment\n\t%s\n$end\n" % text)
+
     def writeWires(self):
         # Declare wires
         self.fd.write("$scope module lac $end\n")
         self.fd.write("$var wire 8 P probe[7:0] $end\n")
+        for signal in self.signals:
+            self.fd.write("$var wire %i %s %s $end\n" % (signal.width, signal.code, signal.declaration()))
         self.fd.write("$enddefinitions $end\n")
 
     def close(self):
@@ -595,10 +3011,38 @@ class VCDWriter(object):
         self.fd.write("#%i\n" % (i))
     
     def putBinary(self,c):
-        self.fd.write("%s P\n" % binary(c))
+        self.fd.write(VCDWriter.BINARY[c])
+
+    def putSamples(self, data, start=0):
+        """write a whole capture, VCD only needs the value changes plus
+           the final step to mark the end of the capture
+        """
+        table = VCDWriter.BINARY
+        if not self.signals:
+            lines = ["#%i\n%s" % (start + i, table[data[i]]) for i in value_changes(data)]
+            lines.append("#%i\n" % (start + len(data)))
+            self.fd.write("".join(lines))
+            return
+        changes = [(i, table[data[i]]) for i in value_changes(data)]
+        for signal in self.signals:
+            levels = signal.levels(data)
+            formats = signal.formats
+            changes += [(i, formats[levels[i]]) for i in value_changes(levels)]
+        changes.sort(key=lambda change: change[0])
+        lines = []
+        step = None
+        for i, line in changes:
+            if i != step:
+                lines.append("#%i\n" % (start + i))
+                step = i
+            lines.append(line)
+        lines.append("#%i\n" % (start + len(data)))
+        self.fd.write("".join(lines))
     
 class Lm32Lac(LM32Serial):
 
+    CMD_ARM = struct.Struct(">5B")
+    PROFILED = ("disarm", "arm", "getSize", "read", "get")
 
     def setup(self,select,trigger,triggermask):
         print "Select Probe: 0x%02x Trigger: 0x%02x Mask: 0x%02x" % ( select, trigger, triggermask)
@@ -607,31 +3051,39 @@ class Lm32Lac(LM32Serial):
         self.triggermask = triggermask
 
     def disarm(self):
-        for i in range(0,6):
-            self.put_uint8(0x00)
+        self.wire.send("\x00" * 6)
     
-    def arm(self): 
-        self.put_uint8(0x01)
-        self.put_uint8(self.select)
-        self.put_uint8(self.trigger)
-        self.put_uint8(self.triggermask)
-        self.put_uint8(0x00)
-        print "LAC armed; waiting for trigger condition..."
-
-    def getSize(self):
-        size = self.get_uint8()
-        self.size = 1 << size
+    def arm(self, verbose=True): 
+        self.wire.send(Lm32Lac.CMD_ARM.pack(0x01, self.select, self.trigger, self.triggermask, 0x00))
+        if verbose:
+            print "LAC armed; waiting for trigger condition..."
+
+    def getSize(self, timeout=None):
+        """wait for the size byte, which only arrives once the trigger
+           condition was met. Reads time out after READ_TIMEOUT, so the
+           wait is explicit: forever or for timeout seconds.
+        """
+        deadline = timeout is not None and time.time() + timeout
+        size = ""
+        while not size:
+            size = self.io.read(1)
+            if not size and deadline and time.time() > deadline:
+                raise serial.SerialTimeoutException("No trigger within %.1f s" % timeout)
+        self.received += 1
+        self.size = 1 << ord(size)
+
+    def read(self):
+        self.samples = bytearray(self.size)
+        self.read_into(memoryview(self.samples))
+        return self.samples
 
     def get(self,vcd):
         print "TRIGGERED -- Reading 0x%x bytes..." % self.size
-        for i in range(0,self.size):
-            c =  self.get_uint8()
-            vcd.putStep(i)
-            vcd.putBinary(c)
+        vcd.putSamples(self.read())
 
 
-def lac(options):
-
+def lac_options(options):
+    """trigger setup, timescale and the decoding config of the lac action"""
     try:
         select = int(options.lac_select,16)
         trigger = int(options.lac_trigger,16)
@@ -639,9 +3091,35 @@ def lac(options):
         timescale = options.lac_timescale
     except:
         die("Need values for SELECT TRIGGER TRIGGERMASK")
+
+    signals, decoders, period = [], [], None
+    if options.filename_lac_config:
+        try:
+            signals, decoders = load_lac_config(options.filename_lac_config)
+            period = timescale_seconds(timescale)
+        except (IOError, ValueError, KeyError, TypeError), e:
+            die("Can't use lac config %s: %s" % (options.filename_lac_config, e))
+    return select, trigger, triggermask, timescale, signals, decoders, period
+
+def write_transactions(filename, samples, signals, decoders, period):
+    try:
+        transactions = decode_capture(samples, signals, decoders, period)
+    except ValueError, e:
+        die(str(e))
+    fd = open(filename, "w")
+    for sample, decoder, text in transactions:
+        fd.write("%10i %-9s %s\n" % (sample, decoder, text))
+    fd.close()
+    return len(transactions)
+
+def lac(options):
+
+    select, trigger, triggermask, timescale, signals, decoders, period = lac_options(options)
+    if options.lac_continuous:
+        return lac_continuous(options, select, trigger, triggermask, timescale, signals, decoders, period)
     
     try:
-        vcd = VCDWriter(options.filename_vcd,timescale)
+        vcd = VCDWriter(options.filename_vcd,timescale,signals)
     except:
         die("Can't open output file %s" % options.filename_vcd)
 
@@ -662,16 +3140,89 @@ def lac(options):
     vcd.close()
     lac.close()
 
+    if decoders:
+        filename = options.filename_lac_log or os.path.splitext(options.filename_vcd)[0] + ".log"
+        count = write_transactions(filename, lac.samples, signals, decoders, period)
+        print "Decoded %i transactions to %s" % (count, filename)
+
+def lac_continuous(options, select, trigger, triggermask, timescale, signals, decoders, period):
+    """re-arm right after every readout and write the captures to a
+       rotating set of numbered files while the lac waits for the next
+       trigger. Every trigger is listed with its host time and the dead
+       time from the trigger notification to the re-arm in an .idx file.
+    """
+    base, ext = os.path.splitext(options.filename_vcd)
+    try:
+        index = open(base + ".idx", "a")
+    except IOError, e:
+        die("Can't open capture index %s.idx: %s" % (base, e))
+    try:
+        lac = Lm32Lac(options.port, options.baudrate)
+    except:
+        die("Can't open serial port")
+
+    lac.setup(select, trigger, triggermask)
+    lac.disarm()
+    lac.arm()
+    print "Capturing continuously, Ctrl+C stops..."
+    dead = []
+    started = time.time()
+    try:
+        while not options.lac_captures or len(dead) < options.lac_captures:
+            lac.getSize()
+            triggered = time.time()
+            samples = lac.read()
+            last = len(dead) + 1 == options.lac_captures
+            if not last:
+                lac.arm(False)
+            dead.append(time.time() - triggered)
+
+            n = len(dead) - 1
+            slot = n
+            if options.lac_rotate:
+                slot = n % options.lac_rotate
+            filename = "%s_%04i%s" % (base, slot, ext)
+            vcd = VCDWriter(filename, timescale, signals)
+            vcd.writeHeader(triggered)
+            vcd.writeComment("capture %i triggered at %.6f" % (n, triggered))
+            vcd.writeWires()
+            vcd.putSamples(samples)
+            vcd.close()
+            if decoders:
+                write_transactions(os.path.splitext(filename)[0] + ".log", samples, signals, decoders, period)
+            index.write("%i\t%.6f\t%s\t%.6f\n" % (n, triggered, filename, dead[-1]))
+            index.flush()
+    except KeyboardInterrupt:
+        lac.disarm()
+    elapsed = time.time() - started
+    index.close()
+    lac.close()
+
+    if dead:
+        print "%i captures in %.1f s, %.2f captures/s" % (len(dead), elapsed, len(dead) / elapsed)
+        print "Dead time trigger to re-arm: mean %.1f ms, max %.1f ms" % (
+            1000 * sum(dead) / len(dead), 1000 * max(dead))
+
+
+def record_options(options):
+    try:
+        return int(options.segment_size,16)
+    except ValueError:
+        die("Cannot convert segment size %s to hex" % options.segment_size)
 
 def mterm(options):
 
+    recorder = None
+    if options.record_dir:
+        recorder = LogRecorder(options.record_dir, record_options(options))
     try:
         miniterm = Miniterm(
             options.port,
             options.baudrate,
             "N",
             False,
-            False
+            False,
+            recorder=recorder
         )
     except serial.SerialException, e:
         sys.stderr.write("could not open port %r: %s\n" % (port, e))
@@ -691,9 +3242,365 @@ def mterm(options):
         key_description('\x08'),
     ))
 
+    console.setup()
+    sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
     miniterm.start()
     miniterm.join(True)
 
+def profile_report(options):
+    if options.profile:
+        profile.report()
+    if options.filename_profile:
+        profile.save_json(options.filename_profile)
+    if options.filename_trace:
+        profile.save_trace(options.filename_trace)
+
+def mconsole(options):
+    """console on all --fleet ports at once"""
+    ports = fleet_ports(options.fleet)
+    if not ports:
+        die("No serial ports match %s" % options.fleet)
+    recorders = None
+    if options.record_dir:
+        # one recording per port, in a directory named after it
+        segment_size = record_options(options)
+        recorders = [LogRecorder(os.path.join(options.record_dir, port.replace("/dev/", "", 1).replace("/", "_")),
+            segment_size) for port in ports]
+    try:
+        multiconsole = MultiConsole(ports, options.baudrate, recorders=recorders)
+    except serial.SerialException, e:
+        sys.stderr.write("could not open ports: %s\n" % e)
+        sys.exit(1)
+
+    sys.stderr.write('--- Console on %s ---\n' % ", ".join(
+        "%i:%s" % (i + 1, name) for i, name in enumerate(multiconsole.names)))
+    sys.stderr.write('--- Quit: %s  |  Focus: %s followed by the port number or n ---\n' % (
+        key_description(EXITCHARCTER),
+        key_description(MENUCHARACTER),
+    ))
+
+    console.setup()
+    sys.exitfunc = cleanup_console      #terminal modes have to be restored on exit...
+    multiconsole.run()
+
+def query(options):
+    """print recorded lines by time range and regular expression"""
+    if not options.record_dir or not os.path.isdir(options.record_dir):
+        die("Need a --record directory to query")
+    try:
+        start = options.query_from and parse_time(options.query_from)
+        end = options.query_to and parse_time(options.query_to)
+    except ValueError, e:
+        die("Cannot parse time: %s" % e)
+    pattern = None
+    if options.query_grep:
+        try:
+            pattern = re.compile(options.query_grep, re.MULTILINE)
+        except re.error, e:
+            die("Bad regular expression %s: %s" % (options.query_grep, e))
+    for stamp, line in query_log(options.record_dir, start, end, pattern):
+        print format_time(stamp), line
+
+SESSION_SOCKET = os.path.join(ImageCache.PATH, "session.sock")
+SESSION_OPS = ("upload", "dump", "jump", "memcheck", "console")
+
+
+class SessionClient(object):
+    """One connection to the session daemon. Messages are JSON lines:
+       {"out": text} for output, {"console": true} before the connection
+       turns into a raw byte pipe, {"done": ok} at the end.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def send(self, **message):
+        with self.lock:
+            try:
+                self.conn.sendall(json.dumps(message) + "\n")
+            except socket.error:
+                pass
+
+    def finish(self, ok):
+        self.send(done=ok)
+        self.finished.set()
+
+
+class SessionOutput(object):
+    """sys.stdout of the daemon: what a board worker prints goes to the
+       client it serves, everything else to the real stdout
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, data):
+        client = getattr(self.local, "client", None)
+        if client is None:
+            self.stdout.write(data)
+        else:
+            client.send(out=data)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+class BoardSession(object):
+    """A port owned by the daemon. Its LM32Serial stays open between
+       requests, which run one after the other in the worker thread.
+       ready is cleared once the board may have left the bootloader.
+    """
+
+    def __init__(self, port, output):
+        self.port = port
+        self.output = output
+        self.queue = Queue.Queue()
+        self.lm32 = None
+        self.ready = False
+        worker = threading.Thread(target=self.worker)
+        worker.setDaemon(1)
+        worker.start()
+
+    def worker(self):
+        while True:
+            options, client = self.queue.get()
+            self.output.local.client = client
+            ok = False
+            try:
+                getattr(self, options.action)(options, client)
+                ok = True
+            except SystemExit:
+                # die() has printed the reason already
+                pass
+            except Exception, e:
+                print "Error: %s" % e
+                self.ready = False
+            self.output.local.client = None
+            client.finish(ok)
+
+    def open(self, options):
+        if self.lm32 is None:
+            try:
+                self.lm32 = LM32Serial(self.port, options.baudrate)
+            except serial.SerialException, e:
+                die("Can't open serial port: %s" % e)
+        return self.lm32
+
+    def alive(self):
+        lm32 = self.lm32
+        try:
+            if lm32.packets:
+                lm32.packets.checksum(0, 0)
+                return True
+            return lm32.ping()
+        except serial.SerialException:
+            return False
+
+    def board(self, options):
+        """the open LM32Serial with the bootloader in charge"""
+        lm32 = self.open(options)
+        if self.ready and self.alive():
+            return lm32
+        # after a reset the bootloader is back at the base rate
+        lm32.packets = None
+        lm32.io.baudrate = lm32.base_baud
+        lm32.io.flushInput()
+        lm32.find_bootloader(max_baud=options.max_baud, packets=options.packets)
+        self.ready = True
+        return lm32
+
+    def upload(self, options, client):
+        max_extent, block_size = upload_options(options)
+        lm32 = self.board(options)
+        try:
+            segments, addr_jump = load_image(options.filename_srec)
+        except (IOError, ValueError), e:
+            die(str(e))
+        self.ready = False
+        with segments:
+            if not flash(lm32, self.port, segments, addr_jump, max_extent, block_size, options):
+                die("Upload verification failed")
+
+    def dump(self, options, client):
+        dump_board(self.board(options), options)
+
+    def jump(self, options, client):
+        try:
+            addr = int(options.start_addr,16)
+        except:
+            die("Faulty address %s" % options.start_addr)
+        lm32 = self.board(options)
+        self.ready = False
+        lm32.jump(addr)
+
+    def memcheck(self, options, client):
+        generate, base, size, block_size = memcheck_options(options)
+        print "Memcheck addr=0x%X size=0x%X pattern=%s" % (base,size,options.pattern)
+        result = run_memcheck(self.board(options), generate, base, size, block_size, options)
+        result.report()
+
+    def console(self, options, client):
+        """relay between the client and the port until the client leaves"""
+        lm32 = self.open(options)
+        self.ready = False
+        if lm32.packets:
+            try:
+                lm32.leave_packet_mode()
+            except serial.SerialException:
+                pass
+        io = lm32.io
+        client.send(console=True)
+        stop = threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                data = io.read(io.inWaiting() or 1)
+                if data:
+                    try:
+                        client.conn.sendall(data)
+                    except socket.error:
+                        break
+
+        thread = threading.Thread(target=reader)
+        thread.setDaemon(1)
+        thread.start()
+        try:
+            while True:
+                data = client.conn.recv(0x1000)
+                if not data:
+                    break
+                io.write(data)
+        except socket.error:
+            pass
+        stop.set()
+        thread.join()
+
+
+def session_daemon(options):
+    """own the serial ports and serve SESSION_OPS on a Unix socket"""
+    path = options.session_socket
+    make_dirs(os.path.dirname(path))
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(8)
+    output = SessionOutput(sys.stdout)
+    sys.stdout = output
+    sessions = {}
+    lock = threading.Lock()
+    # the port -d auto found first, later auto requests stay on it
+    auto = []
+    output.stdout.write("Serving board sessions on %s\n" % path)
+
+    def reject(client, conn, msg):
+        client.send(out=msg + "\n")
+        client.finish(False)
+        conn.close()
+
+    def serve(conn):
+        client = SessionClient(conn)
+        try:
+            request = json.loads(conn.makefile("r").readline())
+            options = optparse.Values(dict((str(k), v) for k, v in request.items()))
+            if options.action not in SESSION_OPS:
+                raise ValueError("unknown operation %s" % options.action)
+        except (ValueError, TypeError, AttributeError), e:
+            reject(client, conn, "Bad request: %s" % e)
+            return
+        with lock:
+            if options.port == 'auto':
+                if not auto:
+                    # the ports of open sessions are busy, don't probe them
+                    found = discover(options, first=True, skip=sessions.keys())
+                    if not found:
+                        reject(client, conn, "No soc-lm32 bootloader answered on any port")
+                        return
+                    auto.append(found[0][0])
+                options.port = auto[0]
+            if options.port not in sessions:
+                sessions[options.port] = BoardSession(options.port, output)
+            session = sessions[options.port]
+        session.queue.put((options, client))
+        client.finished.wait()
+        conn.close()
+
+    try:
+        while True:
+            conn, peer = server.accept()
+            thread = threading.Thread(target=serve, args=(conn,))
+            thread.setDaemon(1)
+            thread.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
+
+def session_call(options, action):
+    """run action through the session daemon, True when it succeeded"""
+    request = dict(vars(options), action=action)
+    for name in ("filename_srec", "filename_dump", "filename_elf"):
+        if request.get(name):
+            request[name] = os.path.abspath(request[name])
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(options.session_socket)
+    except socket.error, e:
+        die("No session daemon on %s: %s" % (options.session_socket, e))
+    conn.sendall(json.dumps(request) + "\n")
+    replies = conn.makefile("r", 0)
+    for line in iter(replies.readline, ""):
+        message = json.loads(line)
+        if "out" in message:
+            sys.stdout.write(message["out"])
+            sys.stdout.flush()
+        elif message.get("console"):
+            session_console(conn)
+            return True
+        elif "done" in message:
+            return message["done"]
+    return False
+
+def session_console(conn):
+    """terminal on a console relayed by the daemon"""
+    sys.stderr.write('--- Session console --- Quit: %s ---\n' % key_description(EXITCHARCTER))
+    console.setup()
+    sys.exitfunc = cleanup_console
+
+    def reader():
+        while True:
+            data = conn.recv(0x1000)
+            if not data:
+                break
+            sys.stdout.write(data)
+            sys.stdout.flush()
+
+    thread = threading.Thread(target=reader)
+    thread.setDaemon(1)
+    thread.start()
+    while True:
+        c = console.getkey()
+        if c == EXITCHARCTER or not c:
+            break
+        conn.sendall(c == '\n' and '\r\n' or c)
+    conn.close()
+
+def session(options):
+    """thin client: the action and the console run in the daemon"""
+    ok = True
+    if options.action in SESSION_OPS:
+        ok = session_call(options, options.action)
+    elif options.action is not None:
+        die("Action %s does not run in a session, use one of %s" % (options.action, ",".join(SESSION_OPS[:-1])))
+    if ok and options.miniterm:
+        ok = session_call(options, "console")
+    if not ok:
+        sys.exit(-1)
+
 def debugger(options):
     fd = open("remote.gdb","w")
     fd.write("target remote %s\n" % options.port)
@@ -705,7 +3612,6 @@ def debugger(options):
         os.unlink("remote.gdb")
         
 def main():
-    import optparse
 
     parser = optparse.OptionParser(
         usage = "%prog [options]",
@@ -714,7 +3620,7 @@ def main():
 
     parser.add_option("-d", "--device",
         dest = "port",
-        help = "Set device (Default: %default)",
+        help = "Set device, 'auto' for the first bootloader that answers (Default: %default)",
         default = "/dev/ttyUSB0"
     )
 
@@ -726,10 +3632,89 @@ def main():
         default = 115200
     )
 
+    parser.add_option("", "--fleet",
+        dest = "fleet",
+        action = "store",
+        help = "Run upload or memcheck on a comma separated list of devices or globs, e.g. '/dev/ttyUSB*', 'auto' for all bootloaders found",
+        default = None
+    )
+
+    parser.add_option("", "--probe",
+        dest = "probe",
+        action = "store",
+        help = "Comma separated devices or globs to probe besides %s, e.g. socket://host:port" % ",".join(PROBE_PORTS),
+        default = None
+    )
+
+    parser.add_option("", "--daemon",
+        dest = "daemon",
+        action = "store_true",
+        help = "Keep the boards open and serve upload,dump,jump,memcheck and consoles on the session socket",
+        default = False
+    )
+
+    parser.add_option("", "--session",
+        dest = "session",
+        action = "store_true",
+        help = "Run the action and -m through the session daemon instead of opening the port",
+        default = False
+    )
+
+    parser.add_option("", "--session-socket",
+        dest = "session_socket",
+        action = "store",
+        help = "Unix socket of the session daemon (Default: %default)",
+        default = SESSION_SOCKET
+    )
+
+    parser.add_option("-j", "--jobs",
+        dest = "jobs",
+        action = "store",
+        type = 'int',
+        help = "Boards handled in parallel in fleet mode, 0 for all (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--max-baud",
+        dest = "max_baud",
+        action = "store",
+        type = 'int',
+        help = "Negotiate up to this baud rate with the bootloader, 0 keeps --baud (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--packets",
+        dest = "packets",
+        action = "store_true",
+        help = "Use the framed protocol with CRCs and retransmits when the bootloader has it",
+        default = False
+    )
+
+    parser.add_option("", "--profile",
+        dest = "profile",
+        action = "store_true",
+        help = "Print a per command timing summary after the action",
+        default = False
+    )
+
+    parser.add_option("", "--profile-json",
+        dest = "filename_profile",
+        action = "store",
+        help = "Write the profile summary and events as JSON to this file",
+        default = None
+    )
+
+    parser.add_option("", "--profile-trace",
+        dest = "filename_trace",
+        action = "store",
+        help = "Write the profile as Chrome trace (chrome://tracing, Perfetto) to this file",
+        default = None
+    )
+
     parser.add_option("-f","--filename",
         dest = "filename_srec",
         action = "store",
-        help = "Set srec image filename for serial upload",
+        help = "Set srec, Intel HEX or elf image filename for serial upload",
         default = ''
     )
 
@@ -740,10 +3725,53 @@ def main():
         default = ''
     )
 
+    parser.add_option("", "--impact",
+        dest = "bin_impact",
+        action = "store",
+        help = "impact executable used to generate SVF files (Default: %default)",
+        default = "impact"
+    )
+
+    parser.add_option("", "--jtag",
+        dest = "bin_jtag",
+        action = "store",
+        help = "urjtag executable used to program bitstreams (Default: %default)",
+        default = "jtag"
+    )
+
+    parser.add_option("", "--tool-timeout",
+        dest = "tool_timeout",
+        action = "store",
+        type = 'int',
+        help = "Seconds impact and jtag may run (Default: %default)",
+        default = UrjtagUploader.TIMEOUT
+    )
+
     parser.add_option("-a", "--action",
         dest = "action",
         action = "store",
-        help = "Select mode [bitstream,lac,memcheck,upload,jump])",
+        help = "Select mode [bitstream,lac,memcheck,upload,dump,jump,query,bram,discover])",
+        default = None
+    )
+
+    parser.add_option("", "--board",
+        dest = "board",
+        action = "store",
+        help = "Board directory or its system.v to take the BRAM layout from",
+        default = None
+    )
+
+    parser.add_option("", "--bram",
+        dest = "bram",
+        action = "store",
+        help = "wb_bram instance to initialize (Default: the first with a mem_file_name)",
+        default = None
+    )
+
+    parser.add_option("", "--bram-file",
+        dest = "filename_bram",
+        action = "store",
+        help = "Write the BRAM image here instead of the mem_file_name of the board",
         default = None
     )
 
@@ -757,24 +3785,124 @@ def main():
     parser.add_option("-S", "--size",
         dest = "size",
         action = "store",
-        help = "Set size for memchecks (Default: %default)",
+        help = "Set size for memchecks and dumps (Default: %default)",
         default = "0x8000"
     )
 
     parser.add_option("-B", "--blocksize",
         dest = "block_size",
         action = "store",
-        help = "Set block size for memchecks (Default: %default)",
+        help = "Set block size for memchecks, dumps and delta uploads (Default: %default)",
         default = "0x800"
     )
 
+    parser.add_option("", "--delta",
+        dest = "delta",
+        action = "store_true",
+        help = "Only upload blocks that changed since the last upload through this port",
+        default = False
+    )
+
+    parser.add_option("-z", "--compress",
+        dest = "compress",
+        action = "store_true",
+        help = "Send uploads LZSS compressed",
+        default = False
+    )
+
+    parser.add_option("", "--verify",
+        dest = "verify",
+        action = "store_true",
+        help = "Verify uploads with on-target checksums",
+        default = False
+    )
+
+    parser.add_option("-p", "--pattern",
+        dest = "pattern",
+        action = "store",
+        help = "Set memcheck pattern [%s] (Default: %%default)" % ",".join(sorted(PATTERNS)),
+        default = "random"
+    )
+
+    parser.add_option("", "--seed",
+        dest = "seed",
+        action = "store",
+        type = 'int',
+        help = "Set seed for the prng memcheck pattern (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--stream",
+        dest = "stream",
+        action = "store_true",
+        help = "Run memchecks block by block, verifying while the next block is transferred",
+        default = False
+    )
+
+    parser.add_option("", "--max-errors",
+        dest = "max_errors",
+        action = "store",
+        type = 'int',
+        help = "Abort streaming memchecks after this many errors, 0 never aborts (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("-x", "--extent",
+        dest = "max_extent",
+        action = "store",
+        help = "Set max extent size for srec uploads, 0 for unlimited (Default: %default)",
+        default = "0x10000"
+    )
+
+    parser.add_option("-o", "--output",
+        dest = "filename_dump",
+        action = "store",
+        help = "Set output filename for memory dumps (Default: %default)",
+        default = "dump.bin"
+    )
+
     parser.add_option("-m", "--miniterm",
         dest = "miniterm",
         action = "store_true",
-        help = "Start miniterm after action",
+        help = "Start miniterm after action, on all --fleet ports at once if given",
         default = False
     )
 
+    parser.add_option("", "--record",
+        dest = "record_dir",
+        action = "store",
+        help = "Record everything miniterm receives with timestamps into this directory, read back with --action query",
+        default = None
+    )
+
+    parser.add_option("", "--segment-size",
+        dest = "segment_size",
+        action = "store",
+        help = "Start a new recording segment after this many bytes in hex (Default: %default)",
+        default = "0x4000000"
+    )
+
+    parser.add_option("", "--from",
+        dest = "query_from",
+        action = "store",
+        help = "Query recorded lines from this time, epoch seconds, 'YYYY-mm-dd HH:MM:SS' or 'HH:MM:SS' today",
+        default = None
+    )
+
+    parser.add_option("", "--to",
+        dest = "query_to",
+        action = "store",
+        help = "Query recorded lines up to this time",
+        default = None
+    )
+
+    parser.add_option("", "--grep",
+        dest = "query_grep",
+        action = "store",
+        help = "Query only recorded lines matching this regular expression",
+        default = None
+    )
+
     parser.add_option("-D", "--debugger",
         dest = "debugger",
         action = "store_true",
@@ -785,7 +3913,7 @@ def main():
     parser.add_option("-e", "--elf",
         dest = "filename_elf",
         action = "store",
-        help = "Set elf filename for debugger",
+        help = "Set elf filename for debugger, and for serial upload without -f",
         default = False
     )
 
@@ -824,26 +3952,106 @@ def main():
         default = None
     )
 
+    parser.add_option("", "--continuous",
+        dest = "lac_continuous",
+        action = "store_true",
+        help = "Re-arm the la after every capture and write numbered .vcd files",
+        default = False
+    )
+
+    parser.add_option("", "--captures",
+        dest = "lac_captures",
+        action = "store",
+        type = 'int',
+        help = "Stop continuous captures after this many triggers, 0 runs until Ctrl+C (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--rotate",
+        dest = "lac_rotate",
+        action = "store",
+        type = 'int',
+        help = "Number of files continuous captures rotate through, 0 keeps all (Default: %default)",
+        default = 16
+    )
+
+    parser.add_option("", "--lac-config",
+        dest = "filename_lac_config",
+        action = "store",
+        help = "JSON file naming probe bits and decoders (uart, spi, wishbone) for the la",
+        default = None
+    )
+
+    parser.add_option("", "--lac-log",
+        dest = "filename_lac_log",
+        action = "store",
+        help = "Decoded transaction log of the la (Default: the .vcd name with .log)",
+        default = None
+    )
+
     (options, args) = parser.parse_args()
-    if options.action =='bitstream':
-        if options.filename_bitstream is None:
-            parser.error("Need to specify a bitstream filename")
-        bitstream(options)
-    elif options.action =='jump':
-        jump(options)
-    elif options.action =='memcheck':
-        memcheck(options)
-    elif options.action =='lac':
-        if options.filename_vcd is None:
-            parser.error("Need to specify a .vcd filename")
-        lac(options)
-    elif options.action =='upload':
-        if options.filename_srec is None:
-            parser.error("Need to specify a .srec filename")
-        if not os.path.isfile(options.filename_srec):
-            parser.error("Can't access  srec file %s" % options.filename_srec)
-        upload(options)
-    if options.miniterm:
+    if options.action in ('upload', 'bram') and not options.filename_srec and options.filename_elf:
+        options.filename_srec = options.filename_elf
+    if options.action == 'discover':
+        list_boards(options)
+        return
+    # the daemon resolves -d auto itself, it may hold the ports already
+    if options.port == 'auto' and not (options.daemon or options.session):
+        options.port = discover_port(options)
+    if options.fleet == 'auto' and not (options.daemon or options.session):
+        options.fleet = ",".join(port for port, seconds in discover(options))
+    if options.daemon:
+        session_daemon(options)
+        return
+    if options.session:
+        session(options)
+        return
+    global profile
+    if options.profile or options.filename_profile or options.filename_trace:
+        profile = ProtocolProfile()
+    try:
+        if options.fleet and options.action in ('upload', 'memcheck'):
+            if options.action == 'upload' and not os.path.isfile(options.filename_srec):
+                parser.error("Can't access image file %s" % options.filename_srec)
+            fleet(options)
+        elif options.action =='bitstream':
+            if options.filename_bitstream is None:
+                parser.error("Need to specify a bitstream filename")
+            bitstream(options)
+        elif options.action =='jump':
+            jump(options)
+        elif options.action =='memcheck':
+            memcheck(options)
+        elif options.action =='bram':
+            if not options.filename_srec:
+                parser.error("Need to specify a .srec, .hex or .elf filename")
+            if not os.path.isfile(options.filename_srec):
+                parser.error("Can't access image file %s" % options.filename_srec)
+            if options.board is None:
+                parser.error("Need to specify a board directory or system.v")
+            bram(options)
+        elif options.action =='dump':
+            dump(options)
+        elif options.action =='query':
+            query(options)
+        elif options.action =='lac':
+            if options.filename_vcd is None:
+                parser.error("Need to specify a .vcd filename")
+            lac(options)
+        elif options.action =='upload':
+            if not options.filename_srec:
+                parser.error("Need to specify a .srec or .elf filename")
+            if not os.path.isfile(options.filename_srec):
+                parser.error("Can't access image file %s" % options.filename_srec)
+            upload(options)
+    except BootloaderNotFound, e:
+        die(str(e))
+    finally:
+        if profile is not None:
+            profile_report(options)
+    if options.miniterm and options.fleet:
+        mconsole(options)
+    elif options.miniterm:
         mterm(options)
     
     if options.debugger:
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+lm32emu - host side emulation of the soc-lm32 boot0-serial bootloader and
+the logic analyzer component (lac), to run lm32client without a board.
+
+The emulator is served on a pseudo terminal (the slave path is printed on
+startup) or on a TCP port which pyserial opens as socket://host:port.
+"""
+import sys
+import os
+import tty
+import errno
+import socket
+import struct
+import random
+import time
+import zlib
+
+LZ_N = 4096
+LZ_F = 18
+LZ_THRESHOLD = 2
+
+
+class LinkClosed(Exception):
+    pass
+
+
+class Link(object):
+    """Byte stream to the host. With a baud rate set every byte costs ten
+       bit times in its direction, like a 8N1 UART would. With noise set
+       that is the chance of a flipped bit per byte.
+    """
+
+    def __init__(self, recv, send, baud=0, noise=0.0):
+        self.recv = recv
+        self.send = send
+        self.baud = baud
+        self.noise = noise
+        self.buf = bytearray()
+        self.rx_time = 0.0
+        self.tx_time = 0.0
+
+    def throttle(self, size, last):
+        if not self.baud:
+            return last
+        now = time.time()
+        last = max(now, last) + size * 10.0 / self.baud
+        if last > now:
+            time.sleep(last - now)
+        return last
+
+    def garble(self, data):
+        if not self.noise:
+            return data
+        data = bytearray(data)
+        for i in range(len(data)):
+            if random.random() < self.noise:
+                data[i] ^= 1 << random.randrange(8)
+        return str(data)
+
+    def fill(self, timeout=None):
+        data = self.recv(0x10000, timeout)
+        if data is None:
+            return False
+        if not data:
+            raise LinkClosed()
+        self.buf += data
+        return True
+
+    def read(self, size, timeout=None):
+        """read exactly size bytes, None when timeout (seconds) passed first"""
+        deadline = timeout is not None and time.time() + timeout
+        while len(self.buf) < size:
+            left = None
+            if deadline:
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+            self.fill(left)
+        data = str(self.buf[:size])
+        del self.buf[:size]
+        self.rx_time = self.throttle(size, self.rx_time)
+        return self.garble(data)
+
+    def read_uint32(self):
+        return struct.unpack(">I", self.read(4))[0]
+
+    def write(self, data):
+        self.tx_time = self.throttle(len(data), self.tx_time)
+        self.send(self.garble(data))
+
+
+class Bootloader(object):
+    """boot0-serial command loop on top of a Link"""
+
+    BANNER = "**soc-lm32/bootloader** > \r\n"
+    RAM_BASE = 0x40000000
+    RAM_SIZE = 0x1000000
+    BAUD_PROBE = "".join(chr((i * 0x1d + 0x55) & 0xff) for i in range(64))
+    BAUD_TIMEOUT = 0.1
+    PKT_SOF = '\xa5'
+    PKT_HEADER = struct.Struct(">cBII")
+    PKT_WINDOW = 4
+    PKT_MAX = 1024
+    PKT_TIMEOUT = 0.02
+    PKT_LINGER = 0.5
+
+    def __init__(self, max_baud=0, verbose=False):
+        self.ram = bytearray(Bootloader.RAM_SIZE)
+        self.max_baud = max_baud
+        self.verbose = verbose
+        self.commands = {
+            'u': self.upload,
+            'd': self.download,
+            'z': self.upload_compressed,
+            'c': self.checksum,
+            'b': self.baudrate,
+            'p': self.packet_mode,
+            'g': self.jump,
+        }
+
+    def log(self, msg):
+        if self.verbose:
+            sys.stderr.write("bootloader: %s\n" % msg)
+
+    def window(self, addr, size):
+        """offsets of [addr, addr+size) clipped to the emulated RAM"""
+        start = min(max(addr - Bootloader.RAM_BASE, 0), Bootloader.RAM_SIZE)
+        end = min(max(addr + size - Bootloader.RAM_BASE, 0), Bootloader.RAM_SIZE)
+        return start, end
+
+    def peek(self, addr, size):
+        start, end = self.window(addr, size)
+        data = bytearray(size)
+        skip = start - (addr - Bootloader.RAM_BASE)
+        data[skip:skip + end - start] = self.ram[start:end]
+        return str(data)
+
+    def poke(self, addr, data):
+        start, end = self.window(addr, len(data))
+        skip = start - (addr - Bootloader.RAM_BASE)
+        self.ram[start:end] = data[skip:skip + end - start]
+
+    def serve(self, link):
+        # the startup banner of the firmware is lost before a host attaches,
+        # sending it here would leave a stale line behind the first ping
+        while True:
+            c = link.read(1)
+            handler = self.commands.get(c)
+            if handler is None:
+                link.write(Bootloader.BANNER)
+            else:
+                handler(link)
+
+    def upload(self, link):
+        addr = link.read_uint32()
+        size = link.read_uint32()
+        self.log("upload 0x%08x (%i)" % (addr, size))
+        self.poke(addr, link.read(size))
+
+    def download(self, link):
+        addr = link.read_uint32()
+        size = link.read_uint32()
+        self.log("download 0x%08x (%i)" % (addr, size))
+        link.write(self.peek(addr, size))
+
+    def upload_compressed(self, link):
+        addr = link.read_uint32()
+        size = link.read_uint32()
+        self.log("upload_compressed 0x%08x (%i)" % (addr, size))
+        packed = bytearray(link.read(size))
+        out = bytearray()
+        pos = 0
+        flags = 0
+        while pos < size:
+            flags >>= 1
+            if not flags & 256:
+                flags = packed[pos] | 0xff00
+                pos += 1
+                if pos == size:
+                    break
+            if flags & 1:
+                out.append(packed[pos])
+                pos += 1
+            else:
+                if size - pos < 2:
+                    break
+                i, j = packed[pos], packed[pos + 1]
+                pos += 2
+                i |= (j & 0xf0) << 4
+                dist = (LZ_N - LZ_F + len(out) - i) & (LZ_N - 1) or LZ_N
+                for k in range((j & 0x0f) + LZ_THRESHOLD + 1):
+                    out.append(out[-dist] if len(out) >= dist else 0x20)
+        self.poke(addr, out)
+
+    def checksum(self, link):
+        addr = link.read_uint32()
+        size = link.read_uint32()
+        self.log("checksum 0x%08x (%i)" % (addr, size))
+        start, end = self.window(addr, size)
+        crc = zlib.crc32(buffer(self.ram, start, end - start)) & 0xffffffff
+        link.write(struct.pack(">I", crc))
+
+    def baudrate(self, link):
+        baud = link.read_uint32()
+        if baud == 0:
+            return
+        self.log("baudrate %i" % baud)
+        old = link.baud
+        link.write('b')
+        ok = not self.max_baud or baud <= self.max_baud
+        if ok and old:
+            link.baud = baud
+        for i in range(len(Bootloader.BAUD_PROBE)):
+            c = link.read(1, Bootloader.BAUD_TIMEOUT)
+            if c is None:
+                ok = False
+                break
+            if c != Bootloader.BAUD_PROBE[i]:
+                ok = False
+            # above the supported rate the echo comes back garbled
+            link.write(ok and c or chr(~ord(c) & 0xff))
+        if ok and link.read(1, Bootloader.BAUD_TIMEOUT) == 'K':
+            return
+        link.baud = old
+
+    def packet_reply(self, link, kind, seq, addr, size, data=None):
+        header = Bootloader.PKT_HEADER.pack(kind, seq, addr, size)
+        frame = Bootloader.PKT_SOF + header + struct.pack(">I", zlib.crc32(header) & 0xffffffff)
+        if data is not None:
+            frame += data + struct.pack(">I", zlib.crc32(data) & 0xffffffff)
+        link.write(frame)
+
+    def packet_read(self, link, size):
+        """size bytes followed by their CRC32, None when late or damaged"""
+        data = link.read(size, Bootloader.PKT_TIMEOUT)
+        check = link.read(4, Bootloader.PKT_TIMEOUT)
+        if data is None or check is None:
+            return None
+        if struct.unpack(">I", check)[0] != zlib.crc32(data) & 0xffffffff:
+            return None
+        return data
+
+    def packet_mode(self, link):
+        """framed protocol, see packet_mode() in boot0-serial/main.c"""
+        self.log("packet mode")
+        self.packet_reply(link, 'p', 0, Bootloader.PKT_WINDOW, Bootloader.PKT_MAX)
+        while True:
+            if link.read(1) != Bootloader.PKT_SOF:
+                continue
+            header = self.packet_read(link, Bootloader.PKT_HEADER.size)
+            if header is None:
+                continue
+            kind, seq, addr, size = Bootloader.PKT_HEADER.unpack(header)
+            if kind == 'u' and size <= Bootloader.PKT_MAX:
+                data = self.packet_read(link, size)
+                if data is not None:
+                    self.poke(addr, data)
+                    self.packet_reply(link, 'a', seq, addr, 0)
+                    continue
+            elif kind == 'd' and size <= Bootloader.PKT_MAX:
+                self.packet_reply(link, 'a', seq, addr, size, self.peek(addr, size))
+                continue
+            elif kind == 'c':
+                crc = zlib.crc32(self.peek(addr, size)) & 0xffffffff
+                self.packet_reply(link, 'a', seq, addr, 4, struct.pack(">I", crc))
+                continue
+            elif kind == 'q':
+                self.packet_reply(link, 'a', seq, addr, 0)
+                self.packet_linger(link)
+                self.log("plain mode")
+                return
+            self.log("nak %i" % seq)
+            self.packet_reply(link, 'n', seq, addr, size)
+
+    def packet_linger(self, link):
+        """answer repeated 'q' until the line was quiet for PKT_LINGER"""
+        while True:
+            c = link.read(1, Bootloader.PKT_LINGER)
+            if c is None:
+                return
+            if c != Bootloader.PKT_SOF:
+                continue
+            header = self.packet_read(link, Bootloader.PKT_HEADER.size)
+            if header is None:
+                continue
+            kind, seq, addr, size = Bootloader.PKT_HEADER.unpack(header)
+            if kind == 'q':
+                self.log("repeated q %i" % seq)
+                self.packet_reply(link, 'a', seq, addr, 0)
+
+    def jump(self, link):
+        addr = link.read_uint32()
+        self.log("jump 0x%08x, back in the bootloader" % addr)
+        sys.stderr.write("jump to 0x%08x\n" % addr)
+
+
+class LogicAnalyzer(object):
+    """lac command loop: after an arm command the capture is sent right
+       away as the depth exponent followed by 2**depth sample bytes.
+    """
+
+    CMD_ARM = 0x01
+
+    def __init__(self, depth=11, verbose=False):
+        self.depth = depth
+        self.verbose = verbose
+
+    def capture(self, select, seed):
+        """synthetic probe data: a counter with a slow serial frame on bit 0"""
+        rand = random.Random(seed)
+        size = 1 << self.depth
+        data = bytearray(size)
+        line = 1
+        for i in range(size):
+            if i % 16 == 0:
+                line = rand.getrandbits(1)
+            data[i] = ((i >> 4) & 0xfe) ^ select | line
+        return data
+
+    def serve(self, link):
+        captures = 0
+        while True:
+            c = ord(link.read(1))
+            if c != LogicAnalyzer.CMD_ARM:
+                continue
+            select, trigger, mask, pre = struct.unpack(">4B", link.read(4))
+            if self.verbose:
+                sys.stderr.write("lac: armed select 0x%02x trigger 0x%02x mask 0x%02x\n" % (select, trigger, mask))
+            link.write(chr(self.depth))
+            link.write(str(self.capture(select, captures)))
+            captures += 1
+
+
+def serve_pty(device, baud, noise=0.0):
+    """serve device on a new pseudo terminal until interrupted"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    # keeping the slave open lets hosts close and reopen it between runs
+    print os.ttyname(slave)
+    sys.stdout.flush()
+
+    def recv(size, timeout):
+        import select
+        if not select.select([master], [], [], timeout)[0]:
+            return None
+        return os.read(master, size)
+
+    def send(data):
+        while data:
+            n = os.write(master, data)
+            data = data[n:]
+
+    while True:
+        try:
+            device.serve(Link(recv, send, baud, noise))
+        except LinkClosed:
+            pass
+        except OSError, e:
+            if e.errno != errno.EIO:
+                raise
+            time.sleep(0.1)
+
+
+def serve_tcp(device, baud, host, port, noise=0.0):
+    """serve device to one socket:// client after the other"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    print "socket://%s:%i" % server.getsockname()
+    sys.stdout.flush()
+    while True:
+        conn, peer = server.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def recv(size, timeout):
+            conn.settimeout(timeout)
+            try:
+                return conn.recv(size)
+            except socket.timeout:
+                return None
+
+        try:
+            device.serve(Link(recv, conn.sendall, baud, noise))
+        except (LinkClosed, socket.error):
+            pass
+        conn.close()
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(
+        usage = "%prog [options]",
+        description = "lm32emu - Emulate the soc-lm32 bootloader or lac for lm32client"
+    )
+
+    parser.add_option("-m", "--mode",
+        dest = "mode",
+        action = "store",
+        help = "Emulated device [bootloader,lac] (Default: %default)",
+        default = "bootloader"
+    )
+
+    parser.add_option("-t", "--tcp",
+        dest = "tcp",
+        action = "store",
+        help = "Listen on [host:]port instead of a pty, connect with socket://host:port",
+        default = None
+    )
+
+    parser.add_option("-b", "--baud",
+        dest = "baudrate",
+        action = "store",
+        type = 'int',
+        help = "Throttle the link to this baud rate, 0 for full speed (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--max-baud",
+        dest = "max_baud",
+        action = "store",
+        type = 'int',
+        help = "Fastest baud rate the emulated UART accepts, 0 for any (Default: %default)",
+        default = 0
+    )
+
+    parser.add_option("", "--noise",
+        dest = "noise",
+        action = "store",
+        type = 'float',
+        help = "Chance of a bit error per byte in either direction (Default: %default)",
+        default = 0.0
+    )
+
+    parser.add_option("", "--seed",
+        dest = "seed",
+        action = "store",
+        type = 'int',
+        help = "Seed of the bit errors, for repeatable runs (Default: random)",
+        default = None
+    )
+
+    parser.add_option("", "--depth",
+        dest = "depth",
+        action = "store",
+        type = 'int',
+        help = "lac capture depth as power of two (Default: %default)",
+        default = 11
+    )
+
+    parser.add_option("-v", "--verbose",
+        dest = "verbose",
+        action = "store_true",
+        help = "Log every command to stderr",
+        default = False
+    )
+
+    (options, args) = parser.parse_args()
+
+    random.seed(options.seed)
+    if options.mode == "bootloader":
+        device = Bootloader(options.max_baud, options.verbose)
+    elif options.mode == "lac":
+        device = LogicAnalyzer(options.depth, options.verbose)
+    else:
+        parser.error("Unknown mode %s" % options.mode)
+
+    try:
+        if options.tcp:
+            host, _, port = options.tcp.rpartition(":")
+            serve_tcp(device, options.baudrate, host or "localhost", int(port), options.noise)
+        else:
+            serve_pty(device, options.baudrate, options.noise)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+lm32image - loading of srec, Intel HEX and ELF images for lm32client.
+
+Images end up as a SegmentMap of contiguous (addr, data) extents plus the
+start address. Parsed srec and Intel HEX files are cached under
+~/.lm32client/parsed, ELF segments are read-only views into the mmapped
+file.
+"""
+import os
+import sys
+import errno
+import glob
+import bisect
+import binascii
+import struct
+import mmap
+import hashlib
+
+
+def make_dirs(path):
+    """os.makedirs that is fine with path existing, fleet workers race here"""
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class SegmentMap(object):
+    """Collects (addr, data) records and merges adjacent or overlapping
+       records into contiguous extents. Later records win on overlap.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.segments = []
+        self.zeros = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, addr, data):
+        # empty data records are legal in srec and Intel HEX files
+        if not len(data):
+            return
+        # records of a file mostly continue the last segment
+        if self.starts and self.starts[-1] + len(self.segments[-1]) == addr:
+            self.segments[-1] += data
+            return
+        end = addr + len(data)
+        i = bisect.bisect_right(self.starts, addr) - 1
+        if i < 0 or self.starts[i] + len(self.segments[i]) < addr:
+            i += 1
+            self.starts.insert(i, addr)
+            self.segments.insert(i, bytearray())
+        start = self.starts[i]
+        seg = self.segments[i]
+        seg[addr - start:end - start] = data
+        # swallow following segments the grown one now touches
+        while i + 1 < len(self.starts) and self.starts[i + 1] <= start + len(seg):
+            nstart = self.starts.pop(i + 1)
+            nseg = self.segments.pop(i + 1)
+            tail = start + len(seg) - nstart
+            if tail < len(nseg):
+                seg += nseg[tail:]
+
+    def size(self):
+        return sum(len(seg) for seg in self.segments)
+
+    def freeze(self):
+        """make the map read-only so it can be shared between threads"""
+        self.segments = [bytes(seg) for seg in self.segments]
+        return self
+
+    def extents(self, max_size=0):
+        """yield (addr, memoryview) chunks of at most max_size bytes"""
+        for start, seg in zip(self.starts, self.segments):
+            view = memoryview(seg)
+            step = max_size or len(seg) or 1
+            for offset in range(0, len(seg), step):
+                yield start + offset, view[offset:offset + step]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ElfImage(SegmentMap):
+    """PT_LOAD segments of a 32 bit ELF file as read-only memoryviews into
+       the mmapped file. The part of a segment beyond its file size (.bss)
+       is listed in zeros instead. Segments that touch are merged like in
+       SegmentMap, into one view when they are contiguous in the file too.
+       The views are only valid until close().
+    """
+
+    MAGIC = "\x7fELF"
+    HEADER = "16xHHIIIIIHHH"
+    PROGRAM_HEADER = "IIIIIIII"
+    PT_LOAD = 1
+
+    def __init__(self, filename):
+        fd = open(filename, "rb")
+        self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        fd.close()
+        if self.map[:4] != ElfImage.MAGIC or self.map[4] != '\x01':
+            raise ValueError("%s is no 32 bit ELF file" % filename)
+        endian = self.map[5] == '\x02' and ">" or "<"
+        (etype, machine, version, self.entry, phoff, shoff, flags, ehsize,
+            phentsize, phnum) = struct.unpack_from(endian + ElfImage.HEADER, self.map)
+        view = memoryview(buffer(self.map))
+        loads = []
+        zeros = []
+        for i in range(phnum):
+            (ptype, offset, vaddr, paddr, filesz, memsz, pflags,
+                align) = struct.unpack_from(endian + ElfImage.PROGRAM_HEADER, self.map, phoff + i * phentsize)
+            if ptype != ElfImage.PT_LOAD:
+                continue
+            if filesz:
+                loads.append((paddr, offset, filesz))
+            if memsz > filesz:
+                zeros.append((paddr + filesz, memsz - filesz))
+        self.starts = []
+        self.segments = []
+        for group in ElfImage.touching(loads):
+            addr, offset, size = group[0]
+            if all(a + n == b and o + n == p for (a, o, n), (b, p, m) in zip(group, group[1:])):
+                end = group[-1][1] + group[-1][2]
+                self.starts.append(addr)
+                self.segments.append(view[offset:end])
+                continue
+            # overlapping segments, later program headers win
+            merged = SegmentMap()
+            for addr, offset, size in sorted(group, key=loads.index):
+                merged.add(addr, view[offset:offset + size])
+            self.starts += merged.starts
+            self.segments += merged.segments
+        self.zeros = self.clip(zeros)
+
+    @staticmethod
+    def touching(loads):
+        """(addr, offset, size) loads in groups that overlap or touch"""
+        groups = []
+        end = None
+        for load in sorted(loads):
+            if groups and load[0] <= end:
+                groups[-1].append(load)
+            else:
+                groups.append([load])
+                end = load[0]
+            end = max(end, load[0] + load[2])
+        return groups
+
+    def clip(self, zeros):
+        """(addr, size) zero ranges without the parts data covers, merged"""
+        pieces = []
+        for addr, size in zeros:
+            end = addr + size
+            for start, seg in zip(self.starts, self.segments):
+                if start + len(seg) <= addr or start >= end:
+                    continue
+                if addr < start:
+                    pieces.append((addr, start))
+                addr = max(addr, start + len(seg))
+            if addr < end:
+                pieces.append((addr, end))
+        merged = []
+        for addr, end in sorted(pieces):
+            if merged and merged[-1][1] >= addr:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([addr, end])
+        return [(addr, end - addr) for addr, end in merged]
+
+    def freeze(self):
+        # read-only already
+        return self
+
+    def close(self):
+        self.starts = []
+        self.segments = []
+        self.map.close()
+
+class HexImageReader(object):
+    """Streaming reader of srec (S1/S2/S3 data, S7/S8/S9 start address)
+       and Intel HEX files. Iterating yields (addr, memoryview) for every
+       data record once its checksum checked out, start holds the start
+       address after the last record. Damaged files raise ValueError.
+    """
+
+    SREC_ADDR = {'0': 2, '1': 2, '2': 3, '3': 4, '5': 2, '6': 3, '7': 4, '8': 3, '9': 2}
+    IHEX_DATA, IHEX_EOF, IHEX_SEGMENT, IHEX_START_SEGMENT, IHEX_LINEAR, IHEX_START_LINEAR = range(6)
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.start = 0
+        self.base = 0
+
+    def __iter__(self):
+        fd = open(self.filename, "rb")
+        parse = fd.read(1) == ':' and self.ihex or self.srec
+        fd.seek(0)
+        self.base = 0
+        for number, line in enumerate(fd, 1):
+            line = line.strip()
+            if line:
+                record = parse(line, number)
+                if record is not None:
+                    yield record
+        fd.close()
+
+    def unhexlify(self, text, number):
+        try:
+            record = bytearray(binascii.unhexlify(text))
+        except TypeError:
+            raise ValueError("%s:%i: not a hex record" % (self.filename, number))
+        if not record:
+            raise ValueError("%s:%i: empty record" % (self.filename, number))
+        return record
+
+    def srec(self, line, number):
+        kind = line[1:2]
+        if line[:1] != 'S' or kind not in HexImageReader.SREC_ADDR:
+            raise ValueError("%s:%i: not an srec record" % (self.filename, number))
+        record = self.unhexlify(line[2:], number)
+        if record[0] != len(record) - 1:
+            raise ValueError("%s:%i: length mismatch" % (self.filename, number))
+        if sum(record) & 0xff != 0xff:
+            raise ValueError("%s:%i: checksum mismatch" % (self.filename, number))
+        size = HexImageReader.SREC_ADDR[kind]
+        addr = int(line[4:4 + 2 * size], 16)
+        if kind in '123':
+            return addr, memoryview(record)[1 + size:-1]
+        if kind in '789':
+            self.start = addr
+        return None
+
+    def ihex(self, line, number):
+        if line[:1] != ':':
+            raise ValueError("%s:%i: not an Intel HEX record" % (self.filename, number))
+        record = self.unhexlify(line[1:], number)
+        if len(record) < 5 or record[0] != len(record) - 5:
+            raise ValueError("%s:%i: length mismatch" % (self.filename, number))
+        if sum(record) & 0xff:
+            raise ValueError("%s:%i: checksum mismatch" % (self.filename, number))
+        kind = record[3]
+        if kind == HexImageReader.IHEX_DATA:
+            return self.base + (record[1] << 8 | record[2]), memoryview(record)[4:-1]
+        value = record[0] and int(line[9:-2], 16)
+        if kind == HexImageReader.IHEX_SEGMENT:
+            self.base = value << 4
+        elif kind == HexImageReader.IHEX_LINEAR:
+            self.base = value << 16
+        elif kind == HexImageReader.IHEX_START_SEGMENT:
+            self.start = (value >> 16 << 4) + (value & 0xffff)
+        elif kind == HexImageReader.IHEX_START_LINEAR:
+            self.start = value
+        return None
+
+
+class ParsedImageCache(object):
+    """Binary copies of parsed srec and Intel HEX images, keyed by the SHA1
+       of the file, so an unchanged image is not parsed again. The least
+       recently used copies are dropped beyond MAX_SIZE bytes.
+    """
+
+    PATH = os.path.expanduser("~/.lm32client/parsed")
+    MAX_SIZE = 0x8000000
+    HEADER = struct.Struct(">8sII")
+    EXTENT = struct.Struct(">II")
+    MAGIC = "lm32img1"
+    warned = False
+
+    def __init__(self, filename):
+        digest = hashlib.sha1()
+        fd = open(filename, "rb")
+        for block in iter(lambda: fd.read(0x100000), ""):
+            digest.update(block)
+        fd.close()
+        self.filename = os.path.join(ParsedImageCache.PATH, digest.hexdigest() + ".bin")
+
+    def load(self):
+        """the cached (SegmentMap, start address) or None"""
+        try:
+            data = open(self.filename, "rb").read()
+            magic, start, count = ParsedImageCache.HEADER.unpack_from(data)
+        except (IOError, struct.error):
+            return None
+        if magic != ParsedImageCache.MAGIC:
+            return None
+        segments = SegmentMap()
+        pos = ParsedImageCache.HEADER.size
+        for i in range(count):
+            addr, size = ParsedImageCache.EXTENT.unpack_from(data, pos)
+            pos += ParsedImageCache.EXTENT.size
+            if pos + size > len(data):
+                return None
+            segments.starts.append(addr)
+            segments.segments.append(bytearray(buffer(data, pos, size)))
+            pos += size
+        try:
+            os.utime(self.filename, None)
+        except OSError:
+            pass
+        return segments, start
+
+    def save(self, segments, start):
+        """best effort, a cache that can't be written only costs a parse"""
+        try:
+            make_dirs(ParsedImageCache.PATH)
+            fd = open(self.filename + ".tmp", "wb")
+            try:
+                fd.write(ParsedImageCache.HEADER.pack(ParsedImageCache.MAGIC, start, len(segments)))
+                for addr, data in zip(segments.starts, segments.segments):
+                    fd.write(ParsedImageCache.EXTENT.pack(addr, len(data)))
+                    fd.write(data)
+            finally:
+                fd.close()
+            os.rename(self.filename + ".tmp", self.filename)
+        except (IOError, OSError), e:
+            if not ParsedImageCache.warned:
+                ParsedImageCache.warned = True
+                sys.stderr.write("Can't write parse cache %s: %s\n" % (ParsedImageCache.PATH, e))
+            try:
+                os.unlink(self.filename + ".tmp")
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """drop the least recently used copies beyond MAX_SIZE"""
+        entries = []
+        for filename in glob.glob(os.path.join(ParsedImageCache.PATH, "*.bin")):
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total = 0
+        for mtime, size, filename in sorted(entries, reverse=True):
+            total += size
+            if total > ParsedImageCache.MAX_SIZE and filename != self.filename:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+
+
+def load_srec(filename):
+    """parse an srec or Intel HEX file into a SegmentMap and its start
+       address, unless the parse cache has it already
+    """
+    cache = ParsedImageCache(filename)
+    loaded = cache.load()
+    if loaded is not None:
+        return loaded
+    reader = HexImageReader(filename)
+    segments = SegmentMap()
+    for addr, data in reader:
+        segments.add(addr, data)
+    cache.save(segments, reader.start)
+    return segments, reader.start
+
+def load_image(filename):
+    """SegmentMap of an srec or Intel HEX file or ElfImage of an ELF file
+       and its start address
+    """
+    fd = open(filename, "rb")
+    magic = fd.read(4)
+    fd.close()
+    if magic != ElfImage.MAGIC:
+        return load_srec(filename)
+    image = ElfImage(filename)
+    return image, image.entry
@@ -0,0 +1,108 @@
+"""SVF cache of UrjtagUploader with fake impact and jtag executables."""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lm32client
+
+# writes an SVF naming the programmed bitstream to the setCable file
+IMPACT = """#!/bin/sh
+echo impact >> "%(log)s"
+svf=$(sed -n 's/^setCable -port svf -file //p' "$2")
+sed -n 's/^addDevice -p 2 -file //p' "$2" > "$svf"
+echo impact done
+"""
+
+JTAG = """#!/bin/sh
+echo jtag >> "%(log)s"
+sed -n 's/^svf //p' "$1"
+"""
+
+
+class SVFCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "calls")
+        self.path = lm32client.UrjtagUploader.PATH_SVF
+        lm32client.UrjtagUploader.PATH_SVF = os.path.join(self.dir, "svf")
+        self.impact = self.script("impact", IMPACT)
+        self.jtag = self.script("jtag", JTAG)
+        self.stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        lm32client.UrjtagUploader.PATH_SVF = self.path
+        shutil.rmtree(self.dir)
+
+    def script(self, name, text):
+        filename = os.path.join(self.dir, name)
+        open(filename, "w").write(text % {"log": self.log})
+        os.chmod(filename, 0755)
+        return filename
+
+    def bitstream(self, name, data):
+        filename = os.path.join(self.dir, name)
+        open(filename, "wb").write(data)
+        return filename
+
+    def program(self, filename, impact=None, timeout=10):
+        urjtag = lm32client.UrjtagUploader(filename, impact or self.impact, self.jtag, timeout)
+        urjtag.makeSVF()
+        urjtag.uploadSVF()
+        return urjtag
+
+    def calls(self):
+        if not os.path.isfile(self.log):
+            return []
+        return open(self.log).read().split()
+
+    def test_miss_then_hit(self):
+        filename = self.bitstream("a.bit", "bits of a")
+        urjtag = self.program(filename)
+        self.assertEqual(open(urjtag.file_svf).read(), filename + "\n")
+        self.assertEqual(self.calls(), ["impact", "jtag"])
+        self.program(filename)
+        self.assertEqual(self.calls(), ["impact", "jtag", "jtag"])
+        self.assertIn(urjtag.file_svf, sys.stdout.getvalue())
+
+    def test_key_is_the_content(self):
+        first = self.program(self.bitstream("a.bit", "same bits"))
+        second = self.program(self.bitstream("b.bit", "same bits"))
+        third = self.program(self.bitstream("a.bit", "new bits"))
+        self.assertEqual(first.file_svf, second.file_svf)
+        self.assertNotEqual(first.file_svf, third.file_svf)
+        self.assertEqual(self.calls().count("impact"), 2)
+
+    def test_failing_impact(self):
+        impact = self.script("bad", "#!/bin/sh\necho no license\nexit 3\n")
+        with self.assertRaises(lm32client.ToolError) as context:
+            self.program(self.bitstream("a.bit", "bits"), impact)
+        self.assertEqual(str(context.exception), "impact failed with exit code 3")
+        self.assertEqual(context.exception.output, "no license\n")
+        self.assertEqual(os.listdir(lm32client.UrjtagUploader.PATH_SVF), [])
+
+    def test_impact_without_svf(self):
+        impact = self.script("lazy", "#!/bin/sh\necho nothing\n")
+        with self.assertRaises(lm32client.ToolError) as context:
+            self.program(self.bitstream("a.bit", "bits"), impact)
+        self.assertEqual(str(context.exception), "Failed to create svf file")
+
+    def test_timeout(self):
+        impact = self.script("slow", "#!/bin/sh\nsleep 30\n")
+        with self.assertRaises(lm32client.ToolError) as context:
+            self.program(self.bitstream("a.bit", "bits"), impact, 1)
+        self.assertEqual(str(context.exception), "impact did not finish within 1s")
+
+    def test_missing_tool(self):
+        with self.assertRaises(lm32client.ToolError):
+            self.program(self.bitstream("a.bit", "bits"), os.path.join(self.dir, "none"))
+
+
+if __name__ == '__main__':
+    unittest.main()
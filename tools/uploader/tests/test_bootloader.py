@@ -0,0 +1,129 @@
+"""LM32Serial transfers in the plain protocol and in packet mode against
+the bootloader emulated by lm32emu."""
+import os
+import sys
+import random
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lm32client
+
+RAM = 0x40000000
+
+
+class Emulator(object):
+    """lm32emu child process serving the bootloader on a local TCP port"""
+
+    def __init__(self, *args):
+        script = os.path.join(os.path.dirname(os.path.abspath(lm32client.__file__)), "lm32emu.py")
+        self.proc = subprocess.Popen([sys.executable, script, "--tcp", "127.0.0.1:0"] + list(args),
+            stdout=subprocess.PIPE)
+        self.port = self.proc.stdout.readline().strip()
+
+    def close(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+
+class QuietSerial(lm32client.LM32Serial):
+
+    def info(self, msg):
+        pass
+
+    def progress(self):
+        pass
+
+
+def payload(size, seed=0):
+    rand = random.Random(seed)
+    return bytearray(rand.getrandbits(8) for i in range(size))
+
+
+class BoardTest(unittest.TestCase):
+
+    ARGS = ()
+    PACKETS = False
+
+    @classmethod
+    def setUpClass(cls):
+        cls.emulator = Emulator(*cls.ARGS)
+        cls.lm32 = QuietSerial(cls.emulator.port, 115200)
+        cls.lm32.find_bootloader(packets=cls.PACKETS)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.lm32.close()
+        cls.emulator.close()
+
+
+class PlainTest(BoardTest):
+
+    def test_upload_download(self):
+        data = payload(5000, 1)
+        self.lm32.upload(RAM + 0x1000, data)
+        self.assertEqual(self.lm32.download(RAM + 0x1000, len(data)), data)
+        self.assertEqual(self.lm32.checksum(RAM + 0x1000, len(data)), lm32client.crc32(str(data)))
+
+    def test_chunked(self):
+        data = payload(0x3000, 2)
+        self.lm32.upload_chunked(data, RAM + 0x8000, len(data), 0x400)
+        self.assertEqual(self.lm32.download_chunked(RAM + 0x8000, len(data), 0x500), data)
+
+    def test_compressed(self):
+        data = bytearray("lm32 " * 1000) + payload(100, 3)
+        self.assertLess(self.lm32.upload_compressed(RAM + 0x10000, data), len(data))
+        self.assertEqual(self.lm32.download(RAM + 0x10000, len(data)), data)
+
+    def test_zero_fill(self):
+        self.lm32.upload(RAM + 0x20000, payload(3000, 4))
+        self.assertLess(self.lm32.zero_fill(RAM + 0x20000, 3000), 3000)
+        self.assertEqual(self.lm32.download(RAM + 0x20000, 3000), bytearray(3000))
+
+    def test_verify_zeros(self):
+        segments = lm32client.SegmentMap()
+        segments.add(RAM + 0x30000, payload(100, 7))
+        segments.zeros = [(RAM + 0x30064, 0x900)]
+        self.lm32.upload(RAM + 0x30000, payload(0xa00, 8))
+        self.assertFalse(lm32client.verify_segments(self.lm32, segments, 0x400))
+        self.lm32.upload(RAM + 0x30000, payload(100, 7))
+        self.lm32.zero_fill(RAM + 0x30064, 0x900)
+        self.assertTrue(lm32client.verify_segments(self.lm32, segments, 0x400))
+
+
+class PacketTest(BoardTest):
+
+    ARGS = ("--noise", "0.001", "--seed", "1")
+    PACKETS = True
+
+    def test_packet_mode(self):
+        self.assertTrue(self.lm32.packets)
+
+    def test_transfer_under_noise(self):
+        data = payload(0x4000, 5)
+        self.lm32.upload(RAM + 0x1000, data)
+        self.assertEqual(self.lm32.download(RAM + 0x1000, len(data)), data)
+        self.assertEqual(self.lm32.checksum(RAM + 0x1000, len(data)), lm32client.crc32(str(data)))
+        self.assertTrue(self.lm32.packets.retransmits)
+
+
+class PacketLeaveTest(BoardTest):
+
+    PACKETS = True
+
+    def test_lost_leave_ack(self):
+        link = self.lm32.packets
+        # a 'q' whose ACK gets lost, seq 0x67 would be a 'g' in plain mode
+        self.lm32.wire.send(link.frame('q', 0x67, 0, 0))
+        self.assertEqual(link.receive()[:2], ('a', 0x67))
+        link.seq = 0x67
+        self.lm32.leave_packet_mode()
+        self.assertTrue(self.lm32.ping())
+        data = payload(100, 6)
+        self.lm32.upload(RAM, data)
+        self.assertEqual(self.lm32.download(RAM, len(data)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,246 @@
+"""SegmentMap, ElfImage, the srec/Intel HEX reader and the parse cache of
+lm32image."""
+import os
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lm32image
+
+
+def srec(kind, addr, data, width=4):
+    body = bytearray([width + len(data) + 1]) + bytearray(struct.pack(">I", addr)[4 - width:]) + bytearray(data)
+    return "S%s%s%02X" % (kind, str(body).encode("hex").upper(), ~sum(body) & 0xff)
+
+def ihex(kind, addr, data):
+    body = bytearray([len(data), addr >> 8, addr & 0xff, kind]) + bytearray(data)
+    return ":%s%02X" % (str(body).encode("hex").upper(), -sum(body) & 0xff)
+
+def elf(loads, entry=0x40000000):
+    """big endian 32 bit ELF with (paddr, data, memsz) PT_LOAD segments,
+       data at the file offsets given by an optional fourth item
+    """
+    phoff = 52
+    body = bytearray()
+    headers = ""
+    for load in loads:
+        paddr, data, memsz = load[:3]
+        offset = len(load) > 3 and load[3] or phoff + 32 * len(loads) + len(body)
+        end = offset - phoff - 32 * len(loads) + len(data)
+        body += bytearray(max(0, end - len(body)))
+        body[end - len(data):end] = data
+        headers += struct.pack(">IIIIIIII", 1, offset, paddr, paddr, len(data), memsz, 5, 4)
+    header = "\x7fELF\x01\x02\x01" + "\0" * 9
+    header += struct.pack(">HHIIIIIHHHHHH", 2, 0x8a, 1, entry, phoff, 0, 0, 52, 32, len(loads), 40, 0, 0)
+    return header + headers + str(body)
+
+
+
+class SegmentMapTest(unittest.TestCase):
+
+    def extents(self, segments, max_size=0):
+        return [(addr, data.tobytes()) for addr, data in segments.extents(max_size)]
+
+    def test_merge_adjacent(self):
+        segments = lm32image.SegmentMap()
+        segments.add(0x100, "ab")
+        segments.add(0x102, "cd")
+        segments.add(0x10, "xy")
+        self.assertEqual(self.extents(segments), [(0x10, "xy"), (0x100, "abcd")])
+        self.assertEqual(segments.size(), 6)
+        self.assertEqual(len(segments), 2)
+
+    def test_later_records_win(self):
+        segments = lm32image.SegmentMap()
+        segments.add(0x100, "aaaa")
+        segments.add(0x102, "bbbb")
+        segments.add(0xff, "c")
+        self.assertEqual(self.extents(segments), [(0xff, "caabbbb")])
+
+    def test_fill_gap_swallows_following(self):
+        segments = lm32image.SegmentMap()
+        segments.add(0x100, "aa")
+        segments.add(0x104, "cc")
+        segments.add(0x108, "ee")
+        segments.add(0x102, "bbbbbb")
+        self.assertEqual(self.extents(segments), [(0x100, "aabbbbbbee")])
+
+    def test_extents_max_size(self):
+        segments = lm32image.SegmentMap()
+        segments.add(0, "0123456789")
+        self.assertEqual(self.extents(segments, 4), [(0, "0123"), (4, "4567"), (8, "89")])
+
+    def test_empty_records(self):
+        segments = lm32image.SegmentMap()
+        segments.add(0x100, "")
+        segments.add(0x200, "ab")
+        segments.add(0x202, "")
+        self.assertEqual(self.extents(segments), [(0x200, "ab")])
+        self.assertEqual(self.extents(lm32image.SegmentMap()), [])
+
+    def test_freeze(self):
+        segments = lm32image.SegmentMap()
+        segments.add(0, "abc")
+        self.assertEqual(self.extents(segments.freeze()), [(0, "abc")])
+
+
+class ImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = lm32image.ParsedImageCache.PATH
+        lm32image.ParsedImageCache.PATH = os.path.join(self.dir, "parsed")
+
+    def tearDown(self):
+        lm32image.ParsedImageCache.PATH = self.path
+        shutil.rmtree(self.dir)
+
+    def write(self, name, lines):
+        filename = os.path.join(self.dir, name)
+        open(filename, "w").write("\n".join(lines) + "\n")
+        return filename
+
+    def records(self, filename):
+        reader = lm32image.HexImageReader(filename)
+        return [(addr, data.tobytes()) for addr, data in reader], reader.start
+
+    def test_srec(self):
+        filename = self.write("a.srec", [
+            srec("0", 0, "hdr", 2),
+            srec("1", 0x1000, "\x01\x02", 2),
+            srec("2", 0x20000, "\x03", 3),
+            srec("3", 0x40000000, "\x04\x05\x06"),
+            srec("3", 0x40000003, ""),
+            srec("7", 0x40000000, ""),
+        ])
+        self.assertEqual(self.records(filename), ([(0x1000, "\x01\x02"), (0x20000, "\x03"),
+            (0x40000000, "\x04\x05\x06"), (0x40000003, "")], 0x40000000))
+
+    def test_ihex(self):
+        filename = self.write("a.hex", [
+            ihex(0, 0x0010, "\xaa\xbb"),
+            ihex(4, 0, "\x40\x00"),
+            ihex(0, 0x0100, "\xcc"),
+            ihex(2, 0, "\x10\x00"),
+            ihex(0, 0x0002, "\xdd"),
+            ihex(5, 0, "\x40\x00\x01\x00"),
+            ihex(1, 0, ""),
+        ])
+        self.assertEqual(self.records(filename), ([(0x10, "\xaa\xbb"), (0x40000100, "\xcc"),
+            (0x10002, "\xdd")], 0x40000100))
+
+    def assertDamaged(self, lines, message):
+        filename = self.write("bad", lines)
+        with self.assertRaises(ValueError) as context:
+            self.records(filename)
+        self.assertIn(message, str(context.exception))
+
+    def test_srec_checksum(self):
+        line = srec("3", 0x1000, "\x01\x02")
+        self.assertDamaged([srec("0", 0, "", 2), line[:-2] + "00"], "bad:2: checksum mismatch")
+
+    def test_srec_length(self):
+        line = srec("3", 0x1000, "\x01\x02")
+        self.assertDamaged([line[:2] + "09" + line[4:]], "bad:1: length mismatch")
+
+    def test_srec_garbage(self):
+        self.assertDamaged(["S3zz"], "not a hex record")
+        self.assertDamaged(["X3000000"], "not an srec record")
+
+    def test_ihex_checksum(self):
+        line = ihex(0, 0x10, "\x01\x02")
+        self.assertDamaged([line[:-2] + "00"], "bad:1: checksum mismatch")
+
+    def test_ihex_length(self):
+        self.assertDamaged([":0500100001"], "length mismatch")
+
+    def test_load_image_cache(self):
+        filename = self.write("a.srec", [srec("3", 0x100, "abcd"), srec("3", 0x104, "ef"), srec("7", 0x100, "")])
+        segments, start = lm32image.load_image(filename)
+        cached = lm32image.ParsedImageCache(filename)
+        self.assertTrue(os.path.isfile(cached.filename))
+        for segments, start in (lm32image.load_image(filename), cached.load()):
+            self.assertEqual([(addr, data.tobytes()) for addr, data in segments.extents()], [(0x100, "abcdef")])
+            self.assertEqual(start, 0x100)
+
+    def test_cache_eviction(self):
+        size = lm32image.ParsedImageCache.MAX_SIZE
+        lm32image.ParsedImageCache.MAX_SIZE = 0x100
+        try:
+            names = []
+            for i in range(4):
+                filename = self.write("%i.srec" % i, [srec("3", 0x100, chr(i) * 100)])
+                lm32image.load_image(filename)
+                names.append(lm32image.ParsedImageCache(filename).filename)
+                # mtime resolution of the file system
+                os.utime(names[-1], (i, i))
+        finally:
+            lm32image.ParsedImageCache.MAX_SIZE = size
+        self.assertEqual([os.path.isfile(name) for name in names], [False, False, True, True])
+
+    def test_unwritable_cache(self):
+        blocker = self.write("blocker", [])
+        lm32image.ParsedImageCache.PATH = os.path.join(blocker, "parsed")
+        filename = self.write("a.srec", [srec("3", 0x100, "abcd")])
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            for i in range(2):
+                segments, start = lm32image.load_image(filename)
+                self.assertEqual(segments.size(), 4)
+            warnings = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+            lm32image.ParsedImageCache.warned = False
+        self.assertEqual(warnings.count("Can't write parse cache"), 1)
+
+
+class ElfImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def image(self, loads):
+        filename = os.path.join(self.dir, "a.elf")
+        open(filename, "wb").write(elf(loads))
+        image, entry = lm32image.load_image(filename)
+        self.assertEqual(entry, 0x40000000)
+        return image
+
+    def extents(self, image):
+        return [(addr, data.tobytes()) for addr, data in image.extents()]
+
+    def test_segments(self):
+        with self.image([(0x1000, "code", 4), (0x40000000, "data", 0x10)]) as image:
+            self.assertEqual(self.extents(image), [(0x1000, "code"), (0x40000000, "data")])
+            self.assertEqual(image.zeros, [(0x40000004, 0xc)])
+        self.assertEqual(len(image), 0)
+
+    def test_adjacent_segments(self):
+        with self.image([(0x100, "ab", 2), (0x102, "cd", 2)]) as image:
+            self.assertEqual(self.extents(image), [(0x100, "abcd")])
+            # contiguous in the file as well, still a view
+            self.assertIsInstance(image.segments[0], memoryview)
+        with self.image([(0x100, "ab", 2), (0x102, "cd", 2), (0x104, "ef", 2, 200)]) as image:
+            self.assertEqual(self.extents(image), [(0x100, "abcdef")])
+
+    def test_overlapping_segments(self):
+        with self.image([(0x100, "aaaa", 4), (0x102, "bbbb", 4), (0xfe, "c", 1)]) as image:
+            self.assertEqual(self.extents(image), [(0xfe, "c"), (0x100, "aabbbb")])
+
+    def test_zeros_around_data(self):
+        loads = [(0x100, "ab", 0x10), (0x104, "cd", 2), (0x110, "", 8), (0x200, "", 4)]
+        with self.image(loads) as image:
+            self.assertEqual(self.extents(image), [(0x100, "ab"), (0x104, "cd")])
+            self.assertEqual(image.zeros, [(0x102, 2), (0x106, 0x12), (0x200, 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
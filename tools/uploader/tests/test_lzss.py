@@ -0,0 +1,84 @@
+"""LZSS compression of lm32client against a transcription of unpack() in
+boot0-serial."""
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lm32client
+from lm32client import LZ_N, LZ_F, LZ_THRESHOLD
+
+
+def unpack(packed):
+    """unpack() of boot0-serial, the ring starts out filled with spaces"""
+    packed = bytearray(packed)
+    size = len(packed)
+    out = bytearray()
+    pos = 0
+    flags = 0
+    while pos < size:
+        flags >>= 1
+        if not flags & 256:
+            flags = packed[pos] | 0xff00
+            pos += 1
+            if pos == size:
+                break
+        if flags & 1:
+            out.append(packed[pos])
+            pos += 1
+        else:
+            if size - pos < 2:
+                break
+            i, j = packed[pos], packed[pos + 1]
+            pos += 2
+            i |= (j & 0xf0) << 4
+            dist = (LZ_N - LZ_F + len(out) - i) & (LZ_N - 1) or LZ_N
+            for k in range((j & 0x0f) + LZ_THRESHOLD + 1):
+                out.append(out[-dist] if len(out) >= dist else 0x20)
+    return out
+
+
+class LzssTest(unittest.TestCase):
+
+    def roundtrip(self, data):
+        packed = lm32client.lzss_compress(data)
+        self.assertEqual(unpack(packed), bytearray(data))
+        return packed
+
+    def test_empty(self):
+        self.assertEqual(self.roundtrip(""), bytearray())
+
+    def test_random(self):
+        rand = random.Random(1)
+        for size in (1, 2, 3, 17, 18, 19, 4095, 4096, 10000):
+            self.roundtrip(bytearray(rand.getrandbits(8) for i in range(size)))
+
+    def test_repetitive(self):
+        packed = self.roundtrip("hello lm32 " * 2000)
+        self.assertLess(len(packed), 22000 / 8)
+
+    def test_spaces_before_start(self):
+        # matches into the initial ring of spaces must not be produced
+        self.roundtrip("   abc" * 100)
+
+    def test_far_matches(self):
+        rand = random.Random(2)
+        block = bytearray(rand.getrandbits(8) for i in range(5000))
+        self.roundtrip(block + block)
+
+    def test_memoryview(self):
+        data = bytearray("abcabcabcabc" * 100)
+        packed = lm32client.lzss_compress(memoryview(data)[3:])
+        self.assertEqual(unpack(packed), data[3:])
+
+    def test_zeros(self):
+        for size in (0, 1, 2, 3, 18, 19, 100, 0x10000 + 7):
+            packed = lm32client.lzss_zeros(size)
+            self.assertEqual(packed, lm32client.lzss_compress(bytearray(size)))
+            self.assertEqual(unpack(packed), bytearray(size))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+"""XMODEM and YMODEM transfers of lm32client.Modem between two Modem
+instances on a socket pair."""
+import os
+import sys
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lm32client
+
+
+class Loopback(object):
+    """one end of a socket pair with the read/write of a serial port"""
+
+    def __init__(self, sock, timeout=0.05):
+        self.sock = sock
+        self.sock.settimeout(timeout)
+
+    def read(self, size=1):
+        try:
+            return self.sock.recv(size)
+        except socket.timeout:
+            return ""
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+
+class ModemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        a, b = socket.socketpair()
+        self.sender = lm32client.Modem(Loopback(a))
+        self.receiver = lm32client.Modem(Loopback(b))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def file(self, name, size, seed=0):
+        rand = random.Random(seed)
+        filename = os.path.join(self.dir, name)
+        open(filename, "wb").write(str(bytearray(rand.getrandbits(8) for i in range(size))))
+        return filename
+
+    def transfer(self, filenames, ymodem, **receive):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.sender.send(filenames, ymodem)))
+        thread.setDaemon(1)
+        thread.start()
+        received = self.receiver.receive(**receive)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        return received, result[0]
+
+    def test_ymodem_batch(self):
+        filenames = [self.file("a.bin", 3000, 1), self.file("b.bin", 128, 2), self.file("c.bin", 1, 3)]
+        out = os.path.join(self.dir, "out")
+        os.mkdir(out)
+        received, (total, seconds) = self.transfer(filenames, True, directory=out)
+        self.assertEqual([os.path.basename(name) for name in received], ["a.bin", "b.bin", "c.bin"])
+        self.assertEqual(total, 3129)
+        for filename in filenames:
+            self.assertEqual(open(filename, "rb").read(),
+                open(os.path.join(out, os.path.basename(filename)), "rb").read())
+
+    def test_xmodem(self):
+        filename = self.file("x.bin", 2000)
+        target = os.path.join(self.dir, "x.out")
+        received, (total, seconds) = self.transfer([filename], False, filename=target)
+        self.assertEqual(received, [target])
+        self.assertEqual(open(filename, "rb").read(), open(target, "rb").read())
+
+    def test_xmodem_needs_filename(self):
+        filename = self.file("x.bin", 200)
+        thread = threading.Thread(target=lambda: self.assertRaises(lm32client.ModemError,
+            self.sender.send, [filename], False))
+        thread.setDaemon(1)
+        thread.start()
+        self.assertRaises(lm32client.ModemError, self.receiver.receive, self.dir)
+        thread.join(30)
+
+    def test_checksum(self):
+        self.sender.crc = True
+        self.assertEqual(self.sender.checksum("123456789"), "\x31\xc3")
+        self.sender.crc = False
+        self.assertEqual(self.sender.checksum("\x01\x02\xff"), "\x02")
+
+    def test_cancel_sender(self):
+        cancelled = threading.Event()
+        self.sender = lm32client.Modem(self.sender.port, lambda msg: cancelled.set(), cancelled)
+        filename = self.file("a.bin", 20000)
+        thread = threading.Thread(target=lambda: self.assertRaises(lm32client.ModemCancelled,
+            self.sender.send, [filename]))
+        thread.setDaemon(1)
+        thread.start()
+        with self.assertRaises(lm32client.ModemError) as context:
+            self.receiver.receive(self.dir)
+        self.assertEqual(str(context.exception), "cancelled by sender")
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_cancel_receiver(self):
+        self.receiver.cancelled.set()
+        self.assertRaises(lm32client.ModemCancelled, self.receiver.receive, self.dir)
+        self.assertTrue(self.sender.port.read(16).endswith(lm32client.Modem.CAN * 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""VCD output and decoder config of lac captures."""
+import os
+import sys
+import shutil
+import json
+import tempfile
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lm32client
+
+
+class VCDWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "capture.vcd")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, samples, start=0):
+        vcd = lm32client.VCDWriter(self.filename, "10ns")
+        vcd.writeHeader()
+        vcd.writeWires()
+        vcd.putSamples(bytearray(samples), start)
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            vcd.close()
+        finally:
+            sys.stdout = stdout
+        return open(self.filename).read()
+
+    def test_header(self):
+        text = self.write([0])
+        self.assertIn("$timescale\n\t10ns\n$end\n", text)
+        self.assertIn("$var wire 8 P probe[7:0] $end\n", text)
+        self.assertTrue(text.index("$enddefinitions $end\n") < text.index("#0\n"))
+
+    def test_value_changes_only(self):
+        text = self.write([1, 1, 2, 2, 2, 0x81])
+        body = text[text.index("$enddefinitions $end\n"):].split("\n")[1:]
+        self.assertEqual(body, ["#0", "b00000001 P", "#2", "b00000010 P", "#5", "b10000001 P", "#6", ""])
+
+    def test_start_offset(self):
+        text = self.write([7, 7], 100)
+        self.assertTrue(text.endswith("#100\nb00000111 P\n#102\n"))
+
+
+class LacConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "lac.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def load(self, decoders):
+        json.dump({"signals": {"sck": 0, "mosi": 1, "addr": [4, 7]}, "decoders": decoders},
+            open(self.filename, "w"))
+        return lm32client.load_lac_config(self.filename)
+
+    def test_signals(self):
+        signals, decoders = self.load([{"type": "spi", "sck": "sck", "mosi": "mosi"}])
+        self.assertEqual([(s.name, s.lsb, s.width) for s in signals],
+            [("sck", 0, 1), ("mosi", 1, 1), ("addr", 4, 4)])
+        self.assertEqual(decoders[0].names(), ["sck", "mosi"])
+
+    def test_undefined_signal(self):
+        with self.assertRaises(ValueError) as context:
+            self.load([{"type": "spi", "sck": "sck", "miso": "miso"}])
+        self.assertEqual(str(context.exception), "spi decoder uses undefined signal 'miso'")
+
+    def test_unknown_decoder(self):
+        self.assertRaises(ValueError, self.load, [{"type": "i2c", "scl": "sck"}])
+
+
+if __name__ == '__main__':
+    unittest.main()